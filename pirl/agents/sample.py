@@ -1,3 +1,6 @@
+import time
+
+from baselines import bench
 from baselines.common.vec_env import VecEnvWrapper
 import gym
 import numpy as np
@@ -98,4 +101,73 @@ class SampleVecMonitor(VecEnvWrapper):
 
     @property
     def trajectories(self):
-        return self._trajectories
\ No newline at end of file
+        return self._trajectories
+
+
+def record_episodes(env, returns, lengths):
+    '''Records episodes in the bench.Monitor wrapping env, as if they had
+       been run in it. For samplers that simulate episodes without stepping
+       env. Does nothing if env is not wrapped in a bench.Monitor.
+
+       Returns a list of episode info dicts, in the format bench.Monitor
+       adds to info['episode'].'''
+    monitor = env
+    while not isinstance(monitor, bench.Monitor):
+        if not isinstance(monitor, gym.Wrapper):
+            return [None] * len(returns)
+        monitor = monitor.env
+    epinfos = []
+    for eprew, eplen in zip(returns, lengths):
+        eprew = float(eprew)
+        eplen = int(eplen)
+        eptime = time.time() - monitor.tstart
+        epinfo = {"r": round(eprew, 6), "l": eplen, "t": round(eptime, 6)}
+        monitor.episode_rewards.append(eprew)
+        monitor.episode_lengths.append(eplen)
+        monitor.episode_times.append(eptime)
+        monitor.total_steps += eplen
+        if monitor.logger:
+            monitor.logger.writerow(epinfo)
+            monitor.f.flush()
+        epinfos.append(epinfo)
+    return epinfos
+
+
+
+class VecMonitor(VecEnvWrapper):
+    def __init__(self, venv, monitors):
+        '''Takes a vector environment venv and a list monitors of gym.Env
+           wrapped in bench.Monitor, one per environment in venv. Episodes
+           in environment i of venv are recorded in monitors[i], and
+           info['episode'] is set when they finish, as bench.Monitor does.
+           For vector environments that do not step an underlying gym.Env.
+           close() closes venv and then each monitor, so venv should not close
+           any of monitors itself.'''
+        assert len(monitors) == venv.num_envs
+        self.monitors = monitors
+        self.returns = None
+        self.lengths = None
+        super(VecMonitor, self).__init__(venv)
+
+    def step_wait(self):
+        obs, rews, dones, infos = self.venv.step_wait()
+        self.returns += rews
+        self.lengths += 1
+        for i in np.flatnonzero(dones):
+            epinfo, = record_episodes(self.monitors[i], [self.returns[i]],
+                                      [self.lengths[i]])
+            infos[i]['episode'] = epinfo
+            self.returns[i] = 0
+            self.lengths[i] = 0
+        return obs, rews, dones, infos
+
+    def reset(self):
+        obs = self.venv.reset()
+        self.returns = np.zeros(self.num_envs)
+        self.lengths = np.zeros(self.num_envs, dtype=int)
+        return obs
+
+    def close(self):
+        self.venv.close()
+        for m in self.monitors:
+            m.close()
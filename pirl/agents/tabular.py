@@ -1,15 +1,24 @@
+import logging
+
+from baselines.common.vec_env import VecEnv, VecEnvWrapper
 import gym
 from gym.utils import seeding
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from pirl.agents.sample import record_episodes
+from pirl.envs.tabular_mdp import policy_transition, transition_expectation
+from pirl.utils import cumulative_table, getattr_unwrapped, table_sample
 
-from pirl.utils import discrete_sample, getattr_unwrapped
+logger = logging.getLogger('pirl.agents.tabular')
 
 def q_iteration(transition, reward, horizon, discount,
                 policy=None, max_error=1e-3):
     """Performs value iteration on a finite-state MDP.
 
     Args:
-        - T(array): nS*nA*nS transition matrix.
+        - T(array or SparseTransition): nS*nA*nS transition matrix.
         - R(array): nS reward array.
         - H(int): maximum number of iterations.
         - policy(optional[array]): nS*nA policy matrix.
@@ -38,7 +47,7 @@ def q_iteration(transition, reward, horizon, discount,
             policy_V = Q.max(1)
         else:
             policy_V = np.sum(policy * Q, axis=1)
-        Q = reward + discount * (transition * policy_V).sum(2)
+        Q = reward + discount * transition_expectation(transition, policy_V)
         new_V = Q.sum(1)
         delta = np.linalg.norm(new_V - V, float('inf'))
         if delta < terminate_at:
@@ -52,6 +61,81 @@ def q_iteration(transition, reward, horizon, discount,
     return Q, info
 
 
+def policy_evaluation(transition, reward, policy, horizon, discount,
+                      max_error=1e-6, method='auto'):
+    """Exact value of a policy in a finite-state MDP.
+
+    Works with the S*S state transition matrix P under policy, which is
+    sparse if transition is, rather than the S*A*S transition tensor.
+
+    Args:
+        - transition(array, SparseTransition or CompiledMdp): nS*nA*nS
+            transition tensor.
+        - reward(array): nS reward array.
+        - policy(array): nS*nA policy matrix.
+        - horizon(optional[int]): number of timesteps. If None, computes
+            the infinite-horizon value, requiring discount < 1.
+        - discount(float): in [0,1].
+        - max_error(float): with method 'auto', tolerance on the error
+            from truncating to horizon.
+        - method(str): one of:
+            'solve': infinite-horizon value, solving the linear system
+                (I - discount * P) V = R. Requires discount < 1.
+            'recurse': horizon steps of V <- R + discount * P V.
+            'auto': 'solve' if horizon is None, or if the infinite-horizon
+                value is within max_error of the finite-horizon value;
+                otherwise, 'recurse'.
+
+    Returns (V, info) where:
+        - V is the value of each state (nS array).
+        - info is a dict providing information about convergence:
+            - method, the method used.
+            - num_iter, the number of iterations (0 for 'solve').
+            - error, a bound on the error in V with respect to the value
+              over horizon timesteps (or infinite horizon, if horizon is None).
+            - residual, the norm of (I - discount * P) V - R for 'solve'.
+    """
+    reward = np.asarray(reward, dtype=np.float64)
+    max_reward = np.abs(reward).max()
+    if discount < 1:
+        infinite_value = max_reward / (1 - discount)
+    else:
+        infinite_value = float('+inf')
+    if horizon is None:
+        truncation = 0
+    else:
+        truncation = discount ** horizon * infinite_value
+    if method == 'auto':
+        method = 'solve' if truncation <= max_error else 'recurse'
+
+    P = policy_transition(transition, policy)
+    nS = P.shape[0]
+    info = {'method': method}
+    if method == 'solve':
+        assert discount < 1
+        if scipy.sparse.issparse(P):
+            A = scipy.sparse.identity(nS, format='csr') - discount * P
+            V = scipy.sparse.linalg.spsolve(A.tocsc(), reward)
+        else:
+            A = np.eye(nS) - discount * P
+            V = np.linalg.solve(A, reward)
+        residual = np.linalg.norm(A @ V - reward, float('inf'))
+        info['num_iter'] = 0
+        info['residual'] = residual
+        info['error'] = residual / (1 - discount) + truncation
+    elif method == 'recurse':
+        assert horizon is not None
+        V = np.zeros(nS)
+        for i in range(horizon):
+            V = reward + discount * (P @ V)
+        info['num_iter'] = horizon
+        info['error'] = 0
+    else:
+        raise ValueError("Unknown method '{}'".format(method))
+
+    return V, info
+
+
 def get_policy(Q):
     """
     Computes an optimal policy from a Q-matrix.
@@ -73,10 +157,91 @@ def q_iteration_policy(T, R, H, discount=None):
     return get_policy(Q)
 
 
+def policy_iteration(transition, reward, discount,
+                     num_eval_sweeps=None, max_iter=1000):
+    """Performs (modified) policy iteration on a finite-state MDP, over an
+       infinite horizon. (Over a finite horizon, the optimal policy is not
+       stationary in general: use q_iteration.)
+
+    Args:
+        - transition(array, SparseTransition or CompiledMdp): nS*nA*nS
+            transition tensor.
+        - reward(array): nS reward array.
+        - discount(float): in [0,1).
+        - num_eval_sweeps(optional[int]): if None, evaluates each policy
+            exactly, solving a linear system with policy_evaluation (policy
+            iteration). Otherwise, performs num_eval_sweeps backups
+            V <- R + discount * P V under the policy, starting from the
+            previous value (modified policy iteration), until the policy is
+            stable; the policy is then improved with exact evaluation until
+            it is stable again.
+        - max_iter(int): maximum number of policy improvements.
+
+    Returns (Q, info) where:
+        - Q is the Q-value matrix (nS*nA matrix) of the final policy.
+        - info is a dict providing information about convergence, in particular:
+            - num_iter, the number of policy improvements.
+            - num_exact_iter, the number of exact policy evaluations.
+            - converged, whether the policy was stable under exact evaluation.
+    """
+    assert discount < 1, 'policy iteration requires discount < 1'
+    nS, nA, _ = transition.shape
+    reward = np.asarray(reward, dtype=np.float64)
+
+    V = np.zeros(nS)
+    Q = reward.reshape(nS, 1) + discount * transition_expectation(transition, V)
+    policy = get_policy(Q)
+    exact = num_eval_sweeps is None
+    num_exact_iter = 0
+    converged = False
+    for i in range(max_iter):
+        if exact:
+            new_V, _ = policy_evaluation(transition, reward, policy,
+                                         None, discount, method='solve')
+            num_exact_iter += 1
+        else:
+            P = policy_transition(transition, policy)
+            new_V = V
+            for j in range(num_eval_sweeps):
+                new_V = reward + discount * (P @ new_V)
+        Q = reward.reshape(nS, 1) + discount * transition_expectation(
+            transition, new_V)
+        new_policy = get_policy(Q)
+
+        stable = np.array_equal(new_policy, policy)
+        if exact:
+            # Rounding error may break ties differently between iterations,
+            # cycling between policies of the same value.
+            delta = np.linalg.norm(new_V - V, float('inf'))
+            scale = max(1, np.linalg.norm(new_V, float('inf')))
+            converged = stable or delta <= 1e-12 * scale
+        elif stable:
+            exact = True
+        V = new_V
+        policy = new_policy
+        if converged:
+            break
+
+    info = {
+        'num_iter': i + 1,
+        'num_exact_iter': num_exact_iter,
+        'converged': converged,
+    }
+    return Q, info
+
+
+def policy_iteration_policy(T, R, H, discount, num_eval_sweeps=None):
+    """Optimal policy over an infinite horizon: H is ignored, and discount
+       must be less than 1. Experiments using it are rejected by
+       config.types.parse_config otherwise."""
+    Q, info = policy_iteration(T, R, discount, num_eval_sweeps)
+    return get_policy(Q)
+
+
 def policy_env_wrapper(f):
     def helper(mdp, discount, seed, log_dir, reward=None):
         # log_dir is not used but is needed to match function signature.
-        T = getattr_unwrapped(mdp, 'transition')
+        T = getattr_unwrapped(mdp, 'compiled')
         if reward is None:
             reward = getattr_unwrapped(mdp, 'reward')
         H = getattr_unwrapped(mdp, '_max_episode_steps')
@@ -84,54 +249,177 @@ def policy_env_wrapper(f):
     return helper
 
 
-def value_in_mdp(mdp, policy, discount, seed):
+def value_in_mdp(mdp, policy, discount, seed, return_info=False):
     '''Exact value of a tabular policy in environment mdp with given discount.
-       Returns (value, 0), where 0 represents the standard error.'''
-    T = getattr_unwrapped(mdp, 'transition')
+       Returns (value, 0), where 0 represents the standard error.
+       If return_info, returns (value, 0, info) where info is that returned
+       by policy_evaluation; it is logged in either case.'''
+    T = getattr_unwrapped(mdp, 'compiled')
     R = getattr_unwrapped(mdp, 'reward')
     H = getattr_unwrapped(mdp, '_max_episode_steps')
-    Q, info = q_iteration(T, R, H, discount, policy=policy)
-    V = Q.sum(1)
+    V, info = policy_evaluation(T, R, policy, H - 1, discount)
+    logger.info('Policy evaluation: %s', info)
+    # Same as summing over actions the Q-values from q_iteration
+    nA = policy.shape[1]
+    V = nA * R + discount * transition_expectation(T, V).sum(1)
     initial_states = getattr_unwrapped(mdp, 'initial_states')
     value = np.sum(V * initial_states)
+    if return_info:
+        return value, 0, info
     return value, 0
 
 
-def sample(env, policy, num_episodes, seed):
+def sample_packed(env, policy, num_episodes, seed):
+    """Samples num_episodes episodes from policy in env, simulating all
+       episodes at once from the MDP's dynamics. env must be a (possibly
+       wrapped) TabularMdpEnv; the episode length is given by
+       _max_episode_steps and the terminal states.
+
+    Returns (states, actions, rewards, lengths) where:
+        - states, actions and rewards are num_episodes*L arrays, where L is
+          the length of the longest episode. Row i contains episode i,
+          padded with -1 (states and actions) or 0 (rewards) after
+          lengths[i] timesteps.
+        - lengths is an int array of the length of each episode.
+    """
     # seed to make results reproducible
     rng, _ = seeding.np_random(seed)
 
-    def helper():
-        '''Samples for one episode.'''
-        states = []
-        actions = []
-        rewards = []
+    compiled = getattr_unwrapped(env, 'compiled')
+    reward = getattr_unwrapped(env, 'reward')
+    terminal = getattr_unwrapped(env, 'terminal')
+    initial_states = getattr_unwrapped(env, 'initial_states')
+    try:
+        horizon = getattr_unwrapped(env, '_max_episode_steps')
+    except AttributeError:
+        horizon = None
+    policy_table = cumulative_table(np.asarray(policy))
+    initial_table = cumulative_table(initial_states)
+
+    zeros = np.zeros(num_episodes, dtype=int)
+    state = table_sample(initial_table, zeros, rng.rand(num_episodes))
+    active = np.ones(num_episodes, dtype=bool)
+    states, actions, rewards, actives = [], [], [], []
+    t = 0
+    while active.any():
+        action = table_sample(policy_table, state, rng.rand(num_episodes))
+        next_state = compiled.sample_successors(state, action,
+                                                rng.rand(num_episodes))
+        states.append(np.where(active, state, -1))
+        actions.append(np.where(active, action, -1))
+        rewards.append(np.where(active, reward[next_state], 0))
+        actives.append(active)
+
+        t += 1
+        done = terminal[next_state]
+        if horizon is not None and t >= horizon:
+            done = True
+        active = active & ~done
+        state = next_state
+
+    lengths = np.sum(actives, axis=0)
+    return (np.stack(states, axis=1), np.stack(actions, axis=1),
+            np.stack(rewards, axis=1), lengths)
+
+
+def sample(env, policy, num_episodes, seed):
+    """Samples num_episodes episodes from policy in env. See sample_packed.
+       env is not stepped, but the episodes are recorded in the bench.Monitor
+       wrapping it, if any.
+
+    Returns a list of (states, actions, rewards) tuples of arrays, one per
+    episode."""
+    states, actions, rewards, lengths = sample_packed(env, policy,
+                                                      num_episodes, seed)
+    record_episodes(env, np.sum(rewards, axis=1), lengths)
+    return [(states[i, :n], actions[i, :n], rewards[i, :n])
+            for i, n in enumerate(lengths)]
+
+
+class TabularMdpVecEnv(VecEnv):
+    """Vectorized version of a TabularMdpEnv, simulating num_envs episodes
+       in parallel with array operations. Episodes are reset automatically
+       when they terminate or reach _max_episode_steps.
+
+       Exposes the MDP's dynamics in the same attributes as TabularMdpEnv,
+       so tabular planning and IRL algorithms also accept it."""
+    def __init__(self, env, num_envs, seed=None):
+        """
+        Args:
+            env (gym.Env): a (possibly wrapped) TabularMdpEnv. The dynamics
+                and reward are read from it, including any reward wrapper
+                and TimeLimit. env itself is neither stepped nor closed:
+                it remains owned by the caller.
+            num_envs (int): number of parallel episodes.
+            seed (int): seed for the random number generator.
+        """
+        self.compiled = getattr_unwrapped(env, 'compiled')
+        self.transition = getattr_unwrapped(env, 'transition')
+        self.reward = getattr_unwrapped(env, 'reward')
+        self.initial_states = getattr_unwrapped(env, 'initial_states')
+        self.terminal = getattr_unwrapped(env, 'terminal')
+        self.features = getattr_unwrapped(env, 'features')
+        try:
+            self._max_episode_steps = getattr_unwrapped(env,
+                                                        '_max_episode_steps')
+        except AttributeError:
+            pass
+        self._initial_table = cumulative_table(self.initial_states)
+        super().__init__(num_envs, env.observation_space, env.action_space)
+
+        self.seed(seed)
+        self._actions = None
+        self.reset()
 
-        state = env.reset()
-        done = False
-        while not done:
-            states.append(state)
-            action_dist = policy[state]
-            action = discrete_sample(action_dist, rng)
-            actions.append(action)
-            state, reward, done, _ = env.step(action)
-            rewards.append(reward)
-        return np.array(states), np.array(actions), np.array(rewards)
+    def seed(self, seed=None):
+        self.rng, seed = seeding.np_random(seed)
+        return [seed]
 
-    return [helper() for i in range(num_episodes)]
+    def _sample_initial(self, n):
+        return table_sample(self._initial_table, np.zeros(n, dtype=int),
+                            self.rng.rand(n))
+
+    def reset(self):
+        self._states = self._sample_initial(self.num_envs)
+        self._elapsed = np.zeros(self.num_envs, dtype=int)
+        return self._states.copy()
+
+    def step_async(self, actions):
+        self._actions = np.asarray(actions)
+
+    def step_wait(self):
+        states = self.compiled.sample_successors(self._states, self._actions,
+                                                 self.rng.rand(self.num_envs))
+        rewards = self.reward[states]
+        self._elapsed += 1
+        dones = self.terminal[states]
+        horizon = getattr(self, '_max_episode_steps', None)
+        if horizon is not None:
+            dones = dones | (self._elapsed >= horizon)
+        # States reached by this step, before any episodes were reset.
+        self.next_states = states
+
+        self._states = states.copy()
+        num_done = np.count_nonzero(dones)
+        if num_done > 0:
+            self._states[dones] = self._sample_initial(num_done)
+            self._elapsed[dones] = 0
+        infos = [{} for _i in range(self.num_envs)]
+        return self._states.copy(), rewards, dones, infos
+
+    def close(self):
+        pass  # env is owned by the caller
 
 
 class TabularRewardWrapper(gym.Wrapper):
     """Wrapper for a gym.Env replacing with a new reward matrix."""
     def __init__(self, env, new_reward):
-        # Note: will fail on vectorized environments, but value_iteration
-        # doesn't support these anyway.
         self.new_reward = new_reward
         super().__init__(env)
 
     def step(self, action):
         observation, old_reward, done, info = self.env.step(action)
-        new_reward = self.new_reward[observation, action]
+        new_reward = self.new_reward[observation]
         return observation, new_reward, done, info
 
     @property
@@ -140,3 +428,31 @@ class TabularRewardWrapper(gym.Wrapper):
 
     def reset(self, **kwargs):
         return self.env.reset(**kwargs)
+
+
+class TabularVecRewardWrapper(VecEnvWrapper):
+    """Wrapper for a TabularMdpVecEnv replacing with a new reward matrix."""
+    def __init__(self, venv, new_reward):
+        self.new_reward = new_reward
+        super().__init__(venv)
+
+    def step_wait(self):
+        obs, old_rewards, dones, infos = self.venv.step_wait()
+        # obs of episodes that are done is the first state of the next episode
+        next_states = getattr_unwrapped(self.venv, 'next_states')
+        return obs, self.new_reward[next_states], dones, infos
+
+    @property
+    def reward(self):
+        return self.new_reward
+
+    def reset(self):
+        return self.venv.reset()
+
+
+def tabular_reward_wrapper(env, new_reward):
+    if hasattr(env, 'num_envs'):
+        cls = TabularVecRewardWrapper
+    else:
+        cls = TabularRewardWrapper
+    return cls(env, new_reward)
@@ -2,9 +2,12 @@ import logging.config
 import numpy as np
 
 from pirl.config import types
-from pirl.config.config import RL_ALGORITHMS, SINGLE_IRL_ALGORITHMS, \
-        POPULATION_IRL_ALGORITHMS, EXPERIMENTS, LOG_CFG, TENSORFLOW, \
-        RAY_SERVER, PROJECT_DIR, EXPERIMENTS_DIR, OBJECT_DIR, CACHE_DIR
+from pirl.config.config import RL_ALGORITHMS, \
+        INFINITE_HORIZON_RL_ALGORITHMS, SINGLE_IRL_ALGORITHMS, \
+        SINGLE_IRL_M_SWEEPS, POPULATION_IRL_ALGORITHMS, \
+        POPULATION_IRL_SWEEPS, EXPERIMENTS, \
+        LOG_CFG, TENSORFLOW, RAY_SERVER, PROJECT_DIR, EXPERIMENTS_DIR, \
+        OBJECT_DIR, CACHE_DIR
 
 types.validate_config(RL_ALGORITHMS,
                       SINGLE_IRL_ALGORITHMS,
@@ -12,5 +15,6 @@ types.validate_config(RL_ALGORITHMS,
 EXPERIMENTS = {k: types.parse_config(k, v,
                                      RL_ALGORITHMS,
                                      SINGLE_IRL_ALGORITHMS,
-                                     POPULATION_IRL_ALGORITHMS)
+                                     POPULATION_IRL_ALGORITHMS,
+                                     INFINITE_HORIZON_RL_ALGORITHMS)
                for k, v in EXPERIMENTS.items()}
\ No newline at end of file
@@ -1,3 +1,4 @@
+import collections
 import functools
 import itertools
 import os.path as osp
@@ -67,6 +68,23 @@ RL_ALGORITHMS = {
         vectorized=False,
         uses_gpu=False,
     ),
+    # See INFINITE_HORIZON_RL_ALGORITHMS
+    'policy_iteration': RLAlgorithm(
+        train=agents.tabular.policy_env_wrapper(agents.tabular.policy_iteration_policy),
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    'modified_policy_iteration': RLAlgorithm(
+        train=agents.tabular.policy_env_wrapper(
+            functools.partial(agents.tabular.policy_iteration_policy,
+                              num_eval_sweeps=10)),
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
     'max_ent': RLAlgorithm(
         train=agents.tabular.policy_env_wrapper(irl.tabular_maxent.max_ent_policy),
         sample=agents.tabular.sample,
@@ -83,7 +101,12 @@ RL_ALGORITHMS = {
     ),
 }
 
-def ppo_cts_pol(num_timesteps):
+# RL algorithms optimal over an infinite horizon, ignoring the episode length.
+# They require discount < 1: parse_config rejects experiments otherwise.
+INFINITE_HORIZON_RL_ALGORITHMS = set(['policy_iteration',
+                                      'modified_policy_iteration'])
+
+def ppo_cts_pol(num_timesteps, vectorized=True):
     train = functools.partial(agents.ppo.train_continuous,
                               tf_config=TENSORFLOW,
                               num_timesteps=num_timesteps)
@@ -92,9 +115,11 @@ def ppo_cts_pol(num_timesteps):
     return RLAlgorithm(train=train,
                        sample=sample,
                        value=value,
-                       vectorized=True,
+                       vectorized=vectorized,
                        uses_gpu=True)
 RL_ALGORITHMS['ppo_cts'] = ppo_cts_pol(1e6)
+# Simulates environments with a native VecEnv (e.g. MountainCar) if available
+RL_ALGORITHMS['ppo_cts_native'] = ppo_cts_pol(1e6, vectorized='native')
 RL_ALGORITHMS['ppo_cts_500k'] = ppo_cts_pol(5e5)
 RL_ALGORITHMS['ppo_cts_200k'] = ppo_cts_pol(2e5)
 RL_ALGORITHMS['ppo_cts_short'] = ppo_cts_pol(1e5)
@@ -108,7 +133,61 @@ SINGLE_IRL_ALGORITHMS = {
     # Maximum Causal Entropy (Ziebart 2010)
     'mce': IRLAlgorithm(
         train=irl.tabular_maxent.irl,
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    'mce_torch': IRLAlgorithm(
+        train=functools.partial(irl.tabular_maxent.irl, engine='torch'),
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    'mce_float32': IRLAlgorithm(
+        train=functools.partial(irl.tabular_maxent.irl, dtype='float32'),
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    'mce_lbfgs': IRLAlgorithm(
+        train=functools.partial(irl.tabular_maxent.irl,
+                                optimizer=irl.tabular_maxent.lbfgs_optimizer,
+                                num_iter=100),
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    # Stops once converged, rather than after a fixed number of iterations
+    'mce_grad_tol': IRLAlgorithm(
+        train=functools.partial(irl.tabular_maxent.irl, grad_tol=1e-3),
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    'mce_linear': IRLAlgorithm(
+        train=irl.tabular_maxent.linear_irl,
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    # Warm-started soft value iteration: biased for finite horizons,
+    # see SoftValueIteration. Same as 'mce' for discount = 1.
+    'mce_warm': IRLAlgorithm(
+        train=functools.partial(irl.tabular_maxent.irl,
+                                planner=irl.tabular_maxent.SoftValueIteration),
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
         sample=agents.tabular.sample,
         value=agents.tabular.value_in_mdp,
         vectorized=False,
@@ -116,7 +195,18 @@ SINGLE_IRL_ALGORITHMS = {
     ),
     'mce_shortest': IRLAlgorithm(
         train=functools.partial(irl.tabular_maxent.irl, num_iter=500),
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
+        sample=agents.tabular.sample,
+        value=agents.tabular.value_in_mdp,
+        vectorized=False,
+        uses_gpu=False,
+    ),
+    # Warm-starts from the reward learnt with fewer trajectories.
+    # See SINGLE_IRL_M_SWEEPS.
+    'mce_prefix_warm': IRLAlgorithm(
+        train=functools.partial(irl.tabular_maxent.prefix_irl,
+                                warm_start=True, grad_tol=1e-3),
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
         sample=agents.tabular.sample,
         value=agents.tabular.value_in_mdp,
         vectorized=False,
@@ -126,7 +216,7 @@ SINGLE_IRL_ALGORITHMS = {
     'me': IRLAlgorithm(
         train=functools.partial(irl.tabular_maxent.irl,
                                 planner=irl.tabular_maxent.max_ent_policy),
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
         sample=agents.tabular.sample,
         value=agents.tabular.value_in_mdp,
         vectorized=False,
@@ -164,27 +254,36 @@ AIRL_ITERATIONS = {None: 1000,
 airl_reward = functools.partial(irl.airl.airl_reward_wrapper, tf_cfg=TENSORFLOW)
 airl_sample = functools.partial(irl.airl.sample, tf_cfg=TENSORFLOW)
 airl_value = functools.partial(agents.sample.value, airl_sample)
-for k, kwargs in AIRL_ALGORITHMS.items():
-    for k2, v2 in AIRL_ITERATIONS.items():
-        name = 'airl_{}'.format(k)
-        if k2 is not None:
-            name = '{}_{}'.format(name, k2)
-
-        kwds = dict(kwargs)
-        if v2 is not None:
-            training_cfg = dict(kwds.get('training_cfg', dict()))
-            training_cfg['n_itr'] = v2
-            kwds['training_cfg'] = training_cfg
-
-        train = functools.partial(irl.airl.irl, tf_cfg=TENSORFLOW, **kwds)
-        SINGLE_IRL_ALGORITHMS[name] = IRLAlgorithm(
-            train=train,
-            reward_wrapper=airl_reward,
-            sample=airl_sample,
-            value=airl_value,
-            vectorized=True,
-            uses_gpu=True,
-        )
+# Suffix '_native' simulates environments with a native VecEnv if available
+for (k, kwargs), (k2, v2), native in itertools.product(
+        AIRL_ALGORITHMS.items(), AIRL_ITERATIONS.items(), [False, True]):
+    name = 'airl_{}'.format(k)
+    if k2 is not None:
+        name = '{}_{}'.format(name, k2)
+    if native:
+        name = '{}_native'.format(name)
+
+    kwds = dict(kwargs)
+    if v2 is not None:
+        training_cfg = dict(kwds.get('training_cfg', dict()))
+        training_cfg['n_itr'] = v2
+        kwds['training_cfg'] = training_cfg
+
+    train = functools.partial(irl.airl.irl, tf_cfg=TENSORFLOW, **kwds)
+    SINGLE_IRL_ALGORITHMS[name] = IRLAlgorithm(
+        train=train,
+        reward_wrapper=airl_reward,
+        sample=airl_sample,
+        value=airl_value,
+        vectorized='native' if native else True,
+        uses_gpu=True,
+    )
+
+# Single IRL algorithms whose train takes an additional argument ms, a list of
+# numbers of trajectories, learning from trajectories[:m] for each m in ms.
+# train returns a dict mapping each m to a (reward, policy) pair.
+# Experiments run these once per environment, rather than once per m.
+SINGLE_IRL_M_SWEEPS = set(['mce_prefix_warm'])
 
 gail_train = functools.partial(irl.gail.irl, tf_cfg=TENSORFLOW)
 gail_sample = functools.partial(irl.gail.sample, tf_cfg=TENSORFLOW)
@@ -207,18 +306,47 @@ def pop_maxent(**kwargs):
     return MetaIRLAlgorithm(
         metalearn=functools.partial(irl.tabular_maxent.metalearn, **kwargs),
         finetune=functools.partial(irl.tabular_maxent.finetune, **kwargs),
-        reward_wrapper=agents.tabular.TabularRewardWrapper,
+        reward_wrapper=agents.tabular.tabular_reward_wrapper,
         sample=agents.tabular.sample,
         value=agents.tabular.value_in_mdp,
         vectorized=False,
         uses_gpu=False,
     )
+mcep_regs = collections.OrderedDict()
 for reg in range(-4,3):
-    algo = pop_maxent(regularize=10**reg)
-    POPULATION_IRL_ALGORITHMS['mcep_reg1e{}'.format(reg)] = algo
-POPULATION_IRL_ALGORITHMS['mcep_reg0'] = pop_maxent(regularize=0)
+    mcep_regs['mcep_reg1e{}'.format(reg)] = 10**reg
+mcep_regs['mcep_reg0'] = 0
+for k, reg in mcep_regs.items():
+    POPULATION_IRL_ALGORITHMS[k] = pop_maxent(regularize=reg)
+# Finetunes with all regularization constants in one batched run.
+# Not intended to be used directly in experiments: see POPULATION_IRL_SWEEPS.
+POPULATION_IRL_ALGORITHMS['mcep_reg_sweep'] = pop_maxent(
+    regularize=list(mcep_regs.values()))
 POPULATION_IRL_ALGORITHMS['mcep_shortest_reg0'] = pop_maxent(regularize=0,
                                                              num_iter=500)
+for k, reg in mcep_regs.items():
+    k = k.replace('mcep_', 'mcep_lbfgs_')
+    POPULATION_IRL_ALGORITHMS[k] = pop_maxent(
+        regularize=reg, optimizer=irl.tabular_maxent.lbfgs_optimizer,
+        num_iter=100)
+# Reward linear in features, with parameters shared across training tasks
+for k, reg in mcep_regs.items():
+    k = k.replace('mcep_', 'mcep_linear_')
+    POPULATION_IRL_ALGORITHMS[k] = pop_maxent(regularize=reg, linear=True,
+                                              batched=True)
+POPULATION_IRL_ALGORITHMS['mcep_batched_reg0'] = pop_maxent(regularize=0,
+                                                            batched=True)
+POPULATION_IRL_ALGORITHMS['mcep_batched_shortest_reg0'] = pop_maxent(
+    regularize=0, batched=True, num_iter=500)
+
+# Maps a population IRL algorithm that returns a dict of results, to the
+# names of algorithms it computes results for and their key in the dict.
+# Experiments with 'batch_sweeps' set and several of these algorithms run the
+# sweep only once, passing the keys of the requested algorithms as regularize
+# to finetune.
+POPULATION_IRL_SWEEPS = {
+    'mcep_reg_sweep': mcep_regs,
+}
 
 AIRLP_ALGORITHMS = {
     # 3-tuple with elements:
@@ -287,7 +415,8 @@ def traditional_to_concat(singleirl):
                             uses_gpu=singleirl.uses_gpu)
 
 for name, algo in SINGLE_IRL_ALGORITHMS.items():
-    POPULATION_IRL_ALGORITHMS[name + 'c'] = traditional_to_concat(algo)
+    if name not in SINGLE_IRL_M_SWEEPS:
+        POPULATION_IRL_ALGORITHMS[name + 'c'] = traditional_to_concat(algo)
 
 # Experiments
 
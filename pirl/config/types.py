@@ -1,7 +1,7 @@
 from collections import namedtuple
 import sys
 
-import gym
+from pirl import envs
 
 # Algorithms
 RES_FLDS = ['sample', 'vectorized', 'uses_gpu']
@@ -12,6 +12,10 @@ to sample deterministically. It returns a list of 3-tuples
 (states, actions, rewards), each of which is a list.
 
 vectorized is a boolean flag indicating if the algorithm takes VecEnv's.
+It may also be 'native', in which case the VecEnv simulates all environments
+at once if the environment has a native implementation (see
+pirl.envs.vec_envs), falling back to DummyVecEnv otherwise. Results differ
+from DummyVecEnv for the same seed, so use a separate algorithm name.
 
 uses_gpu is a boolean flag indicating whether the algorithm requires a GPU.
 '''
@@ -107,6 +111,8 @@ FIELD_TYPES = {
     # Number of seeds to use
     'seeds': int,
     'parallel_rollouts': int,
+    # Run requested members of POPULATION_IRL_SWEEPS as one batched sweep
+    'batch_sweeps': bool,
 }
 
 MANDATORY_FIELDS = ['expert', 'irl', 'eval', 'test_trajectories']
@@ -117,14 +123,17 @@ OPTIONAL_FIELDS = {
     'train_trajectories': None,
     # note parallel_rollouts is ignored for non-vectorized (I)RL algorithms
     'parallel_rollouts': 4,
+    'batch_sweeps': False,
 }
 
 def parse_config(experiment, cfg,
-                 rl_algos, single_irl_algos, population_irl_algos):
+                 rl_algos, single_irl_algos, population_irl_algos,
+                 infinite_horizon_rl_algos=()):
     '''Returns a canonical configuration from user-specified configuration
        dictionary cfg. Fills in defaults from OPTIONAL_FIELDS, verifies all
        MANDATORY_FIELDS are present, type checks in FIELD_TYPES, and performs
-       some additional custom validation.'''
+       some additional custom validation. RL algorithms in
+       infinite_horizon_rl_algos require a discount less than 1.'''
     try:
         # Fill in defaults
         res = {}
@@ -149,7 +158,8 @@ def parse_config(experiment, cfg,
         # Check environments are registered
         for fld in ['train_environments', 'test_environments']:
             for env in res[fld]:
-                gym.envs.registry.spec(env)
+                if not envs.is_registered(env):
+                    raise ValueError("Unregistered environment '{}'".format(env))
 
         # Check RL & IRL algorithms are registered
         rl_algos[res['expert']]
@@ -158,6 +168,13 @@ def parse_config(experiment, cfg,
         for irl in res['irl']:
             assert (irl in population_irl_algos or irl in single_irl_algos)
 
+        # Expert and eval RL algorithms are trained with discount
+        for rl in [res['expert']] + res['eval']:
+            if rl in infinite_horizon_rl_algos and res['discount'] >= 1:
+                msg = ("RL algorithm '{}' is optimal over an infinite "
+                       "horizon, so requires discount < 1, not {}")
+                raise ValueError(msg.format(rl, res['discount']))
+
         # train_trajectories only makes sense with a meta-IRL algorithm
         meta_irl = any([irl in population_irl_algos for irl in res['irl']])
         assert ('train_trajectories' in res) == meta_irl
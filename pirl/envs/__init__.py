@@ -1,10 +1,50 @@
-import numpy as np
+import itertools
+
+from gym.envs import registry
 from gym.envs.registration import register
-from pirl.envs import gridworld
+import numpy as np
+
+# Native VecEnv implementations of registered environments: maps gym IDs to
+# the entry point of a VecEnv, with signature (env, num_envs, seed) where env
+# is made from the gym ID. Used by experiments.make_envs in place of
+# DummyVecEnv.
+vec_envs = {}
+
+def register_vec(id, entry_point):
+    vec_envs[id] = entry_point
+
+TABULAR_VEC_ENV = 'pirl.agents.tabular:TabularMdpVecEnv'
+MOUNTAIN_CAR_VEC_ENV = 'pirl.envs.mountain_car:ContinuousMountainCarPopulationVecEnv'
+
+### Families
+# Most environments come in large families, parameterized by their ID.
+# register_family registers every member with gym's register. This only
+# creates an EnvSpec: environment modules are imported, and environments
+# built, when an environment is made, through entry points.
+
+def register_family(pattern, register_fn, **choices):
+    """Registers each ID matching pattern.
+
+    Args:
+        - pattern(str): format string for the ID. Each field must be a
+            keyword argument in choices.
+        - register_fn(callable): called with the ID and, for each field,
+            the choice for it in the ID. It should register the ID.
+        - choices: for each field, a list of the values it may take.
+    """
+    fields = list(choices.keys())
+    for values in itertools.product(*choices.values()):
+        kwargs = dict(zip(fields, values))
+        register_fn(pattern.format(**kwargs), **kwargs)
+
+def is_registered(id):
+    """Whether id is registered with gym."""
+    return id in registry.env_specs
 
 ### Gridworlds
 
 ## Only intended for testing code, entirely unrealistic
+register_vec('pirl/GridWorld-Simple-v0', TABULAR_VEC_ENV)
 register(
     id='pirl/GridWorld-Simple-v0',
     entry_point='pirl.envs.gridworld:GridWorldMdpEnv.from_string',
@@ -19,6 +59,7 @@ register(
     },
 )
 
+register_vec('pirl/GridWorld-Simple-Deterministic-v0', TABULAR_VEC_ENV)
 register(
     id='pirl/GridWorld-Simple-Deterministic-v0',
     entry_point='pirl.envs.gridworld:GridWorldMdpEnv.from_string',
@@ -34,9 +75,7 @@ register(
 )
 
 ## Jungle
-# Key: A = initial state, X = wall, R = road, L = lava, S = soda, W = water
-# Rewards: default = -1, road = 0, lava = -10
-# Rewards: soda = 1 or 0, water = 1 or 0 (depending on agent preference)
+# See gridworld for the key to cells and rewards
 jungle_topology = {
     '9x9': [
         'AAAX  W  ',
@@ -56,124 +95,138 @@ jungle_topology = {
         'ARLS',
     ],
 }
-jungle_default_reward = -1
 jungle_topology = {k: np.array([list(x) for x in v])
                    for k, v in jungle_topology.items()}
-cfg = {'Soda': ['S'], 'Water': ['W'], 'Liquid': ['S', 'W']}
-for kind, cells in cfg.items():
-    reward_map = {'R': 0, 'L': -10}
-    for k in cells:
-        reward_map[k] = 1
-    fn = np.vectorize(lambda x: reward_map.get(x, jungle_default_reward))
-    for scale, topology in jungle_topology.items():
-        reward = fn(topology)
-        register(
-            id='pirl/GridWorld-Jungle-{}-{}-v0'.format(scale, kind),
-            entry_point='pirl.envs.gridworld:GridWorldMdpEnv',
-            max_episode_steps=100,
-            kwargs={
-                'walls': topology == 'X',
-                'reward': reward,
-                'initial_state': gridworld.create_initial_state(topology),
-                'terminal': np.zeros_like(topology, dtype=bool),
-                'noise': 0.2,
-            }
-        )
+jungle_kinds = ['Soda', 'Water', 'Liquid']
+
+# Built when the environment is made, not at registration.
+def _register_jungle(id, scale, kind):
+    register_vec(id, TABULAR_VEC_ENV)
+    register(
+        id=id,
+        entry_point='pirl.envs.gridworld:jungle',
+        max_episode_steps=100,
+        kwargs={
+            'topology': jungle_topology[scale],
+            'kind': kind,
+        }
+    )
+
+register_family('pirl/GridWorld-Jungle-{scale}-{kind}-v0', _register_jungle,
+                scale=list(jungle_topology.keys()), kind=jungle_kinds)
+
+# Procedurally generated, for scaling experiments.
+# Built when the environment is made, not at registration.
+def _register_procedural_jungle(id, shape, kind, seed):
+    size = int(shape.split('x')[0])
+    register_vec(id, TABULAR_VEC_ENV)
+    register(
+        id=id,
+        entry_point='pirl.envs.gridworld:procedural_jungle',
+        max_episode_steps=4 * size,
+        kwargs={
+            'size': size,
+            'kind': kind,
+            'seed': seed,
+        }
+    )
+
+jungle_sizes = [16, 32, 64, 128]
+register_family('pirl/GridWorld-Jungle-Procedural-{shape}-{kind}-seed{seed}-v0',
+                _register_procedural_jungle,
+                shape=['{0}x{0}'.format(size) for size in jungle_sizes],
+                kind=jungle_kinds, seed=range(5))
 
 ## MountainCar
-for num_peaks in [2, 3, 4]:
-    for vel_penalty in [0, 0.1, 0.5, 1]:
-        for initial_noise in [0.05, 0.1, 0.25]:
-            GOAL_POS = {'left': [0.01], 'right': [num_peaks - 1.01], 'random': None}
-            for side, pos in GOAL_POS.items():
-                register(
-                    id='pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
-                        num_peaks, side, vel_penalty, initial_noise),
-                    entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
-                    max_episode_steps=999,
-                    reward_threshold=90.0,
-                    kwargs={
-                        'num_peaks': num_peaks,
-                        'goal_reward': [100],
-                        'goal_position': pos,
-                        'vel_penalty': vel_penalty,
-                        'initial_noise': initial_noise
-                    },
-                )
-
-            TWO_FIXED_POS = {
-                'left-target': [100, -100],
-                'right-target': [-100, 100]
-            }
-            for side, reward in TWO_FIXED_POS.items():
-                register(
-                    id='pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
-                        num_peaks, side, vel_penalty, initial_noise),
-                    entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
-                    max_episode_steps=999,
-                    reward_threshold=90.0,
-                    kwargs={
-                        'num_peaks': num_peaks,
-                        'goal_reward': reward,
-                        'goal_position': [0.01, num_peaks - 1.01],
-                        'vel_penalty': vel_penalty,
-                        'initial_noise': initial_noise
-                    },
-                )
-
-            TWO_VARIABLE_POS = {'red': [100, -100], 'blue': [-100, 100]}
-            for good_goal, reward in TWO_VARIABLE_POS.items():
-                register(
-                    id='pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
-                        num_peaks, good_goal, vel_penalty, initial_noise),
-                    entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
-                    max_episode_steps=999,
-                    reward_threshold=90.0,
-                    kwargs={
-                        'num_peaks': num_peaks,
-                        'goal_reward': reward,
-                        'vel_penalty': vel_penalty,
-                        'initial_noise': initial_noise
-                    },
-                )
+def _register_mountain_car(id, num_peaks, goal, vel_penalty, initial_noise):
+    GOAL_POS = {'left': [0.01], 'right': [num_peaks - 1.01], 'random': None}
+    TWO_FIXED_POS = {
+        'left-target': [100, -100],
+        'right-target': [-100, 100]
+    }
+    TWO_VARIABLE_POS = {'red': [100, -100], 'blue': [-100, 100]}
+    kwargs = {
+        'num_peaks': num_peaks,
+        'vel_penalty': vel_penalty,
+        'initial_noise': initial_noise,
+    }
+    if goal in GOAL_POS:
+        kwargs['goal_reward'] = [100]
+        kwargs['goal_position'] = GOAL_POS[goal]
+    elif goal in TWO_FIXED_POS:
+        kwargs['goal_reward'] = TWO_FIXED_POS[goal]
+        kwargs['goal_position'] = [0.01, num_peaks - 1.01]
+    else:
+        kwargs['goal_reward'] = TWO_VARIABLE_POS[goal]
+    register_vec(id, MOUNTAIN_CAR_VEC_ENV)
+    register(
+        id=id,
+        entry_point='pirl.envs.mountain_car:ContinuousMountainCarPopulationEnv',
+        max_episode_steps=999,
+        reward_threshold=90.0,
+        kwargs=kwargs,
+    )
+
+register_family('pirl/MountainCarContinuous-{num_peaks}-{goal}-'
+                '{vel_penalty}-{initial_noise}-v0',
+                _register_mountain_car,
+                num_peaks=[2, 3, 4],
+                goal=['left', 'right', 'random', 'left-target',
+                      'right-target', 'red', 'blue'],
+                vel_penalty=[0, 0.1, 0.5, 1],
+                initial_noise=[0.05, 0.1, 0.25])
 
 ## Reacher
-for start_variance in [0.1, 0.5, 1.0]:
-    for seed in range(10):
-        register(
-            id='pirl/ReacherGoal-seed{}-{}-v0'.format(seed, start_variance),
-            entry_point='pirl.envs.reacher_goal:ReacherGoalEnv',
-            max_episode_steps=50,
-            kwargs={
-                'seed': seed,
-                'start_variance': start_variance * np.pi,
-                'goal_state_pos': 'fixed',
-                'goal_state_access': False,
-            }
-        )
-
-        for steps in [50, 100]:
-            register(
-                id='pirl/ReacherWall-seed{}-{}-{}-v0'.format(seed, steps, start_variance),
-                entry_point='pirl.envs.reacher_wall:ReacherWallEnv',
-                max_episode_steps=steps,
-                kwargs={
-                    'wall_penalty': 0.4*steps,
-                    'wall_seed': seed,
-                    'start_variance': start_variance * np.pi,
-                }
-            )
-
-    for steps in [50, 100]:
-        register(
-            id='pirl/ReacherWall-nowall-{}-{}-v0'.format(steps, start_variance),
-            entry_point='pirl.envs.reacher_wall:ReacherWallEnv',
-            max_episode_steps=steps,
-            kwargs={
-                'wall_seed': None,
-                'start_variance': start_variance * np.pi,
-            }
-        )
+reacher_start_variances = [0.1, 0.5, 1.0]
+
+def _register_reacher_goal(id, seed, start_variance):
+    register(
+        id=id,
+        entry_point='pirl.envs.reacher_goal:ReacherGoalEnv',
+        max_episode_steps=50,
+        kwargs={
+            'seed': seed,
+            'start_variance': start_variance * np.pi,
+            'goal_state_pos': 'fixed',
+            'goal_state_access': False,
+        }
+    )
+
+register_family('pirl/ReacherGoal-seed{seed}-{start_variance}-v0',
+                _register_reacher_goal,
+                seed=range(10), start_variance=reacher_start_variances)
+
+def _register_reacher_wall(id, seed, steps, start_variance):
+    register(
+        id=id,
+        entry_point='pirl.envs.reacher_wall:ReacherWallEnv',
+        max_episode_steps=steps,
+        kwargs={
+            'wall_penalty': 0.4*steps,
+            'wall_seed': seed,
+            'start_variance': start_variance * np.pi,
+        }
+    )
+
+register_family('pirl/ReacherWall-seed{seed}-{steps}-{start_variance}-v0',
+                _register_reacher_wall,
+                seed=range(10), steps=[50, 100],
+                start_variance=reacher_start_variances)
+
+def _register_reacher_nowall(id, steps, start_variance):
+    register(
+        id=id,
+        entry_point='pirl.envs.reacher_wall:ReacherWallEnv',
+        max_episode_steps=steps,
+        kwargs={
+            'wall_seed': None,
+            'start_variance': start_variance * np.pi,
+        }
+    )
+
+register_family('pirl/ReacherWall-nowall-{steps}-{start_variance}-v0',
+                _register_reacher_nowall,
+                steps=[50, 100], start_variance=reacher_start_variances)
 
 ## Billiards
 billiard_params = [
@@ -182,18 +235,21 @@ billiard_params = [
     (5, 2),
     (-10, 1)
 ]
-for seed in range(10):
-    for num_balls in range(1, len(billiard_params) + 1):
-        register(
-            id='pirl/Billiards{}-seed{}-v0'.format(num_balls, seed),
-            entry_point='pirl.envs.billiards:BilliardsEnv',
-            max_episode_steps=200,
-            kwargs={
-                'params': billiard_params,
-                'num_balls': num_balls,
-                'seed': seed,
-            },
-        )
+
+def _register_billiards(id, num_balls, seed):
+    register(
+        id=id,
+        entry_point='pirl.envs.billiards:BilliardsEnv',
+        max_episode_steps=200,
+        kwargs={
+            'params': billiard_params,
+            'num_balls': num_balls,
+            'seed': seed,
+        },
+    )
+
+register_family('pirl/Billiards{num_balls}-seed{seed}-v0', _register_billiards,
+                num_balls=range(1, len(billiard_params) + 1), seed=range(10))
 
 ## Seaquest
 register(
@@ -201,4 +257,4 @@ register(
     entry_point='pirl.envs.seaquest:SeaquestPopulationEnv',
     max_episode_steps=100000,
     kwargs={},
-)
\ No newline at end of file
+)
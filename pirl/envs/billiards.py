@@ -7,6 +7,8 @@ import numpy as np
 
 from airl.envs.dynamic_mjc.model_builder import MJCModel
 
+from pirl.utils import cached_model_file, rejection_sample
+
 def billiards_model(num_cats, particle_size, cmap_name='Set1'):
     model = MJCModel('billiards')
     root = model.root
@@ -65,6 +67,16 @@ def billiards_model(num_cats, particle_size, cmap_name='Set1'):
     return model
 
 
+def billiards_model_file(num_cats, particle_size):
+    """Path to an XML file for billiards_model, shared by all environments
+       with the same parameters."""
+    def make_xml():
+        model = billiards_model(num_cats, particle_size=particle_size)
+        with model.asfile() as f:
+            return f.read()
+    return cached_model_file(('billiards', num_cats, particle_size), make_xml)
+
+
 def create_reward(params, rng):
     params = np.array(params)
     means = params[:, 0]
@@ -74,18 +86,18 @@ def create_reward(params, rng):
 
 def random_pos(n, gap, rng):
     '''Sample n points from [0,1]x[0,1] where all points are at least
-       gap l_2 norm apart and gap/2 away from the end points.'''
+       gap l_2 norm apart and gap/2 away from the end points.
+       Returns an n*2 array. Candidates are drawn from rng in batches, so
+       this consumes rng differently to drawing them one at a time.'''
     # Brute force solution. Could also sample from a grid, but less continuous.
-    points = []
+    points = np.zeros((n, 2))
+    def sample(k):
+        return rng.rand(k, 2) * (1 - gap) + gap / 2
     for i in range(n):
-        ok = False
-        while not ok:
-            p = rng.rand(2) * (1 - gap) + gap / 2
-            ok = True
-            for x in points:
-                if np.linalg.norm(p - x) < gap:
-                    ok = False
-        points.append(p)
+        def accept(candidates):
+            delta = candidates.reshape(-1, 1, 2) - points[:i].reshape(1, -1, 2)
+            return np.all(np.linalg.norm(delta, axis=2) >= gap, axis=1)
+        points[i] = rejection_sample(sample, accept, batch_size=16)
     return points
 
 
@@ -104,10 +116,9 @@ class BilliardsEnv(MujocoEnv, utils.EzPickle):
 
         num_cats = len(self.rewards)
         assert num_cats >= num_balls
-        model = billiards_model(num_cats, particle_size=particle_size)
-        with model.asfile() as f:
-            MujocoEnv.__init__(self, f.name, 5)
-            utils.EzPickle.__init__(self, params, num_balls, particle_size, seed)
+        model_path = billiards_model_file(num_cats, particle_size)
+        MujocoEnv.__init__(self, model_path, 5)
+        utils.EzPickle.__init__(self, params, num_balls, particle_size, seed)
 
     def step(self, a):
         done = False
@@ -157,7 +168,6 @@ class BilliardsEnv(MujocoEnv, utils.EzPickle):
         # has some numerical error in contact detection.
         gap = self.particle_size * 2.1
         active_pos = random_pos(self.num_targets + 1, gap, self.np_random)
-        active_pos = np.array(active_pos)
 
         qpos = np.zeros((num_cats + 1, 2))
         # inactive target balls, space them out to avoid contact forces
@@ -5,40 +5,55 @@ import numpy as np
 from gym import utils
 from PIL import Image, ImageFont, ImageDraw
 
-from pirl.envs.tabular_mdp import TabularMdpEnv
+from pirl.envs.tabular_mdp import SparseTransition, TabularMdpEnv
 
-def _create_transition(walls, noise):
+def _create_transition(walls, noise, sparse=False):
     width, height = walls.shape
     walls = walls.flatten()
 
     nS = walls.shape[0]
     nA = len(Direction.ALL_DIRECTIONS)
-    transition = np.zeros((nS, nA, nS))
-
-    def move(start, dir):
-        oldx, oldy = start % width, start // width
-        newx, newy = Direction.move_in_direction((oldx, oldy), dir)
-        newx = max(0, min(newx, width - 1))
-        newy = max(0, min(newy, height - 1))
+    states = np.arange(nS)
+
+    def move(dir):
+        """Next state for every state, moving in directions dir (nA*2)."""
+        dx, dy = dir[:, 0].reshape(1, -1), dir[:, 1].reshape(1, -1)
+        x, y = (states % width).reshape(-1, 1), (states // width).reshape(-1, 1)
+        newx = np.clip(x + dx, 0, width - 1)
+        newy = np.clip(y + dy, 0, height - 1)
         idx = newy * width + newx
-        return start if walls[idx] else idx
-
-    for idx, wall in enumerate(walls):
-        for a, dir in enumerate(Direction.ALL_DIRECTIONS):
-            if wall:  # wall
-                # Can never get into a wall, but TabularMdpEnv
-                # insists transition be a probability distribution,
-                # so make it an absorbing state.
-                transition[idx, a, idx] = 1
-            else:  # unobstructed space
-                if dir == Direction.STAY:
-                    transition[idx, a, idx] = 1
-                else:
-                    transition[idx, a, move(idx, dir)] = 1 - noise
-                    for noise_dir in Direction.get_adjacent_directions(dir):
-                        transition[idx, a, move(idx, noise_dir)] += noise / 2
-
-    return transition
+        return np.where(walls[idx], states.reshape(-1, 1), idx)
+
+    # Each action moves in the intended direction with probability 1 - noise,
+    # and in each adjacent direction with probability noise / 2.
+    # STAY always succeeds, and walls are absorbing: TabularMdpEnv insists
+    # transition be a probability distribution, although they can never be
+    # entered.
+    intended = np.array(Direction.ALL_DIRECTIONS)
+    adjacent = [Direction.get_adjacent_directions(dir)
+                if dir != Direction.STAY else [dir, dir]
+                for dir in Direction.ALL_DIRECTIONS]
+    adjacent = np.array(adjacent)
+    next_states = np.stack([move(intended), move(adjacent[:, 0]),
+                            move(adjacent[:, 1])], axis=2)
+    probs = np.array([1 - noise, noise / 2, noise / 2])
+    probs = np.tile(probs, (nS, nA, 1))
+    stays = walls.reshape(-1, 1) | (intended == Direction.STAY).all(1)
+    next_states[stays] = np.nonzero(stays)[0].reshape(-1, 1)
+    probs[stays] = [1, 0, 0]
+
+    states = np.broadcast_to(states.reshape(-1, 1, 1), next_states.shape)
+    actions = np.broadcast_to(np.arange(nA).reshape(1, -1, 1),
+                              next_states.shape)
+    states, actions, next_states, probs = [x.ravel() for x in
+                                           [states, actions, next_states, probs]]
+    if sparse:
+        return SparseTransition.from_coo((nS, nA, nS), states, actions,
+                                         next_states, probs)
+    else:
+        transition = np.zeros((nS, nA, nS))
+        np.add.at(transition, (states, actions, next_states), probs)
+        return transition
 
 def _create_reward(grid, default_reward):
     def convert(cfg):
@@ -49,12 +64,110 @@ def _create_reward(grid, default_reward):
     rewards = [[convert(cfg) for cfg in row] for row in grid]
     return np.array(rewards)
 
+def cell_type_features(grid, cell_types):
+    """One-hot encoding of the type of each cell in grid.
+
+    Args:
+        - grid(N*M array): character describing each cell.
+        - cell_types(list): characters, one for each feature. Every cell in
+            grid must be one of these.
+
+    Returns an (N*M)*d array, where d = len(cell_types).
+    """
+    grid = np.array(grid).flatten()
+    features = grid.reshape(-1, 1) == np.array(cell_types).reshape(1, -1)
+    assert np.all(features.sum(1) == 1), 'unknown cell type'
+    return features.astype(float)
+
 def create_initial_state(grid):
     cfg = np.array(grid, dtype='object')
     initial_state = cfg == 'A'
     return initial_state / initial_state.sum()
 
 
+## Jungle
+# Key: A = initial state, X = wall, R = road, L = lava, S = soda, W = water
+# Rewards: default = -1, road = 0, lava = -10
+# Rewards: soda = 1 or 0, water = 1 or 0 (depending on agent preference)
+jungle_default_reward = -1
+jungle_cell_types = ['A', ' ', 'X', 'R', 'L', 'S', 'W']
+jungle_preferences = {'Soda': ['S'], 'Water': ['W'], 'Liquid': ['S', 'W']}
+
+def jungle_reward(topology, kind):
+    """Reward of each cell in a Jungle topology (N*M character array),
+       for an agent with preference kind (a key of jungle_preferences)."""
+    reward_map = {'R': 0, 'L': -10}
+    for k in jungle_preferences[kind]:
+        reward_map[k] = 1
+    fn = np.vectorize(lambda x: reward_map.get(x, jungle_default_reward))
+    return fn(topology)
+
+def random_jungle_topology(size, seed, wall_density=0.1, lava_density=0.05,
+                           goal_density=0.02, road_density=0.1,
+                           num_initial=4):
+    """Procedurally generate a size*size Jungle topology.
+
+    Roads run the full width or height of the grid, every 1 / road_density
+    cells on average. Walls, lava, soda and water are scattered uniformly at
+    random off the roads, soda and water each with density goal_density.
+    Initial states are num_initial random road cells.
+
+    Returns a size*size character array, deterministic given seed.
+    """
+    rng = np.random.RandomState(seed)
+    topology = np.full((size, size), ' ', dtype='U1')
+
+    num_roads = max(1, int(round(road_density * size)))
+    for axis in rng.randint(2, size=num_roads):
+        pos = rng.randint(size)
+        if axis == 0:
+            topology[pos, :] = 'R'
+        else:
+            topology[:, pos] = 'R'
+
+    off_road = np.flatnonzero(topology.ravel() != 'R')
+    densities = [('X', wall_density), ('L', lava_density),
+                 ('S', goal_density), ('W', goal_density)]
+    counts = [int(round(d * size * size)) for _, d in densities]
+    counts = np.minimum(counts, len(off_road))
+    cells = rng.permutation(off_road)
+    offset = 0
+    for (cell_type, _), count in zip(densities, counts):
+        topology.ravel()[cells[offset:offset + count]] = cell_type
+        offset += count
+
+    roads = np.flatnonzero(topology.ravel() == 'R')
+    initial = rng.choice(roads, size=min(num_initial, len(roads)),
+                         replace=False)
+    topology.ravel()[initial] = 'A'
+
+    return topology
+
+def jungle(topology, kind, noise=0.2):
+    """Jungle gridworld with the given topology, a character matrix."""
+    return GridWorldMdpEnv(walls=topology == 'X',
+                           reward=jungle_reward(topology, kind),
+                           initial_state=create_initial_state(topology),
+                           terminal=np.zeros_like(topology, dtype=bool),
+                           noise=noise,
+                           features=cell_type_features(topology,
+                                                       jungle_cell_types))
+
+def procedural_jungle(size, kind, seed, noise=0.2, **kwargs):
+    """Jungle gridworld with a topology from random_jungle_topology.
+       kwargs are passed to random_jungle_topology. Uses a sparse transition
+       matrix."""
+    topology = random_jungle_topology(size, seed, **kwargs)
+    return GridWorldMdpEnv(walls=topology == 'X',
+                           reward=jungle_reward(topology, kind),
+                           initial_state=create_initial_state(topology),
+                           terminal=np.zeros_like(topology, dtype=bool),
+                           noise=noise,
+                           sparse=True,
+                           features=cell_type_features(topology,
+                                                       jungle_cell_types))
+
+
 class GridWorldMdpEnv(TabularMdpEnv):
     """A grid world where the objective is to navigate to one of many rewards.
 
@@ -74,7 +187,8 @@ class GridWorldMdpEnv(TabularMdpEnv):
         'video.frames_per_second' : 10
     }
 
-    def __init__(self, walls, reward, initial_state, terminal, noise=0.2):
+    def __init__(self, walls, reward, initial_state, terminal, noise=0.2,
+                 sparse=False, features=None):
         """Create an N*M grid world of the specified structure.
 
         Args:
@@ -83,6 +197,10 @@ class GridWorldMdpEnv(TabularMdpEnv):
             - initial_state(N*M float matrix): probability distribution.
             - terminal(N*M bool matrix): does entering cell end episode?
             - noise(float): probability intended action does not take place.
+            - sparse(bool): if True, transition is a SparseTransition rather
+                than a dense array. Recommended for large grids.
+            - features((N*M)*d float matrix): optional, features of each cell,
+                e.g. from cell_type_features.
         """
         # Check dimensions
         assert walls.shape == reward.shape
@@ -90,14 +208,15 @@ class GridWorldMdpEnv(TabularMdpEnv):
 
         # Setup state
         self._walls = walls  # used only for rendering
-        transition = _create_transition(walls, noise)
+        transition = _create_transition(walls, noise, sparse)
         reward = reward.flatten()
         initial_state = initial_state.flatten()
         terminal = terminal.flatten()
-        super().__init__(transition, reward, initial_state, terminal)
+        super().__init__(transition, reward, initial_state, terminal,
+                         features)
 
     @staticmethod
-    def from_string(grid, noise=0.2, default_reward=0.0):
+    def from_string(grid, noise=0.2, default_reward=0.0, sparse=False):
         """Create an N*M grid world from an N-length array of M-length arrays
            of characters or floats (M-length string also permissible).
 
@@ -113,7 +232,8 @@ class GridWorldMdpEnv(TabularMdpEnv):
         reward = _create_reward(grid, default_reward)
         initial_state = create_initial_state(grid)
         terminal = np.zeros_like(walls, dtype=bool)
-        return GridWorldMdpEnv(walls, reward, initial_state, terminal, noise)
+        return GridWorldMdpEnv(walls, reward, initial_state, terminal, noise,
+                               sparse)
 
     def render(self, mode='human'):
         #TODO: PNG/X11 rendering?
@@ -2,11 +2,15 @@
 """Population version of ContinuousMountainCar-v0 from Gym."""
 
 import math
+
+from baselines.common.vec_env import VecEnv
 import gym
 import gym.spaces as spaces
 from gym.utils import seeding
 import numpy as np
 
+from pirl.utils import getattr_unwrapped
+
 # Variables you can vary, both between and within an environment:
 # * Number of peaks. Think this should always be fixed for an instance.
 # * Number of flags. Also fixed for an instance (modifies the state.)
@@ -205,3 +209,112 @@ class ContinuousMountainCarPopulationEnv(gym.Env):
 
     def close(self):
         if self.viewer: self.viewer.close()
+
+
+class ContinuousMountainCarPopulationVecEnv(VecEnv):
+    """Vectorized version of ContinuousMountainCarPopulationEnv, simulating
+       num_envs cars with array operations. Episodes are reset automatically
+       when a car reaches a goal or _max_episode_steps elapse."""
+    def __init__(self, env, num_envs, seed=None):
+        """
+        Args:
+            env (gym.Env): a (possibly wrapped)
+                ContinuousMountainCarPopulationEnv, from which parameters
+                and TimeLimit are read. env itself is neither stepped nor
+                closed: it remains owned by the caller.
+            num_envs (int): number of cars.
+            seed (int): seed for the random number generator.
+        """
+        try:
+            self._max_episode_steps = getattr_unwrapped(env,
+                                                        '_max_episode_steps')
+        except AttributeError:
+            self._max_episode_steps = None
+        params = env.unwrapped
+        for k in ['num_peaks', 'min_position', 'max_position', 'max_speed',
+                  'power', 'goal_reward', 'static_goal_position',
+                  'vel_penalty', 'initial_noise']:
+            setattr(self, k, getattr(params, k))
+        super().__init__(num_envs, env.observation_space, env.action_space)
+
+        num_goals = len(self.goal_reward)
+        self.position = np.zeros(num_envs)
+        self.velocity = np.zeros(num_envs)
+        self.goal_position = np.zeros((num_envs, num_goals))
+        self._elapsed = np.zeros(num_envs, dtype=int)
+        self._actions = None
+
+        self.seed(seed)
+        self.reset()
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def _reset(self, mask):
+        n = np.count_nonzero(mask)
+        trough = self.np_random.randint(0, self.num_peaks - 1, size=n)
+        noise = self.np_random.uniform(low=-1, high=1, size=n)
+        self.position[mask] = trough + 0.5 + noise * self.initial_noise
+        self.velocity[mask] = 0
+        self._elapsed[mask] = 0
+        if self.static_goal_position is not None:
+            self.goal_position[mask] = self.static_goal_position
+        else:
+            # Random ordering of goals at either end, as in the scalar env
+            ends = np.array([self.min_position + 0.01,
+                             self.max_position - 0.01])
+            flip = self.np_random.randint(2, size=n).reshape(-1, 1)
+            num_goals = self.goal_position.shape[1]
+            order = np.arange(num_goals).reshape(1, -1)
+            self.goal_position[mask] = ends[order ^ flip]
+
+    def _obs(self):
+        obs = np.stack([self.position, self.velocity], axis=1)
+        if self.static_goal_position is None:
+            obs = np.concatenate((obs, self.goal_position), axis=1)
+        return obs
+
+    def reset(self):
+        self._reset(np.ones(self.num_envs, dtype=bool))
+        return self._obs()
+
+    def step_async(self, actions):
+        self._actions = np.asarray(actions).reshape(self.num_envs, -1)[:, 0]
+
+    def step_wait(self):
+        action = self._actions
+        force = np.clip(action, -1.0, 1.0)
+
+        old_position = self.position
+        # See ContinuousMountainCarPopulationEnv.step
+        gravity = -np.sin(2 * np.pi * old_position)
+        velocity = self.velocity + force * self.power - 0.0028 * gravity
+        velocity = np.clip(velocity, -self.max_speed, self.max_speed)
+        position = np.clip(old_position + velocity,
+                           self.min_position, self.max_position)
+        at_min = (position == self.min_position) & (velocity < 0)
+        at_max = (position == self.max_position) & (velocity > 0)
+        velocity[at_min | at_max] = 0
+
+        left_before = old_position.reshape(-1, 1) <= self.goal_position
+        left_after = position.reshape(-1, 1) <= self.goal_position
+        switched_side = left_before ^ left_after
+        dones = np.any(switched_side, axis=1)
+        goal_reward = np.sum(switched_side * self.goal_reward, axis=1)
+        vel_cost = self.vel_penalty * np.abs(velocity) / self.max_speed
+        rewards = np.where(dones, goal_reward - 100.0 * vel_cost, 0)
+        rewards -= np.square(action) * 0.1
+
+        self.position = position
+        self.velocity = velocity
+        self._elapsed += 1
+        if self._max_episode_steps is not None:
+            dones |= self._elapsed >= self._max_episode_steps
+        if np.any(dones):
+            self._reset(dones)
+        infos = [{} for _i in range(self.num_envs)]
+        return self._obs(), rewards, dones, infos
+
+    def close(self):
+        pass  # env is owned by the caller
@@ -1,4 +1,3 @@
-import tempfile
 import os.path
 
 import numpy as np
@@ -6,6 +5,35 @@ from gym import utils
 from gym.utils import seeding
 from gym.envs.mujoco import mujoco_env
 
+from pirl.utils import cached_model_file, rejection_sample
+
+def accept_goal(goal, wall_angle):
+    """Mask of goals, an n*2 array, within the arm's reach and more than
+       0.25 radians from the wall."""
+    within_armspan = np.linalg.norm(goal, axis=1) < .2
+    goal_angle = np.arctan2(goal[:, 1], goal[:, 0])
+    outside_wall = np.abs(goal_angle - wall_angle) > 0.25
+    return within_armspan & outside_wall
+
+
+def accept_arm(arm_pos, wall_angle):
+    """Mask of arm positions, an n*2 array of joint angles, where neither
+       the arm nor the fingertip is within 0.05 radians of the wall, and
+       the arm does not cross it."""
+    arm_delta = arm_pos[:, 0] - wall_angle
+
+    arm_theta = np.cumsum(arm_pos, axis=1)
+    finger_x = np.sum(np.cos(arm_theta), axis=1)
+    finger_y = np.sum(np.sin(arm_theta), axis=1)
+    finger_angle = np.arctan2(finger_y, finger_x)
+    finger_delta = finger_angle - wall_angle
+
+    arm_outside = np.abs(arm_delta) > 0.05
+    finger_outside = np.abs(finger_delta) > 0.05
+    intersects = np.sign(arm_delta) * np.sign(finger_delta) == -1
+    return arm_outside & finger_outside & ~intersects
+
+
 class ReacherWallEnv(mujoco_env.MujocoEnv, utils.EzPickle):
     def __init__(self, start_variance=0.1, wall_seed=0,
                  wall_penalty=5, wall_state_access=False):
@@ -25,17 +53,19 @@ class ReacherWallEnv(mujoco_env.MujocoEnv, utils.EzPickle):
             self._wall_penalty = 0
             params = {'XS': -1, 'YS': -1, 'XE': -0.99, 'YE': -0.99}
 
-        model_path = os.path.join(os.path.dirname(__file__), 'reacher_wall.xml')
-        with open(model_path, 'r') as model:
-            model_xml = model.read()
-            for k, v in params.items():
-                model_xml = model_xml.replace(k, str(v))
+        def make_xml():
+            model_path = os.path.join(os.path.dirname(__file__),
+                                      'reacher_wall.xml')
+            with open(model_path, 'r') as model:
+                model_xml = model.read()
+                for k, v in params.items():
+                    model_xml = model_xml.replace(k, str(v))
+            return model_xml
+        key = ('reacher_wall', ) + tuple(sorted(params.items()))
+        model_path = cached_model_file(key, make_xml)
 
         utils.EzPickle.__init__(self)
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.xml') as f:
-            f.write(model_xml)
-            f.flush()
-            mujoco_env.MujocoEnv.__init__(self, f.name, 2)
+        mujoco_env.MujocoEnv.__init__(self, model_path, 2)
 
     def step(self, a):
         self.do_simulation(a, self.frame_skip)
@@ -60,33 +90,24 @@ class ReacherWallEnv(mujoco_env.MujocoEnv, utils.EzPickle):
     def reset_model(self):
         # Randomly choose goal in circle radius 0.2, excluding the sector
         # 0.25 radians away from the wall.
-        while True:
-            self.goal = self.np_random.uniform(low=-.2, high=.2, size=2)
-            within_armspan = np.linalg.norm(self.goal) < .2
-            goal_angle = np.arctan2(self.goal[1], self.goal[0])
-            outside_wall = np.abs(goal_angle - self._wall_angle) > 0.25
-            if within_armspan and outside_wall:
-                break
+        # Candidates are drawn in batches, which consumes np_random
+        # differently to drawing them one at a time: resets for a given
+        # seed differ from those before batching.
+        def sample_goal(n):
+            return self.np_random.uniform(low=-.2, high=.2, size=(n, 2))
+        def accept(goal):
+            return accept_goal(goal, self._wall_angle)
+        self.goal = rejection_sample(sample_goal, accept, batch_size=8)
 
         # Randomly choose arm position, excluding sector 0.05 radians
         # around the wall.
-        while True:
+        def sample_arm(n):
             sv = self._start_variance
-            arm_pos_rnd = self.np_random.uniform(low=-sv, high=sv, size=2)
-            arm_pos = self.init_qpos[:-2] + arm_pos_rnd
-            arm_delta = arm_pos[0] - self._wall_angle
-
-            arm_theta = np.cumsum(arm_pos)
-            finger_xpos = np.sum([np.cos(arm_theta), np.sin(arm_theta)], axis=1)
-            finger_angle = np.arctan2(finger_xpos[1], finger_xpos[0])
-            finger_delta = finger_angle - self._wall_angle
-
-            arm_outside = np.abs(arm_delta) > 0.05
-            finger_outside = np.abs(finger_delta) > 0.05
-            intersects = np.sign([arm_delta, finger_delta]).prod() == -1
-
-            if arm_outside and finger_outside and not intersects:
-                break
+            arm_pos_rnd = self.np_random.uniform(low=-sv, high=sv, size=(n, 2))
+            return self.init_qpos[:-2] + arm_pos_rnd
+        def accept(arm_pos):
+            return accept_arm(arm_pos, self._wall_angle)
+        arm_pos = rejection_sample(sample_arm, accept, batch_size=8)
         arm_vel_rnd = self.np_random.uniform(low=-.005, high=.005, size=2)
         arm_vel = self.init_qvel[:-2] + arm_vel_rnd
 
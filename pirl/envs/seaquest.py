@@ -1,3 +1,5 @@
+import collections
+
 from gym import Env, spaces
 from gym.envs import atari
 import pandas as pd
@@ -7,28 +9,49 @@ import time
 OXYGEN_LOCATION = 102
 DIVERS_LOCATION = 62
 
-def identity_reward(ram, reward, image, action, state):
+def identity_reward(ram, reward, image, action, lives, state):
     return reward
+# Reward functions that do not use image are passed image=None, and the
+# environment does not render frames for them.
+identity_reward.uses_image = False
+
+SUB_COLOR = (170, 170, 170)
+
+def _pack_rgb(image):
+    """Packs each RGB pixel of an H*W*3 uint8 image into one uint32."""
+    image = np.asarray(image, dtype=np.uint32)
+    return (image[..., 0] << 16) | (image[..., 1] << 8) | image[..., 2]
+
+SUB_COLOR_PACKED = int(_pack_rgb(np.array(SUB_COLOR)))
+
+# Counts for the most recent images, which are compared to several times
+_submarine_counts = collections.deque(maxlen=2)
+
+def submarine_count(image):
+    """Number of submarines in image: each submarine has 45 pixels of
+       SUB_COLOR. Cached for the two most recent images, by identity: image
+       must not be modified after it is counted, so renderers that reuse
+       their output buffer give stale counts. SeaquestPopulationEnv renders
+       a new array each step."""
+    for cached_image, count in _submarine_counts:
+        if cached_image is image:
+            return count
+    pixels = np.count_nonzero(_pack_rgb(image) == SUB_COLOR_PACKED)
+    count = pixels // 45
+    _submarine_counts.append((image, count))
+    return count
 
 def submarine_killed(prev_image, image):
     # We determine whether a submarine has been killed, based on whether 45 pixels of the submarine color disappeared in the last two frames
-    SUB_COLOR = (170, 170, 170)
-
-    prev_values, prev_counts = np.unique(prev_image.reshape([-1, 3]), return_counts=True, axis=0)
-    previous_submarine_count = prev_counts[np.where(np.all(prev_values == SUB_COLOR, axis=1))[0]] // 45
-
-    values, counts = np.unique(image.reshape([-1, 3]), return_counts=True, axis=0)
-    current_submarine_count = counts[np.where(np.all(values == SUB_COLOR, axis=1))[0]] // 45
-
-    # Method above returns an empty array if we found no submarines, so make sure to only unpack array if it has content
-    previous_submarine_count = 0 if len(previous_submarine_count) < 1 else previous_submarine_count[0]
-    current_submarine_count = 0 if len(current_submarine_count) < 1 else current_submarine_count[0]
+    return submarine_count(prev_image) == submarine_count(image) + 1
 
-    return (previous_submarine_count == (current_submarine_count + 1))
-
-def fancy_reward_HoF(oxygen_fn=None, diver_reward=100, shark_reward=5, submarine_reward=10, action_fn=None, death_reward=(-20)):
+def fancy_reward_HoF(oxygen_fn=None, diver_reward=100, shark_reward=5, submarine_reward=10, action_fn=None, death_reward=(-20), use_image=True):
     '''
     Higher-order-function that generates a reward function for the Seaquest population variant
+
+    If use_image is False, the reward depends only on the RAM, so frames need
+    not be rendered; but submarines cannot then be told apart from sharks,
+    so all kills earn shark_reward.
     '''
     if (oxygen_fn == None):
         # oxygen_fn = lambda ox: 0
@@ -52,17 +75,20 @@ def fancy_reward_HoF(oxygen_fn=None, diver_reward=100, shark_reward=5, submarine
         if (rescued_diver):
             new_reward += diver_reward
 
-        if (reward > 0 and submarine_killed(state['prev_image'], image)):
+        killed_submarine = (use_image and reward > 0 and
+                            submarine_killed(state['prev_image'], image))
+        if (killed_submarine):
             new_reward += submarine_reward
 
         surfaced_with_divers = oxygen > prev_oxygen and divers < prev_divers and lives == prev_lives
-        if (reward > 0 and not submarine_killed(state['prev_image'], image) and not surfaced_with_divers):
+        if (reward > 0 and not killed_submarine and not surfaced_with_divers):
             new_reward += shark_reward
 
         if (lives < prev_lives):
             new_reward += death_reward
 
         return new_reward
+    reward_function.uses_image = use_image
     return reward_function
 
 AtariEnv = atari.AtariEnv
@@ -78,14 +104,20 @@ class SeaquestPopulationEnv(AtariEnv):
         """
         super().__init__(game='seaquest', obs_type=obs_type, frameskip=2)
         self._reward_fn = reward_fn
-        self._image = super().render(mode='rgb_array')
+        self._uses_image = getattr(reward_fn, 'uses_image', True)
+        self._image = self._render_image()
         self._lives = 0
         self._ram = super()._get_ram()
         self._odd_frame = False
 
+    def _render_image(self):
+        if self._uses_image:
+            return super().render(mode='rgb_array')
+        return None
+
     def step(self, action):
         ob, reward, game_over, info = super().step(action)
-        image = super().render(mode='rgb_array')
+        image = self._render_image()
         ram = super()._get_ram()
         lives = info['ale.lives']
         reward = self._reward_fn(ram, reward, image, action, lives, {'prev_ram': self._ram, 'prev_image': self._image, 'prev_lives': self._lives})
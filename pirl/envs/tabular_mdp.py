@@ -3,35 +3,335 @@ import gym.spaces as spaces
 from gym.utils import seeding
 
 import numpy as np
+import scipy.sparse
 
-from pirl.utils import discrete_sample
+from pirl.utils import cumulative_table, table_sample
 
 def _check_probability(x, axis, tol=1e-6):
     assert np.all(x >= 0)
     assert np.all(abs(x.sum(axis) - 1) < tol)
 
+class SparseTransition(object):
+    """Sparse S*A*S transition tensor, stored as padded successor lists.
+
+    For each state-action pair (s, a), successors[s, a, :] lists the states
+    reachable from (s, a) in ascending order, and probs[s, a, :] their
+    probability. Rows with fewer than K successors are padded with entries of
+    probability zero. This is efficient when every state-action pair has at
+    most K << S successors, e.g. gridworlds where K <= 3.
+
+    successors and probs are usually NumPy arrays, but may also be torch
+    tensors; expectation, propagate and log_probs support both.
+    """
+    def __init__(self, successors, probs, nS=None):
+        """
+        Args:
+            successors (S*A*K int array): successor states for each (s, a).
+            probs (S*A*K array): probability of each successor.
+            nS (int): number of states; inferred from successors if None.
+        """
+        self.successors = successors
+        self.probs = probs
+        assert successors.shape == probs.shape
+        if nS is None:
+            nS = successors.shape[0]
+        self._nS = nS
+
+    @staticmethod
+    def from_coo(shape, states, actions, next_states, probs):
+        """Create from a list of (state, action, next state, probability)
+           entries, in COO format. Duplicate entries are summed."""
+        nS, nA, _ = shape
+        rows = np.asarray(states) * nA + np.asarray(actions)
+        keys = rows * nS + np.asarray(next_states)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        probs = np.bincount(inverse, weights=probs)
+        nonzero = probs > 0
+        keys = keys[nonzero]
+        probs = probs[nonzero]
+        rows, cols = keys // nS, keys % nS
+
+        # Position of each entry within its row; unique() sorts keys, so
+        # entries are grouped by row with successors in ascending order.
+        counts = np.bincount(rows, minlength=nS * nA)
+        assert np.all(counts > 0), 'every (s, a) must have a successor'
+        starts = np.cumsum(counts) - counts
+        pos = np.arange(len(keys)) - starts[rows]
+
+        # Pad with the first successor, so padding always indexes a valid state
+        K = counts.max()
+        successors = np.repeat(cols[starts].reshape(-1, 1), K, axis=1)
+        successors[rows, pos] = cols
+        padded_probs = np.zeros((nS * nA, K))
+        padded_probs[rows, pos] = probs
+
+        return SparseTransition(successors.reshape(nS, nA, K),
+                                padded_probs.reshape(nS, nA, K), nS)
+
+    @staticmethod
+    def from_dense(transition):
+        """Create from a dense S*A*S transition tensor."""
+        transition = np.asarray(transition)
+        states, actions, next_states = np.nonzero(transition)
+        probs = transition[states, actions, next_states]
+        return SparseTransition.from_coo(transition.shape, states, actions,
+                                         next_states, probs)
+
+    def todense(self):
+        nS, nA, K = self.successors.shape
+        transition = np.zeros((nS, nA, self._nS))
+        states = np.arange(nS).reshape(nS, 1, 1)
+        actions = np.arange(nA).reshape(1, nA, 1)
+        np.add.at(transition, (states, actions, self.successors), self.probs)
+        return transition
+
+    @property
+    def shape(self):
+        return self.successors.shape[:2] + (self._nS, )
+
+    @property
+    def nnz(self):
+        return int(np.count_nonzero(self.probs))
+
+    def log_probs(self):
+        """Log of probs, with padding entries -inf."""
+        if not isinstance(self.probs, np.ndarray):  # torch tensor
+            return self.probs.log()
+        with np.errstate(divide='ignore'):
+            return np.log(self.probs)
+
+    def expectation(self, V):
+        """Returns S*A array: expected value of V at the successor state."""
+        return (self.probs * V[self.successors]).sum(2)
+
+    def propagate(self, weights):
+        """Returns S array: next state distribution given an S*A array
+           of (unnormalized) weights over the current state-action pair."""
+        w = weights[:, :, None] * self.probs
+        if not isinstance(w, np.ndarray):  # torch tensor
+            res = w.new_zeros(self._nS)
+            return res.index_add_(0, self.successors.reshape(-1), w.reshape(-1))
+        return np.bincount(self.successors.ravel(), weights=w.ravel(),
+                           minlength=self._nS)
+
+class CompiledMdp(object):
+    """Invariants of an MDP's dynamics that planners would otherwise recompute
+       on every call: the transition tensor in its most efficient
+       representation, its log and the successor lists.
+
+       May be passed in place of a transition tensor to max_ent_policy,
+       max_causal_ent_policy, expected_counts and q_iteration.
+       Does not depend on the reward, so is not invalidated by reward
+       wrappers. See also TabularMdpEnv.compiled."""
+    def __init__(self, transition, sparse=None):
+        """
+        Args:
+            transition (array or SparseTransition): dense or sparse tensor,
+                of NumPy arrays or torch tensors.
+            sparse (bool): whether to use a sparse representation.
+                If None, the representation of transition is left unchanged.
+        """
+        if isinstance(transition, CompiledMdp):
+            transition = transition.transition
+        is_sparse = isinstance(transition, SparseTransition)
+        if sparse is None:
+            sparse = is_sparse
+        if sparse and not is_sparse:
+            transition = SparseTransition.from_dense(transition)
+        elif not sparse and is_sparse:
+            transition = transition.todense()
+        self.transition = transition
+        self.sparse = sparse
+        self._log_transition = None
+        self._sampling_table = None
+        self._casts = {}
+
+    @property
+    def shape(self):
+        return self.transition.shape
+
+    @property
+    def log_transition(self):
+        """Log of the transition probabilities. For sparse MDPs, this is
+           the log of the successor probabilities, with padding -inf.
+           For dense MDPs, log(0) is replaced by a large negative number."""
+        if self._log_transition is None:
+            if self.sparse:
+                self._log_transition = self.transition.log_probs()
+            elif isinstance(self.transition, np.ndarray):
+                with np.errstate(divide='ignore'):
+                    logt = np.log(self.transition)
+                self._log_transition = np.nan_to_num(logt)
+            else:  # torch tensor
+                self._log_transition = self.transition.log()
+        return self._log_transition
+
+    @property
+    def sampling_table(self):
+        """cumulative_table of the transition probabilities, with a row per
+           state-action pair. For sparse MDPs, the classes are the positions
+           in the successor lists; for dense MDPs, the next states."""
+        if self._sampling_table is None:
+            if self.sparse:
+                probs = self.transition.probs
+            else:
+                probs = self.transition
+            self._sampling_table = cumulative_table(np.asarray(probs))
+        return self._sampling_table
+
+    def sample_successors(self, states, actions, u):
+        """Samples next states for arrays of states and actions, given
+           uniform samples u in [0, 1) of the same shape."""
+        nA = self.shape[1]
+        idx = table_sample(self.sampling_table, states * nA + actions, u)
+        if self.sparse:
+            return self.transition.successors[states, actions, idx]
+        return idx
+
+    def astype(self, dtype):
+        """Returns a CompiledMdp with transition probabilities converted to
+           dtype. Requires NumPy transition tensors. The conversion is cached,
+           so repeated calls (e.g. from irl()) share a single copy; this
+           copy is kept alive for the lifetime of this object."""
+        dtype = np.dtype(dtype)
+        transition = self.transition
+        probs = transition.probs if self.sparse else transition
+        if probs.dtype == dtype:
+            return self
+        if dtype not in self._casts:
+            if self.sparse:
+                transition = SparseTransition(transition.successors,
+                                              probs.astype(dtype),
+                                              transition.shape[2])
+            else:
+                transition = transition.astype(dtype)
+            self._casts[dtype] = CompiledMdp(transition, sparse=self.sparse)
+        return self._casts[dtype]
+
+    def successor_values(self, V):
+        """Returns V at the successors of each state-action pair: an S*A*K
+           array for sparse MDPs, and V reshaped to 1*1*S for dense MDPs;
+           either broadcasts with log_transition."""
+        if self.sparse:
+            return V[self.transition.successors]
+        return V.reshape(1, 1, -1)
+
+    def expectation(self, V):
+        return transition_expectation(self.transition, V)
+
+    def propagate(self, weights):
+        return transition_propagate(self.transition, weights)
+
+def as_compiled(transition):
+    """Returns transition if it is a CompiledMdp; otherwise, a CompiledMdp
+       with the same representation as transition."""
+    if isinstance(transition, CompiledMdp):
+        return transition
+    return CompiledMdp(transition)
+
+def block_diagonal(transitions):
+    """Transition tensor for the disjoint union of several MDPs.
+
+    Args:
+        transitions (list): dense arrays or SparseTransition's.
+
+    Returns:
+        A SparseTransition, where state s of the i'th MDP is mapped to state
+        s + sum_{j < i} S_j in the union. The MDPs must have the same number
+        of actions.
+    """
+    transitions = [CompiledMdp(t, sparse=True).transition
+                   for t in transitions]
+    K = max([t.successors.shape[2] for t in transitions])
+    successors = []
+    probs = []
+    offset = 0
+    for t in transitions:
+        pad = K - t.successors.shape[2]
+        padding = np.repeat(t.successors[:, :, :1], pad, axis=2)
+        successors.append(np.concatenate([t.successors, padding], axis=2)
+                          + offset)
+        probs.append(np.pad(t.probs, [(0, 0), (0, 0), (0, pad)], 'constant'))
+        offset += t.shape[2]
+    return SparseTransition(np.concatenate(successors),
+                            np.concatenate(probs), offset)
+
+def policy_transition(transition, policy):
+    """State transition matrix P induced by policy, where
+       P[s, t] = sum_a policy[s, a] * transition[s, a, t].
+
+       Returns a scipy.sparse CSR matrix if transition is a SparseTransition
+       of NumPy arrays, otherwise a dense S*S array or torch tensor."""
+    if isinstance(transition, CompiledMdp):
+        transition = transition.transition
+    nS, nA, _ = transition.shape
+    if isinstance(transition, SparseTransition):
+        K = transition.successors.shape[2]
+        vals = policy[:, :, None] * transition.probs
+        if isinstance(vals, np.ndarray):
+            rows = np.repeat(np.arange(nS), nA * K)
+            cols = transition.successors.ravel()
+            return scipy.sparse.csr_matrix((vals.ravel(), (rows, cols)),
+                                           shape=(nS, nS))
+        else:  # torch tensor
+            offsets = transition.successors.new_tensor(range(nS)) * nS
+            idx = transition.successors + offsets.view(nS, 1, 1)
+            P = vals.new_zeros(nS * nS)
+            return P.index_add_(0, idx.reshape(-1), vals.reshape(-1)).view(nS, nS)
+    return (policy[:, :, None] * transition).sum(1)
+
+def transition_expectation(transition, V):
+    """Computes sum_t transition[s, a, t] * V[t] for dense or sparse
+       transition tensors. Returns an S*A array.
+       Works for both NumPy arrays and torch tensors."""
+    if isinstance(transition, CompiledMdp):
+        transition = transition.transition
+    if isinstance(transition, SparseTransition):
+        return transition.expectation(V)
+    return transition @ V
+
+def transition_propagate(transition, weights):
+    """Computes sum_{s, a} weights[s, a] * transition[s, a, t] for dense or
+       sparse transition tensors. Returns an S array.
+       Works for both NumPy arrays and torch tensors."""
+    if isinstance(transition, CompiledMdp):
+        transition = transition.transition
+    if isinstance(transition, SparseTransition):
+        return transition.propagate(weights)
+    nS = transition.shape[2]
+    return weights.reshape(-1) @ transition.reshape(-1, nS)
+
 class TabularMdpEnv(Env):
     #TODO: Do I want to set reward_range?
     #TODO: am I ok with reward being a function of state?
-    def __init__(self, transition, reward, initial_state, terminal):
+    def __init__(self, transition, reward, initial_state, terminal,
+                 features=None):
         """Creates an environment for an MDP. The state and action spaces
            are consecutive integer sequences, with their size inferred from the
            dimensions of the transition matrix.
 
         Args:
-            transition (S*A*S array-like): transition probability matrix
-                transition[s, a, t] gives probability of moving to state t
-                having taken action a in state s.
+            transition (S*A*S array-like or SparseTransition): transition
+                probability matrix; transition[s, a, t] gives probability of
+                moving to state t having taken action a in state s.
             reward (S array-like): reward per state.
             initial_state (S array-like): probability distribution over states.
             terminal (S array-like): boolean mask for if episode-ending.
+            features (S*d array-like): optional, state features. Used by IRL
+                algorithms that learn a reward linear in the features.
         """
         super().__init__()
 
-        self._transition = np.array(transition)
+        if isinstance(transition, SparseTransition):
+            self._transition = transition
+        else:
+            self._transition = np.array(transition)
         self._reward = np.array(reward)
         self._initial_states = np.array(initial_state)
         self._terminal = np.array(terminal)
+        self._features = None
+        if features is not None:
+            self._features = np.array(features, dtype=float)
 
         # Check dimensions
         S, A, S2 = self._transition.shape
@@ -39,15 +339,24 @@ class TabularMdpEnv(Env):
         assert reward.shape == (S, )
         assert initial_state.shape == (S, )
         assert terminal.shape == (S, )
+        if features is not None:
+            assert self._features.ndim == 2
+            assert self._features.shape[0] == S
 
         # Check probability distributions
-        _check_probability(self._transition, 2)
+        if isinstance(self._transition, SparseTransition):
+            _check_probability(self._transition.probs, 2)
+        else:
+            _check_probability(self._transition, 2)
         _check_probability(self._initial_states, 0)
 
         # State/action space
         self.observation_space = spaces.Discrete(S)
         self.action_space = spaces.Discrete(A)
 
+        self._compiled = None
+        self._initial_table = cumulative_table(self._initial_states)
+
         self.seed()
         self.reset()
 
@@ -57,16 +366,25 @@ class TabularMdpEnv(Env):
          return [seed]
 
     def reset(self):
-        self._state = discrete_sample(self._initial_states, self.rng)
+        self._state = table_sample(self._initial_table, 0, self.rng.rand())
         self._initial_state = self._state
         return self._state
 
     def step(self, action):
-        p = self._transition[self._state, action, :]
-        self._state = discrete_sample(p, self.rng)
+        # Binary search in the cached cumulative transition table
+        compiled = self.compiled
+        state = self._state
+        row = state * compiled.shape[1] + action
+        idx = table_sample(compiled.sampling_table, row, self.rng.rand())
+        if compiled.sparse:
+            self._state = compiled.transition.successors[state, action, idx]
+            prob = compiled.transition.probs[state, action, idx]
+        else:
+            self._state = idx
+            prob = compiled.transition[state, action, idx]
         r = self._reward[self._state]
         finished = self._terminal[self._state]
-        info = {"prob": p[self._state]}
+        info = {"prob": prob}
         return (self._state, r, finished, info)
 
     @property
@@ -81,6 +399,13 @@ class TabularMdpEnv(Env):
     def transition(self):
         return self._transition
 
+    @property
+    def compiled(self):
+        """CompiledMdp for this environment, built on first access."""
+        if self._compiled is None:
+            self._compiled = CompiledMdp(self._transition)
+        return self._compiled
+
     @property
     def reward(self):
         return self._reward
@@ -92,3 +417,8 @@ class TabularMdpEnv(Env):
     @property
     def terminal(self):
         return self._terminal
+
+    @property
+    def features(self):
+        """S*d array of state features, or None if not specified."""
+        return self._features
@@ -13,7 +13,8 @@ import gym
 import joblib
 import ray
 
-from pirl import config, utils
+from pirl import config, envs, utils
+from pirl.agents.sample import VecMonitor
 from pirl.utils import create_seed, sanitize_env_name, safeset
 
 logger = logging.getLogger('pirl.experiments.experiments')
@@ -21,6 +22,17 @@ cache = utils.cache_and_log(config.OBJECT_DIR)
 
 # Context Managers & Decorators
 
+class _MonitorStub(gym.Env):
+    '''Environment with the spaces and spec of env, that is never stepped.
+       Wrapped in a bench.Monitor to log episodes recorded by VecMonitor.'''
+    def __init__(self, env):
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        self.reward_range = env.reward_range
+        self.metadata = env.metadata
+        self.spec = env.spec
+
+
 @contextmanager
 def make_envs(env_name, vectorized, parallel, base_seed, log_prefix,
               pre_wrapper=None, post_wrapper=None):
@@ -34,8 +46,31 @@ def make_envs(env_name, vectorized, parallel, base_seed, log_prefix,
 
     env = None
     try:
-        if vectorized:
-            env_fns = [functools.partial(helper, i) for i in range(parallel)]
+        env = helper(0)
+        native = (vectorized == 'native' and pre_wrapper is None
+                  and env_name in envs.vec_envs)
+        if native:
+            # Simulate all episodes at once. Opt-in, by algorithms declaring
+            # vectorized='native': their names key the cache, so results
+            # are never shared with DummyVecEnv runs. Parameters are read
+            # from the unwrapped env, so this is only used without pre_wrapper.
+            # env is neither stepped nor closed by the VecEnv: VecMonitor
+            # records the episodes in the same log files DummyVecEnv would,
+            # and closes each monitor once. The episodes are drawn
+            # from a single random stream seeded with base_seed: seeded
+            # results differ from those of DummyVecEnv.
+            vec_env_cls = gym.envs.registration.load(envs.vec_envs[env_name])
+            monitors = [env] + [bench.Monitor(_MonitorStub(env),
+                                              log_prefix + str(i),
+                                              allow_early_resets=True)
+                                for i in range(1, parallel)]
+            env = VecMonitor(vec_env_cls(env, parallel, seed=base_seed),
+                             monitors)
+        elif vectorized:
+            first_env = env
+            env_fns = [lambda: first_env]
+            env_fns += [functools.partial(helper, i)
+                        for i in range(1, parallel)]
             #SOMEDAY: use SubprocVecEnv when parallel above a certain threshold.
             # Avoided this since (a) it's not much faster, and (b) it fails
             # on some machines for MuJoCo environments. (Never pinpointed
@@ -43,8 +78,6 @@ def make_envs(env_name, vectorized, parallel, base_seed, log_prefix,
             # TensorFlow code has run, intermittent issue. Suspect GPU drivers.)
             # If you fix this, change num_cpus in ray_remote_variable_resources.
             env = DummyVecEnv(env_fns)
-        else:  # not vectorized
-            env = helper(0)
 
         if post_wrapper is not None:
             # note post_wrapper may be called with Env or VecEnv
@@ -298,7 +331,8 @@ def _run_population_irl_meta(irl, parallel, discount, seed, trajs, log_dir):
 @ray_remote_variable_resources(num_return_vals=2)
 @cache(tags=('irl', 'population_irl'))
 def _run_population_irl_finetune(irl, parallel, discount, seed,
-                                 env, trajs, metainit, log_dir):
+                                 env, trajs, metainit, log_dir,
+                                 sweep_keys=None):
     # Setup
     utils.set_cuda_visible_devices()
     logger.debug('[IRL] finetune: algo = %s [discount=%f, seed=%s, parallel=%d]' 
@@ -311,26 +345,45 @@ def _run_population_irl_finetune(irl, parallel, discount, seed,
     # Seeding
     finetune_seed = create_seed(seed + 'irlfinetune')
 
+    # Sweeps (see config.POPULATION_IRL_SWEEPS) only compute sweep_keys
+    kwargs = {}
+    if sweep_keys is not None:
+        kwargs['regularize'] = list(sweep_keys)
+
     # Finetune IRL algorithm (i.e. run it) from meta-initialization
     with make_envs(env, irl_algo.vectorized, parallel,
                    finetune_seed,
                    log_prefix=finetune_mon_prefix) as envs:
-        r, p = irl_algo.finetune(metainit, envs, trajs, discount=discount,
-                                 seed=finetune_seed, log_dir=log_dir)
-        joblib.dump(p, osp.join(log_dir, 'policy.pkl'))
+        res = irl_algo.finetune(metainit, envs, trajs, discount=discount,
+                                seed=finetune_seed, log_dir=log_dir, **kwargs)
+    # Sweeps (see config.POPULATION_IRL_SWEEPS) return a dict of results
+    sweep = isinstance(res, dict)
+    if not sweep:
+        res = {None: res}
+    policies = {k: p for k, (r, p) in res.items()}
+    joblib.dump(policies if sweep else policies[None],
+                osp.join(log_dir, 'policy.pkl'))
 
     # Compute value of finetuned policy
+    rewards = {}
+    values = {}
     with make_envs(env, irl_algo.vectorized, parallel,
                    finetune_seed,
                    log_prefix=finetune_mon_prefix) as envs:
         eval_seed = create_seed(seed + 'eval')
-        v = irl_algo.value(envs, p, discount=1.0, seed=eval_seed)
+        for k, (r, p) in res.items():
+            rewards[k] = r
+            values[k] = irl_algo.value(envs, p, discount=1.0, seed=eval_seed)
 
-    return r, v
+    if sweep:
+        return rewards, values
+    else:
+        return rewards[None], values[None]
 
 
 def _run_population_irl_train(irl, parallel, discount, seed,
-                              train_trajs, test_trajs, n, ms, log_dir):
+                              train_trajs, test_trajs, n, ms, log_dir,
+                              sweep_keys):
     '''Performs metalearning with irl_name on n training trajectories,
        returning a tuple of rewards and values with shape [env][m].'''
     # Metalearn
@@ -350,7 +403,8 @@ def _run_population_irl_train(irl, parallel, discount, seed,
             r, v = _run_population_irl_finetune.remote(irl, parallel, discount,
                                                        seed, env, subset,
                                                        metainit,
-                                                       finetune_log_dir)
+                                                       finetune_log_dir,
+                                                       sweep_keys)
             safeset(rewards, [env, m], r)
             safeset(values, [env, m], v)
 
@@ -359,7 +413,7 @@ def _run_population_irl_train(irl, parallel, discount, seed,
 
 @ray.remote(num_return_vals=2)
 def _run_population_irl_helper(irl, parallel, discount, seed,
-                               train_envs, test_envs, num_traj,
+                               train_envs, test_envs, num_traj, sweep_keys,
                                log_dir, envs, *trajectories):
     # Reconstruct trajectories
     trajectories = {k: v for k, v in zip(envs, trajectories)}
@@ -372,7 +426,7 @@ def _run_population_irl_helper(irl, parallel, discount, seed,
     for n, ms in num_traj.items():
         r, v = _run_population_irl_train(irl, parallel, discount, seed,
                                          train_trajs, test_trajs, n, ms,
-                                         log_dir)
+                                         log_dir, sweep_keys)
         for env in test_trajs.keys():
             safeset(rewards, [env, n], r[env])
             safeset(values, [env, n], v[env])
@@ -382,14 +436,27 @@ def _run_population_irl_helper(irl, parallel, discount, seed,
     return rewards, values
 
 
+@ray.remote
+def _select_sweep(res, key):
+    '''Selects results for key from the nested dict [env][n][m][key]
+       returned by a sweep.'''
+    return collections.OrderedDict(
+        (env, collections.OrderedDict(
+            (n, collections.OrderedDict((m, v[key]) for m, v in ms.items()))
+            for n, ms in ns.items()))
+        for env, ns in res.items())
+
+
 def _run_population_irl(irl, parallel, discount, seed, train_envs,
-                        test_envs, num_traj, trajectories, out_dir):
+                        test_envs, num_traj, trajectories, out_dir,
+                        sweep_keys=None):
     # Flatten trajectories (env -> object ID) to appease ray
     envs = sorted(list(set(train_envs).union(test_envs)))
     trajectories = [trajectories[k] for k in envs]
     return _run_population_irl_helper.remote(irl, parallel, discount, seed,
                                              train_envs, test_envs, num_traj,
-                                             out_dir, envs, *trajectories)
+                                             sweep_keys, out_dir, envs,
+                                             *trajectories)
 
 ## Single-task IRL
 
@@ -424,6 +491,50 @@ def _run_single_irl_train(irl, parallel, discount, seed,
     return reward, value
 
 
+@ray_remote_variable_resources(num_return_vals=2)
+@cache(tags=('irl', 'single_irl'))
+def _run_single_irl_sweep_train(irl, parallel, discount, seed,
+                                env_name, log_dir, trajectories, ms):
+    '''As _run_single_irl_train, but for an algorithm in
+       config.SINGLE_IRL_M_SWEEPS: learns from trajectories[:m] for every m
+       in ms in a single run. Returns dicts mapping m to rewards and values.'''
+    logger.debug('[IRL] algo = %s [discount=%f, seed=%s, parallel=%d], '
+                 'env = %s, ms = %s',
+                 irl, discount, seed, parallel, env_name, ms)
+    # Setup
+    utils.set_cuda_visible_devices()
+    mon_dir = osp.join(log_dir, 'mon')
+    os.makedirs(mon_dir)
+
+    irl_algo = config.SINGLE_IRL_ALGORITHMS[irl]
+    irl_seed = create_seed(seed + 'irl')
+    with make_envs(env_name, irl_algo.vectorized, parallel, irl_seed,
+                   log_prefix=osp.join(mon_dir, 'train')) as envs:
+        res = irl_algo.train(envs, trajectories, discount=discount, ms=ms,
+                             seed=irl_seed, log_dir=log_dir)
+    rewards = {m: r for m, (r, p) in res.items()}
+    policies = {m: p for m, (r, p) in res.items()}
+
+    # Save learnt rewards & policies for debugging purposes
+    joblib.dump(rewards, osp.join(log_dir, 'reward.pkl'))
+    joblib.dump(policies, osp.join(log_dir, 'policy.pkl'))
+
+    eval_seed = create_seed(seed + 'eval')
+    values = {}
+    with make_envs(env_name, irl_algo.vectorized, parallel, eval_seed,
+                   log_prefix=osp.join(mon_dir, 'eval')) as envs:
+        for m, policy in policies.items():
+            values[m] = irl_algo.value(envs, policy, discount=1.00,
+                                       seed=eval_seed)
+
+    return rewards, values
+
+
+@ray.remote
+def _select_m(res, m):
+    return res[m]
+
+
 @ray.remote(num_return_vals=2)
 def _run_single_irl_helper(irl, parallel, discount, seed,
                            num_traj, test_envs, log_dir, *trajectories):
@@ -432,14 +543,26 @@ def _run_single_irl_helper(irl, parallel, discount, seed,
     value_res = collections.OrderedDict()
 
     ms = sorted(set(itertools.chain(*num_traj.values())))
-    for env, m in itertools.product(test_envs, ms):
-        subset = trajectories[env][:m]
-        sub_log_dir = osp.join(log_dir, 'irl', irl,
-                               sanitize_env_name(env), '{}'.format(m))
+    # Sweeps over m run once per environment
+    sweeps = {}
+    if irl in config.SINGLE_IRL_M_SWEEPS:
+        for env in test_envs:
+            subset = trajectories[env][:ms[-1]]
+            sub_log_dir = osp.join(log_dir, 'irl', irl,
+                                   sanitize_env_name(env), 'sweep')
+            sweeps[env] = _run_single_irl_sweep_train.remote(
+                irl, parallel, discount, seed, env, sub_log_dir, subset, ms)
 
-        reward, value = _run_single_irl_train.remote(irl, parallel, discount,
-                                                     seed, env, sub_log_dir,
-                                                     subset)
+    for env, m in itertools.product(test_envs, ms):
+        if env in sweeps:
+            reward, value = [_select_m.remote(x, m) for x in sweeps[env]]
+        else:
+            subset = trajectories[env][:m]
+            sub_log_dir = osp.join(log_dir, 'irl', irl,
+                                   sanitize_env_name(env), '{}'.format(m))
+            reward, value = _run_single_irl_train.remote(irl, parallel,
+                                                         discount, seed, env,
+                                                         sub_log_dir, subset)
 
         for n, ms in num_traj.items():
             if m in ms:
@@ -496,6 +619,24 @@ def run_irl(cfg, out_dir, trajectories, seed):
         'trajectories': trajectories,
     }
 
+    # Algorithms computed by sweeps: irl -> (sweep, key). Sweeps are opt-in:
+    # their results are stored under the sweep's log directory and cache key,
+    # and stopping rules apply to the whole sweep rather than to each member.
+    swept = {}
+    if cfg.get('batch_sweeps', False):
+        for sweep, members in config.POPULATION_IRL_SWEEPS.items():
+            for irl, key in members.items():
+                swept[irl] = (sweep, key)
+    # Keys of each sweep that are requested. Sweeps are run at most once,
+    # for just these keys, and only if more than one is requested:
+    # otherwise, the requested algorithm is run directly.
+    sweep_keys = collections.OrderedDict()
+    for irl in cfg['irl']:
+        if irl in swept:
+            sweep, key = swept[irl]
+            sweep_keys.setdefault(sweep, []).append(key)
+    sweep_futures = {}
+
     # Futures shape: irl -> Future([env][n][m])
     reward_futures = collections.OrderedDict()
     value_futures = collections.OrderedDict()
@@ -504,6 +645,14 @@ def run_irl(cfg, out_dir, trajectories, seed):
         kwds.update({'irl': irl})
         if irl in config.SINGLE_IRL_ALGORITHMS:
             rew, val = _run_single_irl(**kwds)
+        elif irl in swept and len(sweep_keys[swept[irl][0]]) > 1:
+            sweep, key = swept[irl]
+            if sweep not in sweep_futures:
+                kwds.update({'irl': sweep,
+                             'sweep_keys': tuple(sweep_keys[sweep])})
+                sweep_futures[sweep] = _run_population_irl(**kwds)
+            rew, val = [_select_sweep.remote(x, key)
+                        for x in sweep_futures[sweep]]
         elif irl in config.POPULATION_IRL_ALGORITHMS:
             rew, val = _run_population_irl(**kwds)
         else:
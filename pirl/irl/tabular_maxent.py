@@ -6,37 +6,84 @@ described in the paper:
   - We use Adam rather than exponentiated gradient descent.
 """
 
+import contextlib
 import functools
+import warnings
 
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 from scipy.special import logsumexp as sp_lse
 import torch
 from torch.autograd import Variable
 
+from pirl.envs.tabular_mdp import CompiledMdp, SparseTransition, \
+                                  TabularMdpEnv, as_compiled, block_diagonal, \
+                                  policy_transition, transition_expectation, \
+                                  transition_propagate
 from pirl.utils import getattr_unwrapped, TrainingIterator
 
-#TODO: fully torchize?
+def _discounted_visits(trajectories, discount):
+    """Concatenates the states visited in trajectories.
+
+    Returns (states, weights, lengths) where states and weights are arrays
+    over all timesteps of all trajectories, weights being the discount
+    applied to that timestep, and lengths is the length of each trajectory.
+    """
+    lengths = np.array([len(states) for states, _ in trajectories], dtype=int)
+    if len(trajectories) > 0:
+        states = np.concatenate([states for states, _ in trajectories])
+    else:
+        states = np.zeros(0, dtype=int)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    timesteps = np.arange(len(states)) - starts
+    weights = discount ** timesteps
+    return states, weights, lengths
 
 def empirical_counts(nS, trajectories, discount):
     """Compute empirical state-action feature counts from trajectories."""
-    counts = np.zeros((nS, ))
-    discounted_steps = 0
-    for states, actions in trajectories:
-        incr = np.cumprod([1] + [discount] * (len(states) - 1))
-        counts += np.bincount(states, weights=incr, minlength=nS)
-        discounted_steps += np.sum(incr)
-    return counts / discounted_steps
+    states, weights, _ = _discounted_visits(trajectories, discount)
+    counts = np.bincount(states, weights=weights, minlength=nS)
+    return counts / np.sum(weights)
+
+class TrajectoryCounts(object):
+    """Index giving empirical_counts of every prefix of a list of
+       trajectories. Construction takes a single pass over the trajectories;
+       afterwards, the counts for trajectories[:m] can be computed in O(S),
+       for any m. Uses O(S * len(trajectories)) memory."""
+    def __init__(self, nS, trajectories, discount):
+        states, weights, lengths = _discounted_visits(trajectories, discount)
+        num_trajs = len(lengths)
+        traj_ids = np.repeat(np.arange(num_trajs), lengths)
+        counts = np.bincount(traj_ids * nS + states, weights=weights,
+                             minlength=num_trajs * nS)
+        counts = counts.reshape(num_trajs, nS)
+        steps = np.bincount(traj_ids, weights=weights, minlength=num_trajs)
+        self._prefix_counts = np.zeros((num_trajs + 1, nS))
+        np.cumsum(counts, axis=0, out=self._prefix_counts[1:])
+        self._prefix_steps = np.zeros(num_trajs + 1)
+        np.cumsum(steps, out=self._prefix_steps[1:])
+
+    def __len__(self):
+        return len(self._prefix_steps) - 1
+
+    def counts(self, m):
+        """Equal to empirical_counts(nS, trajectories[:m], discount).
+           trajectories[:m] must contain at least one timestep: otherwise,
+           the counts are undefined."""
+        if self._prefix_steps[m] == 0:
+            raise ValueError('No timesteps in first {} trajectories'.format(m))
+        return self._prefix_counts[m] / self._prefix_steps[m]
 
 def max_ent_policy(transition, reward, horizon, discount):
     """Backward pass of algorithm 1 of Ziebart (2008).
        This corresponds to maximum entropy.
        WARNING: You probably want to use max_causal_ent_policy instead.
        See discussion in section 6.2.2 of Ziebart's PhD thesis (2010)."""
-    nS = transition.shape[0]
-    logsc = np.zeros(nS)  # TODO: terminal states only?
-    with np.warnings.catch_warnings():
-        np.warnings.filterwarnings('ignore', 'divide by zero encountered in log')
-        logt = np.nan_to_num(np.log(transition))
+    mdp = as_compiled(transition)
+    nS = mdp.shape[0]
+    logt = mdp.log_transition
+    logsc = np.zeros(nS, dtype=logt.dtype)  # TODO: terminal states only?
     reward = reward.reshape(nS, 1, 1)
     for i in range(horizon):
         # Ziebart (2008) never describes how to handle discounting. This is a
@@ -44,42 +91,406 @@ def max_ent_policy(transition, reward, horizon, discount):
         # frequency a state/action is visited at the (horizon-i-1)'th position.
         # So we should multiply reward by discount ** (horizon - i - 1).
         cur_discount = discount ** (horizon - i - 1)
-        x = logt + (cur_discount * reward) + logsc.reshape(1, 1, nS)
+        x = logt + (cur_discount * reward) + mdp.successor_values(logsc)
         logac = sp_lse(x, axis=2)
         logsc = sp_lse(logac, axis=1)
     return np.exp(logac - logsc.reshape(nS, 1))
 
 def max_causal_ent_policy(transition, reward, horizon, discount):
-    """Soft Q-iteration, theorem 6.8 of Ziebart's PhD thesis (2010)."""
+    """Soft Q-iteration, theorem 6.8 of Ziebart's PhD thesis (2010).
+       Computes in the precision of reward and transition: it is stable in
+       float32, since the policy is computed in log-space."""
     nS, nA, _ = transition.shape
-    V = np.zeros(nS)
+    V = np.zeros(nS, dtype=reward.dtype)
     for i in range(horizon):
-        Q = reward.reshape(nS, 1) + discount * (transition * V).sum(2)
+        EV = transition_expectation(transition, V)
+        Q = reward.reshape(nS, 1) + discount * EV
         V = sp_lse(Q, axis=1)
     return np.exp(Q - V.reshape(nS, 1))
 
-def expected_counts(policy, transition, initial_states, horizon, discount):
-    """Forward pass of algorithm 1 of Ziebart (2008)."""
+def _power_sum(A, x, n, eye):
+    """Returns sum_{t=0}^{n-1} A^t x using O(log n) matrix products."""
+    res = 0
+    A_pow = A  # A^(2^j)
+    A_sum = eye  # sum_{t < 2^j} A^t
+    while n > 0:
+        if n % 2 == 1:
+            # Contribution of the next 2^j terms: A_sum applied to A^offset x
+            res = res + A_sum @ x
+            x = A_pow @ x
+        n //= 2
+        if n > 0:
+            A_sum = A_sum + A_pow @ A_sum
+            A_pow = A_pow @ A_pow
+    return res
+
+def expected_counts(policy, transition, initial_states, horizon, discount,
+                    method='iterate', per_timestep=False):
+    """Forward pass of algorithm 1 of Ziebart (2008).
+
+    Args:
+        - method(str): one of:
+            'iterate': horizon passes over the transition matrix.
+            'doubling': builds the S*S state transition matrix P under policy
+                and sums its powers by repeated squaring, O(log horizon)
+                S*S matrix products. Only worthwhile for small S.
+            'solve': infinite-horizon counts, solving a (sparse, if transition
+                is sparse) linear system in I - discount * P. Ignores horizon,
+                so requires discount < 1; a good approximation when
+                discount ** horizon is small.
+        - per_timestep(bool): if True, returns an S*(horizon+1) array, where
+            column t is the contribution of timestep t to the counts.
+            Summing over columns gives the return value with per_timestep=False.
+            Requires method 'iterate'.
+
+    With method 'iterate', propagation is in the precision of policy, but
+    counts are summed over timesteps in float64, so a float32 policy and
+    transition lose little accuracy over long horizons.
+    """
     nS = transition.shape[0]
-    counts = np.zeros((nS, horizon + 1))
-    counts[:, 0] = initial_states
-    for i in range(1, horizon + 1):
-        counts[:, i] = np.einsum('i,ij,ijk->k', counts[:, i-1],
-                                 policy, transition) * discount
+    assert not per_timestep or method == 'iterate'
+    if method == 'solve':
+        assert discount < 1
+        P = policy_transition(transition, policy)
+        if scipy.sparse.issparse(P):
+            A = scipy.sparse.identity(nS, format='csc') - discount * P.T
+            counts = scipy.sparse.linalg.spsolve(A.tocsc(), initial_states)
+        else:
+            A = np.eye(nS) - discount * P.T
+            counts = np.linalg.solve(A, initial_states)
+        return counts * (1 - discount)
+
+    if method == 'iterate':
+        counts = np.zeros((nS, horizon + 1), dtype=policy.dtype)
+        counts[:, 0] = initial_states
+        for i in range(1, horizon + 1):
+            weights = counts[:, i-1].reshape(nS, 1) * policy
+            counts[:, i] = transition_propagate(transition, weights) * discount
+        if not per_timestep:
+            counts = np.sum(counts, axis=1, dtype=np.float64)
+    elif method == 'doubling':
+        P = policy_transition(transition, policy)
+        if scipy.sparse.issparse(P):
+            P = P.toarray()
+        counts = _power_sum(discount * P.T, initial_states, horizon + 1,
+                            np.eye(nS))
+    else:
+        raise ValueError("Unknown method '{}'".format(method))
     if discount == 1:
         renorm = horizon + 1
     else:
         renorm = (1 - discount ** (horizon + 1)) / (1 - discount)
-    return np.sum(counts, axis=1) / renorm
+    return counts / renorm
+
+def occurrence_counts(nS, nA, trajectories):
+    """Number of times each state-action pair occurs in trajectories.
+       Returns an S*A array."""
+    if len(trajectories) > 0:
+        states = np.concatenate([states for states, _ in trajectories])
+        actions = np.concatenate([actions for _, actions in trajectories])
+    else:
+        states = actions = np.zeros(0, dtype=int)
+    counts = np.bincount(states * nA + actions, minlength=nS * nA)
+    return counts.reshape(nS, nA)
+
+def occurrence_index(occurrences):
+    """Flattened indices and counts of the state-action pairs that occur in
+       occurrences, an S*A array from occurrence_counts. Returns a pair of
+       arrays, which may be passed to occurrence_loss in place of occurrences
+       to avoid finding the occurring pairs on every call.
+       Works for both NumPy arrays and torch tensors."""
+    flat = occurrences.reshape(-1)
+    if isinstance(occurrences, np.ndarray):
+        index = np.flatnonzero(flat)
+    else:  # torch
+        index = flat.nonzero().reshape(-1)
+    return index, flat[index]
+
+def occurrence_loss(policy, occurrences):
+    """Log-likelihood of trajectories under policy, where occurrences is
+       occurrence_counts of the trajectories, or occurrence_index of it.
+       Equal to policy_loss, but only takes the log of the policy at the
+       occurring state-action pairs.
+       Works for both NumPy arrays and torch tensors."""
+    if not isinstance(occurrences, tuple):
+        occurrences = occurrence_index(occurrences)
+    index, counts = occurrences
+    flat = policy.reshape(-1)
+    if isinstance(policy, np.ndarray):
+        return float(np.dot(counts, np.log(flat[index])))
+    else:  # torch
+        return float((counts * flat[index].log()).sum())
 
 def policy_loss(policy, trajectories):
-    loss = 0
-    log_policy = np.log(policy)
-    for states, actions in trajectories:
-        loss += np.sum(log_policy[states, actions])
-    return loss
+    occurrences = occurrence_counts(*policy.shape, trajectories)
+    return occurrence_loss(policy, occurrences)
+
+## Torch engine: same algorithms as above, operating on torch tensors
+
+def _torch_logsumexp(x, dim):
+    m = x.max(dim, keepdim=True)[0]
+    return (x - m).exp().sum(dim).log() + m.squeeze(dim)
+
+def to_torch(transition, dtype=torch.float64):
+    """Converts a dense or sparse transition tensor, or a CompiledMdp,
+       to torch."""
+    if isinstance(transition, CompiledMdp):
+        return CompiledMdp(to_torch(transition.transition, dtype),
+                           sparse=transition.sparse)
+    if isinstance(transition, SparseTransition):
+        successors = torch.from_numpy(transition.successors)
+        probs = torch.from_numpy(transition.probs).type(dtype)
+        return SparseTransition(successors, probs, transition.shape[2])
+    return torch.from_numpy(np.asarray(transition)).type(dtype)
+
+def max_ent_policy_torch(transition, reward, horizon, discount):
+    """Same as max_ent_policy, but transition (from to_torch) and reward are
+       torch tensors. Returns a torch tensor."""
+    mdp = as_compiled(transition)
+    nS = mdp.shape[0]
+    logsc = reward.new_zeros(nS)
+    logt = mdp.log_transition
+    reward = reward.view(nS, 1, 1)
+    for i in range(horizon):
+        cur_discount = discount ** (horizon - i - 1)
+        x = logt + (cur_discount * reward) + mdp.successor_values(logsc)
+        logac = _torch_logsumexp(x, 2)
+        logsc = _torch_logsumexp(logac, 1)
+    return (logac - logsc.view(nS, 1)).exp()
+
+def max_causal_ent_policy_torch(transition, reward, horizon, discount):
+    """Same as max_causal_ent_policy, but transition (from to_torch) and
+       reward are torch tensors. Returns a torch tensor."""
+    nS = transition.shape[0]
+    V = reward.new_zeros(nS)
+    for i in range(horizon):
+        EV = transition_expectation(transition, V)
+        Q = reward.view(nS, 1) + discount * EV
+        V = _torch_logsumexp(Q, 1)
+    return (Q - V.view(nS, 1)).exp()
+
+def expected_counts_torch(policy, transition, initial_states, horizon,
+                          discount, method='iterate'):
+    """Same as expected_counts, but all arguments are torch tensors.
+       Supports methods 'iterate' and 'doubling'."""
+    nS = transition.shape[0]
+    if method == 'iterate':
+        counts = initial_states
+        total = initial_states.clone().double()  # sum in double precision
+        for i in range(1, horizon + 1):
+            weights = counts.view(nS, 1) * policy
+            counts = transition_propagate(transition, weights) * discount
+            total += counts.double()
+        total = total.to(initial_states.dtype)
+    elif method == 'doubling':
+        P = policy_transition(transition, policy)
+        eye = torch.eye(nS).type(P.type())
+        total = _power_sum(discount * P.t(), initial_states, horizon + 1, eye)
+    else:
+        raise ValueError("Unsupported method '{}'".format(method))
+    if discount == 1:
+        renorm = horizon + 1
+    else:
+        renorm = (1 - discount ** (horizon + 1)) / (1 - discount)
+    return total / renorm
+
+TORCH_PLANNERS = {
+    max_ent_policy: max_ent_policy_torch,
+    max_causal_ent_policy: max_causal_ent_policy_torch,
+}
+
+## Stateful planners
+
+class SoftValueIteration(object):
+    """Soft Q-iteration, warm-started from the value function of the previous
+       call, and stopping once the soft Bellman residual is below tol.
+       Consecutive calls in irl() have similar rewards, so after the first
+       call only a few backups are needed. Call reset() before planning in a
+       new MDP; irl() does this.
+
+       For discount < 1, this computes the infinite-horizon soft value
+       function, ignoring horizon. It is biased relative to
+       max_causal_ent_policy over horizon timesteps, and so are the
+       gradients of irl() with expected_counts over a finite horizon:
+         - truncation: the values differ by up to
+           discount ** horizon * (max|reward| + log(nA)) / (1 - discount);
+         - stopping: the values are within tol * discount / (1 - discount)
+           of the infinite-horizon soft values.
+       Use with counts_method='solve' in irl() for consistent
+       infinite-horizon counts. For discount = 1, this is the same as
+       max_causal_ent_policy, and is not warm-started.
+
+       Instances can be used as the planner in irl() with either engine.
+       Pass the class (rather than an instance) to irl() to construct a
+       fresh instance for each call."""
+    base_planner = staticmethod(max_causal_ent_policy)
+
+    def __init__(self, tol=1e-4, max_iter=10000):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.reset()
+
+    def reset(self):
+        self.V = None
+        self.num_iter = None
+
+    def __call__(self, transition, reward, horizon, discount):
+        use_torch = not isinstance(reward, np.ndarray)
+        if discount == 1:
+            self.num_iter = horizon
+            if use_torch:
+                return max_causal_ent_policy_torch(transition, reward,
+                                                   horizon, discount)
+            return max_causal_ent_policy(transition, reward, horizon, discount)
+
+        nS = transition.shape[0]
+        V = self.V
+        if V is None:
+            V = reward.new_zeros(nS) if use_torch else np.zeros(nS,
+                                                               reward.dtype)
+        for i in range(self.max_iter):
+            EV = transition_expectation(transition, V)
+            Q = reward.reshape(nS, 1) + discount * EV
+            if use_torch:
+                new_V = _torch_logsumexp(Q, 1)
+            else:
+                new_V = sp_lse(Q, axis=1)
+            residual = float(abs(new_V - V).max())
+            V = new_V
+            if residual < self.tol:
+                break
+        self.V = V
+        self.num_iter = i + 1
+
+        log_pol = Q - V.reshape(nS, 1)
+        return log_pol.exp() if use_torch else np.exp(log_pol)
+
+## Optimization
+
+class LBFGS(torch.optim.Optimizer):
+    """Full-batch L-BFGS, with a backtracking line search satisfying the
+       Armijo condition. (torch.optim.LBFGS takes fixed-size steps.)
+
+       step() must be passed a closure that recomputes the gradient of the
+       parameters and returns the objective, as a float. It may call the
+       closure several times. lr is the initial step size of the line search.
+       Only suitable for deterministic, convex-ish objectives, such as that
+       of MaxCausalEnt IRL.
+
+       The Armijo condition is evaluated on the change in objective implied
+       by the gradient: its integral along the step, by the trapezoidal rule.
+       In MaxCausalEnt IRL, the gradient (with a stationary policy) is not
+       exactly that of the objective, so a line search on the latter stalls
+       before the gradient vanishes. The trapezoidal rule may however accept
+       a step over which the objective rises, if the gradient varies sharply
+       along it. As a guard, a step is also rejected if the objective returned
+       by the closure rises by more than rise_tol * max(1, |objective|);
+       rise_tol is loose enough not to be triggered by the small mismatch
+       between gradient and objective. Set rise_tol to None to disable.
+
+       max_step optionally bounds the inf-norm of each step. Without
+       regularization, the IRL objective has no finite minimum if some states
+       are never visited, and unbounded steps lose numerical accuracy.
+
+       If the gradient is zero, or the line search fails even along the
+       steepest descent direction, the parameters are left unchanged and
+       converged is set to True. The latter happens once the gradient is
+       zero to within its numerical accuracy."""
+    def __init__(self, params, lr=1.0, history_size=10, max_backtracks=20,
+                 c1=1e-4, max_step=None, rise_tol=1e-3):
+        defaults = dict(lr=lr, history_size=history_size,
+                        max_backtracks=max_backtracks, c1=c1,
+                        max_step=max_step, rise_tol=rise_tol)
+        super(LBFGS, self).__init__(params, defaults)
+        self._params = [p for group in self.param_groups
+                        for p in group['params']]
+        self.converged = False
+
+    def _flat_grad(self):
+        return torch.cat([p.grad.data.reshape(-1) for p in self._params])
+
+    def _set_params(self, x):
+        offset = 0
+        for p in self._params:
+            n = p.data.numel()
+            p.data.copy_(x[offset:offset + n].view_as(p.data))
+            offset += n
+
+    def step(self, closure):
+        group = self.param_groups[0]
+        state = self.state[self._params[0]]
+        if 'loss' not in state:  # first step
+            state['loss'] = closure()
+            state['grad'] = self._flat_grad()
+            state['s'] = []
+            state['y'] = []
+        loss, g = state['loss'], state['grad']
+        ss, ys = state['s'], state['y']
+        if float(g.abs().max()) == 0:
+            self.converged = True
+            return loss
+
+        # Two-loop recursion: d = -H g
+        d = -g
+        alphas = []
+        for s, y in reversed(list(zip(ss, ys))):
+            alpha = s.dot(d) / y.dot(s)
+            d = d - alpha * y
+            alphas.append(alpha)
+        if ys:
+            d = d * (ss[-1].dot(ys[-1]) / ys[-1].dot(ys[-1]))
+        for (s, y), alpha in zip(zip(ss, ys), reversed(alphas)):
+            beta = y.dot(d) / y.dot(s)
+            d = d + (alpha - beta) * s
+        gtd = float(g.dot(d))
+        if gtd >= 0:  # not a descent direction: reset memory
+            del ss[:], ys[:]
+            d = -g
+            gtd = float(g.dot(d))
+
+        # Backtracking line search
+        t = group['lr']
+        if not ys:  # no curvature information: scale by gradient
+            t = min(t, 1.0 / float(g.abs().sum()))
+        if group['max_step'] is not None:
+            t = min(t, group['max_step'] / float(d.abs().max()))
+        x = torch.cat([p.data.reshape(-1) for p in self._params])
+        for i in range(group['max_backtracks']):
+            self._set_params(x + t * d)
+            new_loss = closure()
+            new_g = self._flat_grad()
+            change = 0.5 * t * (gtd + float(new_g.dot(d)))
+            rise_tol = group['rise_tol']
+            rose = (rise_tol is not None and
+                    new_loss - loss > rise_tol * max(1.0, abs(loss)))
+            if change <= group['c1'] * t * gtd and not rose:
+                break
+            t /= 2
+        else:  # line search failed: restore parameters
+            self._set_params(x)
+            state['loss'] = closure()
+            if ys:  # retry along steepest descent next step
+                del ss[:], ys[:]
+            else:
+                self.converged = True
+            return state['loss']
+
+        s, y = t * d, new_g - g
+        if float(y.dot(s)) > 1e-10:
+            ss.append(s)
+            ys.append(y)
+            if len(ss) > group['history_size']:
+                ss.pop(0)
+                ys.pop(0)
+        state['loss'], state['grad'] = new_loss, new_g
+        return new_loss
 
 default_optimizer = functools.partial(torch.optim.Adam, lr=1e-1)
+# Bound steps to 1 nat of reward per state: unregularized, the IRL objective
+# has no finite minimum if some states are never visited (see LBFGS).
+lbfgs_optimizer = functools.partial(LBFGS, max_step=1.0)
+lbfgs_scheduler = functools.partial(torch.optim.lr_scheduler.ExponentialLR,
+                                    gamma=1.0)
 default_scheduler = {
     max_ent_policy: functools.partial(
         torch.optim.lr_scheduler.ExponentialLR, gamma=1.0
@@ -89,14 +500,47 @@ default_scheduler = {
     ),
 }
 
+def _objective(policy, counts, reward, demo_counts):
+    """MaxCausalEnt IRL objective, whose gradient in reward is
+       counts - demo_counts. This is the expected soft value of the initial
+       state under policy (with counts the expected counts of policy) minus
+       the demonstrator's reward. Up to a constant, it is the negative
+       log-likelihood of demonstrations with visitation counts demo_counts."""
+    if isinstance(policy, np.ndarray):
+        log_policy = np.log(np.maximum(policy, 1e-30))
+    else:  # torch
+        log_policy = policy.clamp(min=1e-30).log()
+    entropy = -(policy * log_policy).sum(1)
+    return float(((reward + entropy) * counts).sum()
+                 - (reward * demo_counts).sum())
+
+@contextlib.contextmanager
+def _torch_num_threads(num_threads):
+    """Sets the number of threads torch may use, restoring it on exit.
+       Does nothing if num_threads is None."""
+    if num_threads is None:
+        yield
+        return
+    old_num_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(old_num_threads)
+
 def irl(mdp, trajectories, discount, seed=None, log_dir=None, demo_counts=None,
         horizon=None, planner=max_causal_ent_policy,
         regularize=None, common_reward=None, optimizer=None, scheduler=None,
-        num_iter=5000, log_every=100, log_expensive_every=1000):
+        num_iter=5000, log_every=100, log_loss_every=1000,
+        log_expensive_every=None,
+        grad_tol=None, reward_tol=None, loss_tol=None, patience=10,
+        counts_method='iterate',
+        engine='numpy', num_threads=None, init_reward=None, dtype='float64',
+        features=None):
     """
     Args:
         - mdp(TabularMdpEnv): MDP trajectories were drawn from.
-        - trajectories(list): expert trajectories; exclusive with demo_counts.
+        - trajectories(list): expert trajectories.
             List containing one (states, actions) pair for each trajectory,
             where states and actions are lists containing all visited
             states/actions in that trajectory.
@@ -104,81 +548,440 @@ def irl(mdp, trajectories, discount, seed=None, log_dir=None, demo_counts=None,
             Should match that of the agent generating the trajectories.
         - seed: ignored.
         - log_dir: ignored.
-        - demo_counts(array): expert visitation frequency; exclusive with trajectories.
+        - demo_counts(array): expert visitation frequency.
             The expected visitation frequency of the optimal policy.
-            Must supply horizon with this argument.
+            Must supply horizon with this argument. If trajectories is also
+            specified, must be their empirical_counts (e.g. precomputed by
+            TrajectoryCounts); trajectories are then only used for logging
+            and scaling regularize. At least one of trajectories and
+            demo_counts must be specified.
         - horizon(int): optional, must be supplied if demo_counts used.
-        - planner(callable): max_ent_policy or max_causal_ent_policy.
-        - regularize(float): regularization constant; requires common_reward.
+        - planner(callable): max_ent_policy, max_causal_ent_policy or
+            SoftValueIteration. If a class, it is instantiated.
+        - regularize(float or array): regularization constant; requires
+            common_reward. May be an array of length S, specifying a constant
+            for each state. If trajectories is specified, it is divided by
+            the number of trajectories; if demo_counts is specified, it is
+            used as-is.
         - common_reward(list): regularize reward to be close to this.
             Same type as the return of this funcion.
-            Argument is exclusive with demo_counts.
         - optimizer(callable): a callable returning a torch.optim object.
             The callable is called with an iterable of parameters to optimize.
+            Its step method is passed a closure evaluating the objective,
+            so optimizers with a line search, such as LBFGS, may be used.
         - scheduler(callable): a callable returning a torch.optim.lr_scheduler.
             The callable is called with a torch.optim optimizer object.
+            Defaults to a constant learning rate for LBFGS.
         - learning_rate(float): for Adam optimizer.
-        - num_iter(int): number of iterations of optimization process.
+        - num_iter(int): maximum number of iterations of optimization process.
+        - log_every(int): how often to record counts, gradients and rewards.
+        - log_loss_every(int): how often to record the loss (log-likelihood
+            of trajectories), if trajectories are specified.
+        - log_expensive_every(int): deprecated alias for log_loss_every.
+        - grad_tol(float): optional, stop once the inf-norm of the gradient
+            is below grad_tol for patience consecutive iterations.
+        - reward_tol(float): optional, stop once the relative change in reward,
+            max|r_new - r_old| / max(1, max|r_new|), is below reward_tol for
+            patience consecutive iterations.
+        - loss_tol(float): optional, stop once the relative change in the
+            loss, |l_new - l_old| / max(1, |l_new|), is below loss_tol for
+            patience consecutive iterations. Requires trajectories.
+        - patience(int): see grad_tol, reward_tol and loss_tol.
+        - counts_method(str): method argument to expected_counts.
+        - engine(str): 'numpy' or 'torch'.
+            With 'torch', the planner (the torch equivalent in TORCH_PLANNERS)
+            and expected counts operate on torch tensors, avoiding conversions
+            to and from NumPy on each iteration.
+        - num_threads(int): if specified, number of threads torch may use
+            while optimizing. Restored to its previous value on return.
+        - init_reward(array): optional, initial value of the reward, e.g. the
+            solution to a similar problem. Defaults to zero. Only reduces
+            runtime in combination with grad_tol or reward_tol.
+        - dtype(str): 'float64' or 'float32', precision of the planner and
+            expected counts. float32 halves the memory read by each planner
+            and expected counts pass over the transition tensor, roughly
+            doubling throughput on large MDPs, at the cost of small errors in
+            the reward. With the NumPy engine, the float32 transition is
+            cached by the MDP's CompiledMdp alongside the float64 original,
+            so is only converted once per MDP but does not reduce memory use.
+        - features(array): optional, S*d matrix of state features Phi.
+            If specified, learns a reward Phi theta linear in the features,
+            optimizing the d parameters theta. The gradient is then the
+            difference in feature expectations. init_reward, common_reward
+            and regularize are in terms of theta, and theta is returned in
+            place of the reward.
 
     Returns (reward, policy) where:
-        reward(list): estimated reward for each state in the MDP.
+        reward(list): estimated reward for each state in the MDP
+            (or theta, if features is specified).
         policy(array): array of dimensions S * A, describing a stochastic policy.
     """
-    assert sum([trajectories is None, demo_counts is None]) == 1
+    assert (trajectories is not None) or (demo_counts is not None)
+    assert (loss_tol is None) or (trajectories is not None)
     assert (regularize is None) ^ (common_reward is None) == 0
-    assert (regularize is None) or (demo_counts is None)
+    if log_expensive_every is not None:
+        warnings.warn('log_expensive_every is deprecated, '
+                      'use log_loss_every instead', DeprecationWarning)
+        log_loss_every = log_expensive_every
 
-    transition = getattr_unwrapped(mdp, 'transition')
+    transition = getattr_unwrapped(mdp, 'compiled')
     initial_states = getattr_unwrapped(mdp, 'initial_states')
     if horizon is None:
         horizon = getattr_unwrapped(mdp, '_max_episode_steps')
-    nS, _, _ = transition.shape
+    nS, nA, _ = transition.shape
 
     num_trajs = None
+    occurrences = None
     if trajectories is not None:
-        demo_counts = empirical_counts(nS, trajectories, discount)
+        if demo_counts is None:
+            demo_counts = empirical_counts(nS, trajectories, discount)
         num_trajs = len(trajectories)
+        occurrences = occurrence_counts(nS, nA, trajectories)
+    if init_reward is None:
+        num_params = nS if features is None else features.shape[1]
+        init_reward = np.zeros(num_params)
 
-    reward = Variable(torch.zeros(nS), requires_grad=True)
     if optimizer is None:
         optimizer = default_optimizer
-    if scheduler is None:
-        scheduler = default_scheduler[planner]
+    if isinstance(planner, type):  # fresh instance of stateful planner
+        planner = planner()
+    if hasattr(planner, 'reset'):  # stateful planner
+        planner.reset()
+    if scheduler is None:  # keyed by the NumPy planner
+        base_planner = getattr(planner, 'base_planner', planner)
+        planner_scheduler = default_scheduler[base_planner]
+
+    dtype = np.dtype(dtype)
+    assert dtype in [np.float32, np.float64]
+    if engine == 'numpy':
+        if dtype != np.float64:
+            transition = transition.astype(dtype)
+            initial_states = initial_states.astype(dtype)
+            if features is not None:
+                features = features.astype(dtype)
+        reward = Variable(torch.tensor(init_reward, dtype=torch.float32),
+                          requires_grad=True)
+        counts_fn = functools.partial(expected_counts, method=counts_method)
+        as_numpy = lambda x: x
+    elif engine == 'torch':
+        torch_dtype = {np.float32: torch.float32,
+                       np.float64: torch.float64}[dtype.type]
+        to_tensor = lambda x: torch.tensor(x, dtype=torch_dtype)
+        reward = Variable(to_tensor(init_reward), requires_grad=True)
+        transition = to_torch(transition, torch_dtype)
+        initial_states = to_tensor(initial_states)
+        demo_counts = to_tensor(demo_counts)
+        if common_reward is not None:
+            common_reward = to_tensor(common_reward)
+        if isinstance(regularize, np.ndarray):
+            regularize = to_tensor(regularize)
+        if occurrences is not None:
+            occurrences = to_tensor(occurrences)
+        if features is not None:
+            features = to_tensor(features)
+        # Planners without a torch equivalent must support torch themselves
+        planner = TORCH_PLANNERS.get(planner, planner)
+        counts_fn = functools.partial(expected_counts_torch,
+                                      method=counts_method)
+        as_numpy = lambda x: x.numpy()
+    else:
+        raise ValueError("Unknown engine '{}'".format(engine))
+    if occurrences is not None:  # find occurring pairs once, not every loss
+        occurrences = occurrence_index(occurrences)
     optimizer = optimizer([reward])
+    if scheduler is None:
+        if isinstance(optimizer, LBFGS):  # line search chooses step size
+            scheduler = lbfgs_scheduler
+        else:
+            scheduler = planner_scheduler
     scheduler = scheduler(optimizer)
 
-    it = TrainingIterator(num_iter, 'irl', heartbeat_iters=100)
-    for i in it:
-        pol = planner(transition, reward.data.numpy(), horizon, discount)
-        ec = expected_counts(pol, transition, initial_states, horizon, discount)
+    def closure():
+        """Computes policy and expected counts at the current reward,
+           sets the gradient of reward and returns the objective."""
+        nonlocal pol, ec
+        params = reward.data if engine == 'torch' else reward.data.numpy()
+        r = params if features is None else features @ params
+        pol = planner(transition, r, horizon, discount)
+        ec = counts_fn(pol, transition, initial_states, horizon, discount)
         optimizer.zero_grad()
 
         grad = ec - demo_counts
+        objective = _objective(pol, ec, r, demo_counts)
+        if features is not None:  # difference in feature expectations
+            grad = grad @ features
         if regularize is not None:  # optionally, regularize
-            delta = reward.data.numpy() - common_reward
-            if num_trajs > 0:
-                grad = grad + (regularize / num_trajs) * delta
-            else:
-                grad = delta
-        reward.grad = Variable(torch.Tensor(grad))
-        optimizer.step()
-        scheduler.step()
-
-        if trajectories is not None and i % log_expensive_every == 0:
-            # loss is expensive to compute
-            loss = policy_loss(pol, trajectories)
-            it.record('loss', loss)
-        if i % log_every == 0:
-            it.record('expected_counts', ec)
-            it.record('grads', reward.grad.data.numpy())
-            it.record('rewards', reward.data.numpy().copy())
+            delta = params - common_reward
+            if num_trajs is None:  # demo_counts: regularize already scaled
+                coef = regularize
+            elif num_trajs > 0:
+                coef = regularize / num_trajs
+            else:  # no trajectories: just match common_reward
+                grad, objective, coef = 0, 0, 1
+            grad = grad + coef * delta
+            objective += 0.5 * float((coef * delta * delta).sum())
+        if engine == 'numpy':
+            grad = torch.Tensor(grad)
+        reward.grad = Variable(grad)
+        return objective
+    pol, ec = None, None
+
+    stop_reason = 'num_iter'
+    tols = {'grad_tol': grad_tol, 'reward_tol': reward_tol,
+            'loss_tol': loss_tol}
+    tols = {k: v for k, v in tols.items() if v is not None}
+    converged_iters = {k: 0 for k in tols}
+    old_loss = None
+    num_iter_run = 0
+    with _torch_num_threads(num_threads):
+        it = TrainingIterator(num_iter, 'irl', heartbeat_iters=100)
+        for i in it:
+            num_iter_run = i + 1
+            if reward_tol is not None:
+                old_reward = reward.data.clone()
+            objective = optimizer.step(closure)
+            scheduler.step()
+            if getattr(optimizer, 'converged', False):
+                stop_reason = 'line_search'
+                break
+
+            if occurrences is not None and (i % log_loss_every == 0 or
+                                            loss_tol is not None):
+                loss = occurrence_loss(pol, occurrences)
+                if i % log_loss_every == 0:
+                    it.record('loss', loss)
+            if i % log_every == 0:
+                it.record('objective', objective)
+                it.record('expected_counts', as_numpy(ec))
+                it.record('grads', reward.grad.data.numpy())
+                it.record('rewards', reward.data.numpy().copy())
+
+            # Convergence checks
+            if tols:
+                errors = {}
+                if grad_tol is not None:
+                    errors['grad_tol'] = float(reward.grad.data.abs().max())
+                if reward_tol is not None:
+                    change = float((reward.data - old_reward).abs().max())
+                    scale = max(1.0, float(reward.data.abs().max()))
+                    errors['reward_tol'] = change / scale
+                if loss_tol is not None:
+                    if old_loss is not None:
+                        change = abs(loss - old_loss)
+                        errors['loss_tol'] = change / max(1.0, abs(loss))
+                    old_loss = loss
+                for k, err in errors.items():
+                    if err < tols[k]:
+                        converged_iters[k] += 1
+                    else:
+                        converged_iters[k] = 0
+                converged = [k for k, v in converged_iters.items()
+                             if v >= patience]
+                if converged:
+                    stop_reason = converged[0]
+                    break
+        if pol is None:  # num_iter is zero: policy for init_reward
+            closure()
+    it.record('num_iter', num_iter_run)
+    it.record('stop_reason', stop_reason)
 
     #TODO: log to disk (used to return it.vals, but this conflicts with new API)
-    return reward.data.numpy(), pol
+    return reward.data.numpy(), as_numpy(pol)
+
+
+def _features(mdp):
+    features = getattr_unwrapped(mdp, 'features')
+    assert features is not None, 'MDP does not specify features'
+    return features
+
+
+def linear_irl(mdp, trajectories, discount, seed=None, log_dir=None,
+               **kwargs):
+    """MaxCausalEnt IRL with a reward linear in the features of mdp.
+       Arguments are as for irl(), which is passed features; returns
+       (reward, policy) where reward is for each state, as irl()."""
+    features = _features(mdp)
+    theta, policy = irl(mdp, trajectories, discount, seed, log_dir,
+                        features=features, **kwargs)
+    return features @ theta, policy
+
+
+def _disjoint_union(mdps, demo_counts, horizon):
+    """Builds the disjoint union of mdps, with a block-diagonal transition
+       matrix, starting in each component MDP with equal probability.
+
+    Args:
+        - mdps(list<TabularMdpEnv>): MDPs, with the same state/action spaces.
+        - demo_counts(list<array>): demonstration counts for each MDP.
+        - horizon(int): optional, defaults to the MDPs' episode length.
+
+    Returns (union, demo_counts, horizon), where demo_counts are for union.
+    Note the counts in each block are scaled by 1 / len(mdps).
+    """
+    num_mdps = len(mdps)
+    transitions = [getattr_unwrapped(mdp, 'compiled') for mdp in mdps]
+    nS = transitions[0].shape[0]
+    if horizon is None:
+        horizons = set([getattr_unwrapped(mdp, '_max_episode_steps')
+                        for mdp in mdps])
+        assert len(horizons) == 1, 'MDPs must have same horizon'
+        horizon = horizons.pop()
+
+    transition = block_diagonal(transitions)
+    initial_states = [getattr_unwrapped(mdp, 'initial_states') for mdp in mdps]
+    initial_states = np.concatenate(initial_states) / num_mdps
+    demo_counts = np.concatenate(demo_counts) / num_mdps
+    union = TabularMdpEnv(transition, np.zeros(num_mdps * nS),
+                          initial_states, np.zeros(num_mdps * nS, dtype=bool))
+    return union, demo_counts, horizon
+
+
+def batched_irl(mdps, trajectories, discount, seed=None, log_dir=None,
+                horizon=None, linear=False, **kwargs):
+    """Runs IRL on several MDPs simultaneously. This is equivalent to calling
+       irl() on each MDP, but solves a single MDP: the disjoint union of
+       mdps, with a block-diagonal transition matrix. This amortizes Python
+       overhead over all MDPs.
+
+    Args:
+        - mdps(dict<TabularMdpEnv>): MDPs, with the same state/action spaces.
+        - trajectories(dict<list>): trajectories, as in metalearn.
+        - discount(float): between 0 and 1.
+        - seed: passed through to irl().
+        - log_dir: passed through to irl().
+        - horizon(int): optional, defaults to the MDPs' episode length.
+        - linear(bool): if True, learns a single reward parameter vector
+            theta for all MDPs, with the reward of each MDP linear in its
+            features. This is not equivalent to calling irl() on each MDP.
+        - kwargs: passed-through to irl(). Must not include demo_counts
+            or common_reward.
+
+    Returns a dict mapping keys of mdps to (reward, policy) pairs, as irl().
+    If linear, the reward is theta (the same for all MDPs).
+    """
+    keys = list(mdps.keys())
+    nS = getattr_unwrapped(mdps[keys[0]], 'transition').shape[0]
+    demo_counts = [empirical_counts(nS, trajectories[k], discount)
+                   for k in keys]
+    # The gradient in each block is scaled by 1 / len(mdps), which Adam
+    # is (up to its epsilon) invariant to.
+    union, demo_counts, horizon = _disjoint_union([mdps[k] for k in keys],
+                                                  demo_counts, horizon)
+
+    if linear:
+        features = np.concatenate([_features(mdps[k]) for k in keys])
+        theta, policy = irl(union, None, discount, seed, log_dir,
+                            demo_counts=demo_counts, horizon=horizon,
+                            features=features, **kwargs)
+        return {k: (theta, policy[i * nS:(i + 1) * nS])
+                for i, k in enumerate(keys)}
+
+    reward, policy = irl(union, None, discount, seed, log_dir,
+                         demo_counts=demo_counts, horizon=horizon, **kwargs)
+    return {k: (reward[i * nS:(i + 1) * nS], policy[i * nS:(i + 1) * nS])
+            for i, k in enumerate(keys)}
+
+
+def sweep_irl(mdp, trajectories, discount, regularize, common_reward,
+              seed=None, log_dir=None, horizon=None, **kwargs):
+    """Runs regularized IRL for several regularization constants
+       simultaneously. This optimizes the same objectives as calling irl()
+       once for each constant, but all the rewards together in a single
+       batched loop, on the disjoint union of copies of mdp (see batched_irl).
+
+       The gradient for each constant is that of irl() scaled by
+       1 / len(regularize). grad_tol is scaled to match, so it applies to
+       the unscaled gradient of each constant. However, stopping rules and
+       line searches act on the batch as a whole: results are not identical
+       to separate runs, except for Adam with a fixed num_iter (up to its
+       epsilon).
+
+    Args:
+        - mdp(TabularMdpEnv): MDP trajectories were drawn from.
+        - trajectories(list): expert trajectories, as in irl().
+        - discount(float): between 0 and 1.
+        - regularize(list<float>): regularization constants.
+        - common_reward(array): regularize reward to be close to this.
+        - seed: passed through to irl().
+        - log_dir: passed through to irl().
+        - horizon(int): optional, defaults to the MDP's episode length.
+        - kwargs: passed-through to irl(). Must not include demo_counts.
+
+    Returns a dict mapping each element of regularize to a (reward, policy)
+    pair, as irl().
+    """
+    regularize = list(regularize)
+    num_trajs = len(trajectories)
+    if num_trajs == 0:
+        # Reward is just common_reward, regardless of regularization.
+        res = irl(mdp, trajectories, discount, seed, log_dir,
+                  horizon=horizon, regularize=regularize[0],
+                  common_reward=common_reward, **kwargs)
+        return {reg: res for reg in regularize}
+
+    num_regs = len(regularize)
+    nS = getattr_unwrapped(mdp, 'transition').shape[0]
+    demo_counts = empirical_counts(nS, trajectories, discount)
+    union, demo_counts, horizon = _disjoint_union([mdp] * num_regs,
+                                                  [demo_counts] * num_regs,
+                                                  horizon)
+    # Scale regularization by 1 / num_regs to match the counts in each block,
+    # so the gradient in each block is that of irl(), scaled by 1 / num_regs.
+    union_reg = np.repeat(regularize, nS) / (num_trajs * num_regs)
+    union_common = np.tile(common_reward, num_regs)
+    if kwargs.get('grad_tol') is not None:
+        kwargs['grad_tol'] = kwargs['grad_tol'] / num_regs
+
+    reward, policy = irl(union, None, discount, seed, log_dir,
+                         demo_counts=demo_counts, horizon=horizon,
+                         regularize=union_reg, common_reward=union_common,
+                         **kwargs)
+    return {reg: (reward[i * nS:(i + 1) * nS], policy[i * nS:(i + 1) * nS])
+            for i, reg in enumerate(regularize)}
+
+
+def prefix_irl(mdp, trajectories, discount, ms, seed=None, log_dir=None,
+               warm_start=False, **kwargs):
+    """Runs irl() on trajectories[:m] for each m in ms. Demonstration counts
+       for all prefixes are computed from a single TrajectoryCounts index.
+
+    Args:
+        - mdp(TabularMdpEnv): MDP trajectories were drawn from.
+        - trajectories(list): expert trajectories, as in irl().
+        - discount(float): between 0 and 1.
+        - ms(list<int>): number of trajectories to use in each run.
+        - seed: passed through to irl().
+        - log_dir: passed through to irl().
+        - warm_start(bool): if True, initialize each run with the reward
+            learnt from the next smallest m. Only reduces runtime in
+            combination with the grad_tol or reward_tol arguments to irl(),
+            and when m is large enough that the rewards are well-determined:
+            otherwise, the previous reward may be a poor initialization.
+            Rewards that are not finite (e.g. from m = 0 without
+            regularization) are never used as an initialization.
+        - kwargs: passed-through to irl(). Must not include demo_counts
+            or init_reward.
+
+    Returns a dict mapping each element of ms to a (reward, policy) pair,
+    as irl(). For m = 0, this is the result of irl() with no trajectories.
+    """
+    nS = getattr_unwrapped(mdp, 'transition').shape[0]
+    index = TrajectoryCounts(nS, trajectories, discount)
+    res = {}
+    reward = None
+    for m in sorted(ms):
+        # No demonstrations: irl() handles this itself
+        demo_counts = index.counts(m) if m > 0 else None
+        res[m] = irl(mdp, trajectories[:m], discount, seed, log_dir,
+                     demo_counts=demo_counts,
+                     init_reward=reward if warm_start else None, **kwargs)
+        if np.all(np.isfinite(res[m][0])):
+            reward = res[m][0]
+    return res
 
 
 def metalearn(mdps, trajectories, discount, seed=None, log_dir=None,
-              regularize=None, **kwargs):
+              regularize=None, batched=False, linear=False, **kwargs):
     """
     Args:
         - mdps(dict<TabularMdpEnv)>): MDPs trajectories were drawn from.
@@ -194,21 +997,47 @@ def metalearn(mdps, trajectories, discount, seed=None, log_dir=None,
         - seed: passed through to irl().
         - log_dir: passed through to irl().
         - individual_reg(float): ignored (used by finetune).
+        - batched(bool): if True, learn rewards for all MDPs simultaneously
+            using batched_irl.
+        - linear(bool): if True, learn rewards linear in the features of
+            the MDPs, which must all have the same features. If batched is
+            also True, a single parameter vector is learnt for all MDPs.
         - kwargs: passed-through to irl().
 
-    Returns mean_reward, a list containing the estimate reward for each state.
+    Returns mean_reward, a list containing the estimate reward for each state
+    (or the mean parameters, if linear).
     """
-    res = {k: irl(mdp, trajectories[k], discount, seed, log_dir, **kwargs)
-           for k, mdp in mdps.items()}
+    if batched:
+        res = batched_irl(mdps, trajectories, discount, seed, log_dir,
+                          linear=linear, **kwargs)
+    else:
+        res = {k: irl(mdp, trajectories[k], discount, seed, log_dir,
+                      features=_features(mdp) if linear else None, **kwargs)
+               for k, mdp in mdps.items()}
     rewards = {k: r for k, (r, v) in res.items()}
     mean_reward = np.mean(list(rewards.values()), axis=0)
     return mean_reward
 
 
 def finetune(mean_reward, env_fns, trajectories, discount, seed=None,
-             log_dir=None, regularize=1e-2, **kwargs):
+             log_dir=None, regularize=1e-2, batched=False, linear=False,
+             **kwargs):
     """First argument is result of metalearn; individual_reg is regularization
-       factor; remaining arguments are passed-through to irl."""
+       factor; batched is ignored (used by metalearn); linear is as for
+       metalearn, regularizing the parameters; remaining arguments
+       are passed-through to irl.
+
+       If regularize is a list, runs a sweep over regularization factors
+       with sweep_irl, returning a dict mapping each factor to the
+       (reward, policy) pair."""
+    if isinstance(regularize, (list, tuple)):
+        assert not linear, 'sweeps not supported for linear rewards'
+        return sweep_irl(env_fns, trajectories, discount, regularize,
+                         mean_reward, seed, log_dir, **kwargs)
+    if linear:
+        return linear_irl(env_fns, trajectories, discount, seed, log_dir,
+                          common_reward=mean_reward, regularize=regularize,
+                          **kwargs)
     return irl(env_fns, trajectories, discount, seed, log_dir,
                common_reward=mean_reward, regularize=regularize,
                **kwargs)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import atexit
 import collections
 from distutils.dir_util import copy_tree
 import functools
@@ -30,6 +31,7 @@ def getattr_unwrapped(env, attr):
 
     Args:
         - env(gym.Wrapper or gym.Env): a (possibly wrapped) environment.
+            May also be a VecEnv, wrapped by VecEnvWrapper's.
         - attr: name of the attribute
 
     Returns:
@@ -38,11 +40,45 @@ def getattr_unwrapped(env, attr):
     try:
         return getattr(env, attr)
     except AttributeError:
+        if hasattr(env, 'venv'):  # VecEnvWrapper
+            return getattr_unwrapped(env.venv, attr)
         if env.env == env:
             raise
         else:
             return getattr_unwrapped(env.env, attr)
 
+_model_files = {}
+
+def _remove_model_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def cached_model_file(key, make_xml):
+    """Path to a file containing the XML model make_xml(), for MuJoCo
+       environments that generate their model. The file is written on the
+       first call with key, and reused by later calls in this process.
+
+    Args:
+        - key: hashable, uniquely identifying the model.
+        - make_xml(callable): returns the model as a str or bytes.
+
+    Returns:
+        path to the file, which is removed when the process exits.
+    """
+    try:
+        return _model_files[key]
+    except KeyError:
+        xml = make_xml()
+        mode = 'wb' if isinstance(xml, bytes) else 'w'
+        fd, path = tempfile.mkstemp(suffix='.xml', prefix='pirl_model_')
+        with os.fdopen(fd, mode) as f:
+            f.write(xml)
+        atexit.register(_remove_model_file, path)
+        _model_files[key] = path
+        return path
+
 # Randomness & sampling
 
 def create_seed(seed=None, max_bytes=8):
@@ -54,6 +90,63 @@ def discrete_sample(prob, rng):
        specifies class probabilities."""
     return (np.cumsum(prob) > rng.rand()).argmax()
 
+
+def rejection_sample(sample, accept, batch_size=64, max_batches=1000):
+    """Rejection sampling, testing candidates in batches.
+
+    Args:
+        - sample(callable): sample(n) returns an array of n candidates.
+        - accept(callable): accept(candidates) returns a boolean mask of
+            the acceptable candidates.
+        - batch_size(int): number of candidates to draw at once.
+        - max_batches(int): number of batches to try before falling back to
+            drawing candidates one at a time, so that rarely acceptable
+            candidates do not waste batch_size - 1 draws per attempt.
+
+    Returns:
+        the first acceptable candidate. Has the same distribution as drawing
+        candidates one at a time until one is acceptable. Like that, it
+        does not return if no candidate is ever acceptable.
+    """
+    for i in range(max_batches):
+        candidates = sample(batch_size)
+        ok = np.flatnonzero(accept(candidates))
+        if len(ok) > 0:
+            return candidates[ok[0]]
+    logger.warning('No acceptable sample in %d candidates: '
+                   'sampling one at a time', batch_size * max_batches)
+    while True:
+        candidate = sample(1)
+        if accept(candidate)[0]:
+            return candidate[0]
+
+
+def cumulative_table(prob):
+    """Table for sampling from many discrete distributions at once with
+       table_sample. The last axis of prob specifies class probabilities;
+       the other axes are flattened into rows of the table."""
+    K = prob.shape[-1]
+    cdf = np.cumsum(prob.reshape(-1, K), axis=1, dtype=np.float64)
+    # Offset row i by i, so the whole table is sorted and a single call
+    # to searchsorted can look up many rows.
+    return cdf + np.arange(cdf.shape[0]).reshape(-1, 1)
+
+
+def table_sample(table, rows, u):
+    """Sample a class from each of the given rows of a cumulative_table.
+
+    Args:
+        - table(array): table from cumulative_table.
+        - rows(int array): row to sample from for each sample.
+        - u(array): uniform samples in [0, 1), of the same shape as rows.
+
+    Returns:
+        int array of classes, of the same shape as rows."""
+    K = table.shape[1]
+    idx = np.searchsorted(table.ravel(), rows + u, side='right') - rows * K
+    # Guard against rounding error in the last element of the CDF
+    return np.minimum(idx, K - 1)
+
 # Modified from https://stackoverflow.com/questions/2257441/random-string-generation-with-upper-case-letters-and-digits-in-python
 def id_generator(size=8):
     choices = random.choices(string.ascii_uppercase + string.digits, k=size)
@@ -133,6 +226,7 @@ class TrainingIterator(object):
         self._h_iters = heartbeat_iters
         self._h_time = heartbeat_time
         self._last_h_time = time.time()
+        self._i = 0
         self._vals = {}
 
     @property
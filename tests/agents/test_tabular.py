@@ -0,0 +1,207 @@
+import itertools
+import pytest
+
+from baselines import bench
+import gym
+import numpy as np
+
+from pirl.agents import sample, tabular
+from pirl.envs import tabular_mdp
+from pirl.irl import tabular_maxent
+
+@pytest.mark.parametrize("discount", [1.00, 0.99, 0.9])
+def test_policy_evaluation(discount):
+    """Tests policy_evaluation agrees with iterative evaluation by
+       q_iteration, and value_in_mdp with the value it reported when
+       computed by q_iteration."""
+    env = gym.make('pirl/GridWorld-Jungle-9x9-Soda-v0')
+    transition = env.unwrapped.transition
+    reward = env.unwrapped.reward
+    horizon = env._max_episode_steps
+    policy = tabular.policy_env_wrapper(tabular_maxent.max_causal_ent_policy)(
+        env, discount, None, None)
+
+    Q, _ = tabular.q_iteration(transition, reward, horizon, discount,
+                               policy=policy, max_error=1e-12)
+    expected = np.sum(policy * Q, axis=1)
+    V, info = tabular.policy_evaluation(transition, reward, policy, horizon,
+                                        discount, method='recurse')
+    assert info['method'] == 'recurse'
+    assert np.allclose(V, expected)
+    # Sparse transitions
+    sparse = tabular_mdp.CompiledMdp(transition, sparse=True)
+    V, _ = tabular.policy_evaluation(sparse, reward, policy, horizon, discount)
+    assert np.allclose(V, expected)
+
+    # value_in_mdp reports the same quantity as before policy_evaluation:
+    # the Q-values of q_iteration summed over actions
+    value, se, info = tabular.value_in_mdp(env, policy, discount, seed=0,
+                                           return_info=True)
+    assert se == 0
+    old_value = np.sum(Q.sum(1) * env.unwrapped.initial_states)
+    assert value == pytest.approx(old_value)
+    assert info['error'] < 1e-5
+    assert tabular.value_in_mdp(env, policy, discount, seed=0) == (value, 0)
+
+    if discount < 1:
+        # Infinite horizon: compare against a horizon long enough that
+        # truncation is negligible
+        long_horizon = int(np.log(1e-12) / np.log(discount))
+        Q, _ = tabular.q_iteration(transition, reward, long_horizon, discount,
+                                   policy=policy, max_error=1e-12)
+        expected = np.sum(policy * Q, axis=1)
+        V, info = tabular.policy_evaluation(transition, reward, policy, None,
+                                            discount, method='solve')
+        assert info['method'] == 'solve'
+        assert np.allclose(V, expected)
+
+
+@pytest.mark.parametrize("discount,num_eval_sweeps",
+                         itertools.product([0.99, 0.9], [None, 1, 10]))
+def test_policy_iteration(discount, num_eval_sweeps):
+    """Tests (modified) policy iteration finds the optimal infinite-horizon
+       Q-values, computed by value iteration over a horizon long enough
+       that truncation is negligible."""
+    env = gym.make('pirl/GridWorld-Jungle-9x9-Soda-v0')
+    T = env.unwrapped.compiled
+    R = env.unwrapped.reward
+    Q, info = tabular.policy_iteration(T, R, discount, num_eval_sweeps)
+    assert info['converged']
+
+    long_horizon = int(np.log(1e-12) / np.log(discount))
+    expected, _ = tabular.q_iteration(T, R, long_horizon, discount,
+                                      max_error=1e-10)
+    assert np.allclose(Q, expected)
+
+
+def test_policy_iteration_nonstationary():
+    """Tests policy iteration on an MDP whose optimal finite-horizon policy
+       is not stationary. From state 0, action 0 stays in state 0 (reward 1);
+       action 1 moves to state 1 (reward 0) and then to the absorbing state
+       2 (reward 3). Moving is optimal over a long horizon, but staying is
+       optimal with two timesteps to go. Policy iteration must agree with
+       value iteration over a long horizon."""
+    T = np.zeros((3, 2, 3))
+    T[0, 0, 0] = T[0, 1, 1] = 1
+    T[1, :, 2] = T[2, :, 2] = 1
+    R = np.array([1.0, 0.0, 3.0])
+    discount = 0.9
+
+    Q, info = tabular.policy_iteration(T, R, discount)
+    assert info['converged']
+    policy = tabular.get_policy(Q)
+    assert policy[0, 1] == 1
+
+    expected, _ = tabular.q_iteration(T, R, 1000, discount, max_error=1e-10)
+    assert np.allclose(Q, expected)
+    short_policy = tabular.q_iteration_policy(T, R, 2, discount)
+    assert short_policy[0, 0] == 1
+
+    with pytest.raises(AssertionError):
+        tabular.policy_iteration(T, R, 1.00)
+
+
+def test_sample():
+    """Tests batched sample agrees in distribution with stepping the
+       environment, and records episodes in the Monitor."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    env = bench.Monitor(env, None, allow_early_resets=True)
+    num_states = env.observation_space.n
+    policy = tabular.policy_env_wrapper(tabular_maxent.max_causal_ent_policy)(
+        env, 0.9, None, None)
+    num_episodes = 2000
+
+    def stats(trajectories):
+        returns = [np.sum(r) for (s, a, r) in trajectories]
+        lengths = [len(s) for (s, a, r) in trajectories]
+        states = np.concatenate([s for (s, a, r) in trajectories])
+        visits = np.bincount(states, minlength=num_states) / num_episodes
+        return np.mean(returns), np.mean(lengths), visits
+
+    trajectories = tabular.sample(env, policy, num_episodes, seed=0)
+    assert env.get_episode_rewards() == pytest.approx(
+        [np.sum(r) for (s, a, r) in trajectories])
+    assert env.get_episode_lengths() == [len(s) for (s, a, r) in trajectories]
+    batched = stats(trajectories)
+
+    env.seed(0)
+    rng = np.random.RandomState(0)
+    trajectories = []
+    for _i in range(num_episodes):
+        states, actions, rewards = [], [], []
+        state = env.reset()
+        done = False
+        while not done:
+            action = rng.choice(policy.shape[1], p=policy[state])
+            states.append(state)
+            actions.append(action)
+            state, reward, done, _ = env.step(action)
+            rewards.append(reward)
+        trajectories.append((np.array(states), np.array(actions),
+                             np.array(rewards)))
+    scalar = stats(trajectories)
+
+    assert batched[0] == pytest.approx(scalar[0], rel=0.05, abs=0.1)
+    assert batched[1] == pytest.approx(scalar[1], rel=0.05)
+    assert np.allclose(batched[2], scalar[2], rtol=0.1, atol=0.1)
+
+
+def test_vec_env():
+    """Tests TabularMdpVecEnv agrees in distribution with TabularMdpEnv,
+       and VecMonitor records its episodes."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    env.seed(0)
+    num_states = env.observation_space.n
+    num_actions = env.action_space.n
+    horizon = env._max_episode_steps
+    num_envs = 50
+    num_steps = 4 * horizon
+    rng = np.random.RandomState(0)
+
+    def stats(transitions):
+        counts = np.zeros((num_states, num_actions, num_states))
+        for s, a, next_s, r in transitions:
+            np.add.at(counts, (s, a, next_s), 1)
+            assert np.all(r == env.unwrapped.reward[next_s])
+        return counts / np.sum(counts)
+
+    monitors = [bench.Monitor(env, None, allow_early_resets=True)
+                for _i in range(num_envs)]
+    venv = sample.VecMonitor(tabular.TabularMdpVecEnv(env, num_envs, seed=0),
+                             monitors)
+    states = venv.reset()
+    transitions = []
+    for t in range(num_steps):
+        actions = rng.randint(num_actions, size=num_envs)
+        obs, rewards, dones, infos = venv.step(actions)
+        next_states = venv.venv.next_states
+        transitions.append((states, actions, next_states, rewards))
+        states = obs
+    vec_counts = stats(transitions)
+    for m in monitors:
+        assert m.get_episode_lengths() == [horizon] * (num_steps // horizon)
+    assert [info['episode']['l'] for info in infos] == [horizon] * num_envs
+    total_reward = np.sum([r for (s, a, next_s, r) in transitions])
+    assert np.sum([m.get_episode_rewards() for m in monitors]) == \
+        pytest.approx(total_reward)
+
+    transitions = []
+    state = env.reset()
+    for t in range(num_envs * num_steps):
+        action = rng.randint(num_actions)
+        next_state, reward, done, _ = env.step(action)
+        transitions.append(([state], [action], [next_state], [reward]))
+        state = env.reset() if done else next_state
+    counts = stats(transitions)
+
+    # Visitation frequencies agree, and transition frequencies agree with
+    # the dynamics wherever there is enough data to estimate them
+    transition = env.unwrapped.transition
+    assert np.allclose(np.sum(vec_counts, axis=(1, 2)),
+                       np.sum(counts, axis=(1, 2)), atol=0.01)
+    for c in [vec_counts, counts]:
+        visits = np.sum(c, axis=2, keepdims=True)
+        visited = visits[:, :, 0] * num_envs * num_steps > 200
+        estimate = c / np.maximum(visits, 1e-12)
+        assert np.any(visited)
+        assert np.allclose(estimate[visited], transition[visited], atol=0.1)
@@ -0,0 +1,35 @@
+import pytest
+
+from pirl import config
+from pirl.config import types
+
+def _parse(**kwargs):
+    cfg = {
+        'environments': ['pirl/GridWorld-Jungle-4x4-Liquid-v0'],
+        'expert': 'value_iteration',
+        'eval': ['value_iteration'],
+        'irl': ['mce'],
+        'test_trajectories': [10],
+    }
+    cfg.update(kwargs)
+    return types.parse_config('test', cfg,
+                              config.RL_ALGORITHMS,
+                              config.SINGLE_IRL_ALGORITHMS,
+                              config.POPULATION_IRL_ALGORITHMS,
+                              config.INFINITE_HORIZON_RL_ALGORITHMS)
+
+@pytest.mark.parametrize("rl", sorted(config.INFINITE_HORIZON_RL_ALGORITHMS))
+def test_infinite_horizon_rl(rl):
+    """Tests RL algorithms optimal over an infinite horizon are rejected
+       as expert or eval without discounting, and accepted with it."""
+    for fld in ['expert', 'eval']:
+        value = rl if fld == 'expert' else [rl]
+        with pytest.raises(ValueError, match='requires discount < 1'):
+            _parse(discount=1.00, **{fld: value})
+        res = _parse(discount=0.99, **{fld: value})
+        assert res['discount'] == 0.99
+
+def test_unregistered_environment():
+    """Tests unregistered environments are rejected."""
+    with pytest.raises(ValueError, match='Unregistered environment'):
+        _parse(environments=['pirl/GridWorld-Jungle-5x5-Soda-v0'])
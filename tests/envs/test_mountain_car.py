@@ -0,0 +1,104 @@
+import pytest
+
+from baselines import bench
+import gym
+import numpy as np
+
+from pirl.agents.sample import VecMonitor
+from pirl.envs.mountain_car import ContinuousMountainCarPopulationVecEnv
+
+ENV_NAMES = ['pirl/MountainCarContinuous-2-left-0.1-0.1-v0',
+             'pirl/MountainCarContinuous-3-right-target-0.5-0.25-v0',
+             'pirl/MountainCarContinuous-3-random-0.5-0.25-v0',
+             'pirl/MountainCarContinuous-2-red-1-0.05-v0']
+
+
+def _sync(env, venv, i):
+    """Sets the state of env to that of car i in venv."""
+    env = env.unwrapped
+    env.goal_position = venv.goal_position[i].copy()
+    env.state = venv._obs()[i]
+
+
+@pytest.mark.parametrize("env_name", ENV_NAMES)
+def test_vec_env_step(env_name):
+    """Tests each car in the VecEnv takes the same steps as the scalar env,
+       and cars are reset when they reach a goal or time out."""
+    num_envs = 8
+    env = gym.make(env_name)
+    horizon = env._max_episode_steps
+    venv = ContinuousMountainCarPopulationVecEnv(env, num_envs, seed=0)
+    scalar_envs = [gym.make(env_name) for _i in range(num_envs)]
+    for i, e in enumerate(scalar_envs):
+        e.reset()
+        _sync(e, venv, i)
+    rng = np.random.RandomState(0)
+
+    num_done = 0
+    for t in range(2 * horizon):
+        # Push hard enough that some cars reach a goal
+        actions = rng.uniform(-1, 1, size=(num_envs, 1))
+        actions += np.sign(np.sin(t * np.pi / 50)).reshape(-1, 1)
+        obs, rewards, dones, infos = venv.step(actions)
+        for i, e in enumerate(scalar_envs):
+            e_obs, e_reward, e_done, _ = e.step(actions[i])
+            assert e_reward == pytest.approx(rewards[i])
+            assert e_done == dones[i]
+            if e_done:
+                num_done += 1
+                # obs is the initial observation of the next episode
+                assert obs[i, 1] == 0
+                assert venv._elapsed[i] == 0
+                e.reset()
+                _sync(e, venv, i)
+            else:
+                assert np.allclose(e_obs, obs[i])
+    assert num_done > 0
+
+
+def test_vec_env_timeout():
+    """Tests cars that never reach a goal are reset after _max_episode_steps,
+       and VecMonitor records their episodes."""
+    env = gym.make('pirl/MountainCarContinuous-2-red-1-0.05-v0')
+    horizon = env._max_episode_steps
+    num_envs = 4
+    monitors = [bench.Monitor(env, None, allow_early_resets=True)
+                for _i in range(num_envs)]
+    venv = ContinuousMountainCarPopulationVecEnv(env, num_envs, seed=0)
+    venv = VecMonitor(venv, monitors)
+    venv.reset()
+    actions = np.zeros((num_envs, 1))
+    for t in range(horizon - 1):
+        obs, rewards, dones, infos = venv.step(actions)
+        assert not np.any(dones)
+    obs, rewards, dones, infos = venv.step(actions)
+    assert np.all(dones)
+    assert np.all(venv.venv._elapsed == 0)
+    assert np.all(obs[:, 1] == 0)
+    assert np.all(np.abs(obs[:, 0] - 0.5) <= 0.05)
+    for m, info in zip(monitors, infos):
+        assert m.get_episode_lengths() == [horizon]
+        assert info['episode']['l'] == horizon
+
+
+@pytest.mark.parametrize("env_name", ENV_NAMES)
+def test_vec_env_goals(env_name):
+    """Tests goal positions after reset have the same distribution as in
+       the scalar env."""
+    num_envs = 2000
+    env = gym.make(env_name)
+    venv = ContinuousMountainCarPopulationVecEnv(env, num_envs, seed=0)
+    vec_goals = venv.goal_position
+
+    np.random.seed(0)
+    scalar_goals = []
+    for _i in range(num_envs):
+        env.reset()
+        scalar_goals.append(env.unwrapped.goal_position)
+    scalar_goals = np.array(scalar_goals)
+
+    assert vec_goals.shape == scalar_goals.shape
+    vec_values, vec_counts = np.unique(vec_goals, axis=0, return_counts=True)
+    values, counts = np.unique(scalar_goals, axis=0, return_counts=True)
+    assert np.array_equal(vec_values, values)
+    assert np.allclose(vec_counts / num_envs, counts / num_envs, atol=0.05)
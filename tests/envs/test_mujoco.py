@@ -0,0 +1,71 @@
+import pytest
+
+import gym
+import numpy as np
+
+from pirl import utils
+
+pytest.importorskip('mujoco_py')
+
+@pytest.mark.parametrize("env_name", ['pirl/ReacherWall-seed0-50-0.1-v0',
+                                      'pirl/ReacherWall-nowall-50-0.1-v0',
+                                      'pirl/Billiards2-seed0-v0'])
+def test_model_file_shared(env_name):
+    """Tests instances with the same parameters share one model file."""
+    env = gym.make(env_name)
+    paths = set(utils._model_files.values())
+    other_env = gym.make(env_name)
+    assert set(utils._model_files.values()) == paths
+    env.close()
+    other_env.close()
+
+def _old_accept_goal(goal, wall_angle):
+    """Scalar acceptance condition for goals, before batching."""
+    within_armspan = np.linalg.norm(goal) < .2
+    goal_angle = np.arctan2(goal[1], goal[0])
+    outside_wall = np.abs(goal_angle - wall_angle) > 0.25
+    return within_armspan and outside_wall
+
+def _old_accept_arm(arm_pos, wall_angle):
+    """Scalar acceptance condition for arm positions, before batching."""
+    arm_delta = arm_pos[0] - wall_angle
+
+    arm_theta = np.cumsum(arm_pos)
+    finger_xpos = np.sum([np.cos(arm_theta), np.sin(arm_theta)], axis=1)
+    finger_angle = np.arctan2(finger_xpos[1], finger_xpos[0])
+    finger_delta = finger_angle - wall_angle
+
+    arm_outside = np.abs(arm_delta) > 0.05
+    finger_outside = np.abs(finger_delta) > 0.05
+    intersects = np.sign([arm_delta, finger_delta]).prod() == -1
+    return arm_outside and finger_outside and not intersects
+
+@pytest.mark.parametrize("wall_angle", [-3, -0.5, 0, 0.1, 2])
+def test_reacher_wall_accept(wall_angle):
+    """Tests batched acceptance tests agree with the old scalar conditions."""
+    from pirl.envs import reacher_wall
+    rng = np.random.RandomState(0)
+
+    goal = rng.uniform(low=-.2, high=.2, size=(1000, 2))
+    expected = [_old_accept_goal(g, wall_angle) for g in goal]
+    assert np.array_equal(reacher_wall.accept_goal(goal, wall_angle), expected)
+
+    arm_pos = rng.uniform(low=-np.pi, high=np.pi, size=(1000, 2))
+    # Include the edges of the excluded sectors
+    arm_pos[:10, 0] = wall_angle + np.linspace(-0.1, 0.1, 10)
+    expected = [_old_accept_arm(a, wall_angle) for a in arm_pos]
+    assert np.array_equal(reacher_wall.accept_arm(arm_pos, wall_angle),
+                          expected)
+
+def test_billiards_random_pos():
+    """Tests random_pos satisfies the old conditions on ball positions."""
+    from pirl.envs import billiards
+    rng = np.random.RandomState(0)
+    gap = 0.105
+    for n in range(1, 6):
+        points = billiards.random_pos(n, gap, rng)
+        assert points.shape == (n, 2)
+        assert np.all(points >= gap / 2) and np.all(points <= 1 - gap / 2)
+        for i in range(n):
+            for j in range(i):
+                assert np.linalg.norm(points[i] - points[j]) >= gap
@@ -0,0 +1,79 @@
+import itertools
+import pytest
+
+import gym
+import numpy as np
+
+from pirl import envs
+from pirl.envs import gridworld
+
+def _jungle_ids():
+    for scale, kind in itertools.product(['9x9', '4x4'],
+                                         ['Soda', 'Water', 'Liquid']):
+        yield 'pirl/GridWorld-Jungle-{}-{}-v0'.format(scale, kind)
+
+def _old_ids():
+    """IDs registered at import, one per member of each family."""
+    yield 'pirl/GridWorld-Simple-v0'
+    yield 'pirl/GridWorld-Simple-Deterministic-v0'
+    yield from _jungle_ids()
+    for size, kind, seed in itertools.product([16, 32, 64, 128],
+                                              ['Soda', 'Water', 'Liquid'],
+                                              range(5)):
+        yield 'pirl/GridWorld-Jungle-Procedural-{0}x{0}-{1}-seed{2}-v0'.format(
+            size, kind, seed)
+    goals = ['left', 'right', 'random', 'left-target', 'right-target',
+             'red', 'blue']
+    for num_peaks, goal, vel_penalty, initial_noise in itertools.product(
+            [2, 3, 4], goals, [0, 0.1, 0.5, 1], [0.05, 0.1, 0.25]):
+        yield 'pirl/MountainCarContinuous-{}-{}-{}-{}-v0'.format(
+            num_peaks, goal, vel_penalty, initial_noise)
+    for start_variance, seed in itertools.product([0.1, 0.5, 1.0], range(10)):
+        yield 'pirl/ReacherGoal-seed{}-{}-v0'.format(seed, start_variance)
+        for steps in [50, 100]:
+            yield 'pirl/ReacherWall-seed{}-{}-{}-v0'.format(
+                seed, steps, start_variance)
+    for steps, start_variance in itertools.product([50, 100],
+                                                   [0.1, 0.5, 1.0]):
+        yield 'pirl/ReacherWall-nowall-{}-{}-v0'.format(steps, start_variance)
+    for seed, num_balls in itertools.product(range(10), range(1, 5)):
+        yield 'pirl/Billiards{}-seed{}-v0'.format(num_balls, seed)
+    yield 'pirl/SeaquestPopulation-v0'
+
+def test_old_ids():
+    """Tests every previously registered ID is registered with gym, and
+       listed by registry.all()."""
+    ids = list(_old_ids())
+    assert len(ids) == 457
+    all_ids = set(spec.id for spec in gym.envs.registry.all())
+    for id in ids:
+        assert envs.is_registered(id)
+        assert id in all_ids
+        assert gym.envs.registry.spec(id).id == id
+        if 'GridWorld' in id or 'MountainCar' in id:
+            assert id in envs.vec_envs
+
+@pytest.mark.parametrize("id", [
+    'pirl/GridWorld-Jungle-5x5-Soda-v0',
+    'pirl/GridWorld-Jungle-Procedural-16x32-Soda-seed0-v0',
+    'pirl/MountainCarContinuous-5-left-0-0.05-v0',
+    'pirl/ReacherGoal-seed0-0x1-v0',
+    'pirl/ReacherGoal-seed0-0.1-v0-extra',
+    'pirl/Billiards1Xseed0-v0',
+])
+def test_unknown_ids(id):
+    """Tests IDs not in any family are not registered."""
+    assert not envs.is_registered(id)
+    with pytest.raises(gym.error.Error):
+        gym.envs.registry.spec(id)
+
+@pytest.mark.parametrize("id", list(_jungle_ids()))
+def test_jungle(id):
+    """Tests Jungle environments built at make time match their topology."""
+    scale, kind = id.split('-')[2:4]
+    topology = envs.jungle_topology[scale]
+    env = gym.make(id)
+    assert np.array_equal(env.unwrapped.reward,
+                          gridworld.jungle_reward(topology, kind).flatten())
+    assert np.array_equal(env.unwrapped.initial_states,
+                          gridworld.create_initial_state(topology).flatten())
@@ -0,0 +1,49 @@
+import pytest
+
+import numpy as np
+
+pytest.importorskip('atari_py')
+
+from pirl.envs import seaquest
+
+def _old_submarine_count(image):
+    """Count of submarines with np.unique, before counting packed pixels."""
+    values, counts = np.unique(image.reshape([-1, 3]), return_counts=True,
+                               axis=0)
+    count = counts[np.where(np.all(values == seaquest.SUB_COLOR, axis=1))[0]]
+    count = count // 45
+    return 0 if len(count) < 1 else count[0]
+
+def _frame(rng, num_pixels):
+    """Synthetic 210*160 frame with num_pixels pixels of SUB_COLOR, and
+       colours differing from it in one channel."""
+    image = rng.randint(0, 256, size=(210, 160, 3)).astype(np.uint8)
+    flat = image.reshape(-1, 3)
+    flat[np.all(flat == seaquest.SUB_COLOR, axis=1)] = 0
+    flat[rng.choice(210 * 160, 300, replace=False)] = [170, 170, 171]
+    flat[rng.choice(210 * 160, num_pixels, replace=False)] = seaquest.SUB_COLOR
+    return image
+
+@pytest.mark.parametrize("num_pixels", [0, 44, 45, 100, 135, 180])
+def test_submarine_count(num_pixels):
+    """Tests submarine_count agrees with counting by np.unique."""
+    rng = np.random.RandomState(num_pixels)
+    image = _frame(rng, num_pixels)
+    expected = _old_submarine_count(image)
+    assert expected == num_pixels // 45
+    assert seaquest.submarine_count(image) == expected
+    # Cached
+    assert seaquest.submarine_count(image) == expected
+
+def test_submarine_killed():
+    """Tests a kill is detected when one submarine disappears."""
+    rng = np.random.RandomState(0)
+    frames = [_frame(rng, n) for n in [135, 90, 90, 45, 90]]
+    killed = [seaquest.submarine_killed(prev, image)
+              for prev, image in zip(frames[:-1], frames[1:])]
+    assert killed == [True, False, True, False]
+
+def test_identity_reward():
+    """Tests identity_reward accepts the arguments step passes."""
+    state = {'prev_ram': None, 'prev_image': None, 'prev_lives': 3}
+    assert seaquest.identity_reward(None, 20, None, 0, 3, state) == 20
@@ -3,14 +3,24 @@ import pytest
 
 import gym
 import numpy as np
+import torch
 
 from pirl import experiments
 from pirl.agents import tabular
+from pirl.envs import tabular_mdp
 from pirl.irl import tabular_maxent
 
 def demean(x):
     return x - np.mean(x)
 
+def expert_trajectories(env, discount, num_trajectories=20, seed=0):
+    """Samples (states, actions) trajectories in env from the
+       MaxCausalEnt policy for its reward."""
+    policy = tabular.policy_env_wrapper(tabular_maxent.max_causal_ent_policy)(
+        env, discount, None, None)
+    samples = tabular.sample(env, policy, num_trajectories, seed)
+    return [(s, a) for s, a, _ in samples]
+
 @pytest.mark.parametrize("env_name,planner,discount",
     itertools.product(
         ['pirl/GridWorld-Jungle-4x4-Liquid-v0'],
@@ -87,3 +97,489 @@ def test_irl(env_name, planner, discount):
                                         num_iter=num_iter)
     check_reward(traj_reward, *thresholds[planner]['traj'])
 
+
+
+@pytest.mark.parametrize("env_name,discount",
+    itertools.product(
+        ['pirl/GridWorld-Jungle-4x4-Liquid-v0',
+         'pirl/GridWorld-Jungle-9x9-Soda-v0'],
+        [1.00, 0.9],
+    )
+)
+def test_sparse_transition(env_name, discount):
+    """Tests planners and expected_counts give the same result for dense,
+       sparse and compiled representations of the transition matrix."""
+    env = gym.make(env_name)
+    transition = env.unwrapped.transition
+    sparse = tabular_mdp.SparseTransition.from_dense(transition)
+    assert np.all(sparse.todense() == transition)
+
+    reward = env.unwrapped.reward
+    initial_states = env.unwrapped.initial_states
+    horizon = env._max_episode_steps
+    for planner in [tabular_maxent.max_causal_ent_policy,
+                    tabular_maxent.max_ent_policy]:
+        dense_pol = planner(transition, reward, horizon, discount)
+        sparse_pol = planner(sparse, reward, horizon, discount)
+        assert np.allclose(dense_pol, sparse_pol)
+        for is_sparse in [False, True]:
+            compiled = tabular_mdp.CompiledMdp(transition, sparse=is_sparse)
+            assert compiled.sparse == is_sparse
+            compiled_pol = planner(compiled, reward, horizon, discount)
+            assert np.allclose(dense_pol, compiled_pol)
+
+        dense_counts = tabular_maxent.expected_counts(
+            dense_pol, transition, initial_states, horizon, discount)
+        sparse_counts = tabular_maxent.expected_counts(
+            dense_pol, sparse, initial_states, horizon, discount)
+        assert np.allclose(dense_counts, sparse_counts)
+
+
+@pytest.mark.parametrize("discount", [1.00, 0.9])
+def test_torch_engine(discount):
+    """Tests the torch engine agrees with the NumPy engine."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    transition = env.unwrapped.transition
+    initial_states = env.unwrapped.initial_states
+    reward = env.unwrapped.reward
+    horizon = env._max_episode_steps
+
+    # Planners and forward pass
+    torch_transition = tabular_maxent.to_torch(transition)
+    torch_initial_states = torch.from_numpy(initial_states).double()
+    torch_reward = torch.from_numpy(reward).double()
+    for planner, torch_planner in tabular_maxent.TORCH_PLANNERS.items():
+        pol = planner(transition, reward, horizon, discount)
+        torch_pol = torch_planner(torch_transition, torch_reward,
+                                  horizon, discount)
+        assert np.allclose(pol, torch_pol.numpy())
+
+        counts = tabular_maxent.expected_counts(pol, transition, initial_states,
+                                                horizon, discount)
+        torch_counts = tabular_maxent.expected_counts_torch(
+            torch_pol, torch_transition, torch_initial_states,
+            horizon, discount)
+        assert np.allclose(counts, torch_counts.numpy())
+
+    # IRL. (Only for max_causal_ent_policy: Adam oscillates for
+    # max_ent_policy, so small numerical differences get amplified.)
+    rewards = {}
+    for engine in ['numpy', 'torch']:
+        rewards[engine], _ = tabular_maxent.irl(env, trajectories=None,
+                                                discount=discount,
+                                                demo_counts=counts,
+                                                horizon=horizon,
+                                                num_iter=100, engine=engine)
+    # NumPy engine stores reward in single precision, so allow some slack
+    assert np.allclose(rewards['numpy'], rewards['torch'], atol=1e-3)
+
+
+@pytest.mark.parametrize("discount", [1.00, 0.9])
+def test_soft_value_iteration(discount):
+    """Tests SoftValueIteration against max_causal_ent_policy. For
+       discount < 1, it should be within its stopping tolerance of the
+       infinite-horizon policy, and need fewer backups when warm-started.
+       For discount = 1, it should match the finite-horizon policy."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    transition = env.unwrapped.transition
+    reward = env.unwrapped.reward
+    horizon = env._max_episode_steps
+
+    tol = 1e-6
+    planner = tabular_maxent.SoftValueIteration(tol=tol)
+    pol = planner(transition, reward, horizon, discount)
+    if discount == 1:
+        expected = tabular_maxent.max_causal_ent_policy(transition, reward,
+                                                        horizon, discount)
+        assert np.allclose(pol, expected)
+        return
+
+    # Converged so that discount ** horizon is negligible
+    exact_horizon = int(np.ceil(np.log(tol) / np.log(discount))) * 2
+    expected = tabular_maxent.max_causal_ent_policy(transition, reward,
+                                                    exact_horizon, discount)
+    # Log-policy error is at most twice the value error
+    bound = 2 * tol * discount / (1 - discount)
+    assert np.abs(np.log(pol) - np.log(expected)).max() < bound
+    cold_iter = planner.num_iter
+
+    new_reward = reward + 1e-3 * np.arange(len(reward)) / len(reward)
+    pol = planner(transition, new_reward, horizon, discount)
+    expected = tabular_maxent.max_causal_ent_policy(transition, new_reward,
+                                                    exact_horizon, discount)
+    assert np.abs(np.log(pol) - np.log(expected)).max() < bound
+    assert planner.num_iter < cold_iter
+
+    planner.reset()
+    planner(transition, new_reward, horizon, discount)
+    assert planner.num_iter >= cold_iter - 1
+
+    # Runs inside irl()
+    irl_reward, _ = tabular_maxent.irl(
+        env, None, discount, demo_counts=env.unwrapped.initial_states,
+        horizon=horizon, planner=tabular_maxent.SoftValueIteration,
+        counts_method='solve', num_iter=10)
+    assert np.all(np.isfinite(irl_reward))
+
+
+def test_num_threads():
+    """Tests irl() restores the number of threads torch may use."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    old_num_threads = torch.get_num_threads()
+    num_threads = 1 if old_num_threads > 1 else 2
+    tabular_maxent.irl(env, None, 0.9, demo_counts=env.unwrapped.initial_states,
+                       horizon=env._max_episode_steps, num_iter=2,
+                       engine='torch', num_threads=num_threads)
+    assert torch.get_num_threads() == old_num_threads
+
+
+def test_sweep_irl():
+    """Tests a regularization sweep gives the same rewards as separate runs."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    discount = 0.99
+    trajectories = expert_trajectories(env, discount, 5)
+    common_reward = np.zeros(env.unwrapped.transition.shape[0])
+
+    regs = [1e-2, 1e0, 1e2]
+    sweep = tabular_maxent.finetune(common_reward, env, trajectories,
+                                    discount, regularize=regs,
+                                    num_iter=100, engine='torch')
+    assert set(sweep.keys()) == set(regs)
+    for reg in regs:
+        reward, _ = tabular_maxent.finetune(common_reward, env, trajectories,
+                                            discount, regularize=reg,
+                                            num_iter=100, engine='torch')
+        assert np.allclose(reward, sweep[reg][0], atol=1e-6)
+
+
+def test_trajectory_counts():
+    """Tests TrajectoryCounts agrees with empirical_counts on each prefix."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    nS = env.unwrapped.transition.shape[0]
+    trajectories = expert_trajectories(env, 0.9)
+
+    index = tabular_maxent.TrajectoryCounts(nS, trajectories, 0.9)
+    assert len(index) == len(trajectories)
+    for m in range(1, len(trajectories) + 1):
+        expected = tabular_maxent.empirical_counts(nS, trajectories[:m], 0.9)
+        assert np.allclose(index.counts(m), expected)
+
+
+def test_occurrence_loss():
+    """Tests occurrence_loss agrees with policy_loss, given either the
+       occurrence counts or their precomputed occurrence_index."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    nS, nA, _ = env.unwrapped.transition.shape
+    trajectories = expert_trajectories(env, 0.9)
+    policy = tabular_maxent.max_causal_ent_policy(
+        env.unwrapped.transition, np.zeros(nS), env._max_episode_steps, 0.9)
+
+    expected = tabular_maxent.policy_loss(policy, trajectories)
+    occurrences = tabular_maxent.occurrence_counts(nS, nA, trajectories)
+    index = tabular_maxent.occurrence_index(occurrences)
+    for occ in [occurrences, index]:
+        assert tabular_maxent.occurrence_loss(policy, occ) == \
+               pytest.approx(expected)
+    torch_index = tabular_maxent.occurrence_index(torch.tensor(occurrences))
+    assert tabular_maxent.occurrence_loss(torch.tensor(policy), torch_index) \
+           == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("engine", ['numpy', 'torch'])
+def test_float32(engine):
+    """Tests IRL in single precision gives similar rewards to double."""
+    env = gym.make('pirl/GridWorld-Jungle-9x9-Soda-v0')
+    discount = 0.99
+    trajectories = expert_trajectories(env, discount)
+
+    rewards = {}
+    for dtype in ['float64', 'float32']:
+        rewards[dtype], _ = tabular_maxent.irl(env, trajectories, discount,
+                                               num_iter=100, engine=engine,
+                                               dtype=dtype)
+    scale = max(1.0, np.abs(rewards['float64']).max())
+    error = np.abs(rewards['float64'] - rewards['float32']).max()
+    assert error < 1e-3 * scale
+
+    # Conversion is cached, rather than copying on every call
+    compiled = env.unwrapped.compiled
+    assert compiled.astype('float64') is compiled
+    assert compiled.astype('float32') is compiled.astype(np.float32)
+
+
+def test_lbfgs():
+    """Tests the L-BFGS optimizer solves regularized IRL in few iterations."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    transition = env.unwrapped.transition
+    initial_states = env.unwrapped.initial_states
+    horizon = env._max_episode_steps
+    discount = 0.9
+    nS = transition.shape[0]
+    trajectories = expert_trajectories(env, discount)
+    common_reward = np.zeros(nS)
+    regularize = 1.0
+
+    reward, _ = tabular_maxent.finetune(common_reward, env, trajectories,
+                                        discount, regularize=regularize,
+                                        num_iter=30, engine='torch',
+                                        optimizer=tabular_maxent.LBFGS)
+    # Gradient of the regularized objective should vanish at the optimum
+    policy = tabular_maxent.max_causal_ent_policy(transition, reward,
+                                                  horizon, discount)
+    counts = tabular_maxent.expected_counts(policy, transition, initial_states,
+                                            horizon, discount)
+    demo_counts = tabular_maxent.empirical_counts(nS, trajectories, discount)
+    delta = reward - common_reward
+    grad = counts - demo_counts + (regularize / len(trajectories)) * delta
+    assert np.abs(grad).max() < 1e-5
+
+
+def test_lbfgs_rising_objective():
+    """Tests L-BFGS rejects a step satisfying the trapezoidal Armijo
+       condition on the gradient if the objective returned by the closure
+       rises, and accepts it if the guard is disabled."""
+    def step(**kwargs):
+        x = torch.zeros(1, dtype=torch.float64, requires_grad=True)
+        optimizer = tabular_maxent.LBFGS([x], **kwargs)
+        def closure():
+            # Gradient is that of v^2 - v, but the objective rises for v > 1/4
+            v = float(x.data)
+            x.grad = torch.tensor([2 * v - 1], dtype=torch.float64)
+            return v ** 2 - v + 4 * v ** 3
+        objective = optimizer.step(closure)
+        return float(x.data), objective
+
+    x, objective = step(rise_tol=None)
+    assert x == 0.5 and objective > 0
+    x, objective = step()
+    assert x == 0.25 and objective < 0
+
+
+def test_linear_irl():
+    """Tests IRL with one-hot state features is equivalent to tabular IRL,
+       and that Jungle gridworlds supply cell type features."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    features = env.unwrapped.features
+    assert np.all(features.sum(1) == 1)
+
+    nS = env.unwrapped.transition.shape[0]
+    onehot_env = tabular_mdp.TabularMdpEnv(env.unwrapped.transition,
+                                           env.unwrapped.reward,
+                                           env.unwrapped.initial_states,
+                                           env.unwrapped.terminal,
+                                           features=np.eye(nS))
+    discount = 0.9
+    horizon = env._max_episode_steps
+    trajectories = expert_trajectories(env, discount)
+
+    tabular_reward, _ = tabular_maxent.irl(env, trajectories, discount,
+                                           num_iter=50, engine='torch')
+    linear_reward, _ = tabular_maxent.linear_irl(onehot_env, trajectories,
+                                                 discount, horizon=horizon,
+                                                 num_iter=50, engine='torch')
+    assert np.allclose(tabular_reward, linear_reward)
+
+
+def test_batched_irl():
+    """Tests batched IRL on several MDPs gives the same rewards as separate
+       runs of irl(). Only equal up to Adam's epsilon, since the gradient in
+       each block of the batched MDP is scaled by 1 / len(mdps)."""
+    envs = {kind: gym.make('pirl/GridWorld-Jungle-4x4-{}-v0'.format(kind))
+            for kind in ['Soda', 'Water', 'Liquid']}
+    discount = 0.9
+    trajectories = {k: expert_trajectories(env, discount)
+                    for k, env in envs.items()}
+
+    kwargs = {'num_iter': 100, 'engine': 'torch'}
+    batched = tabular_maxent.batched_irl(envs, trajectories, discount,
+                                         **kwargs)
+    assert set(batched.keys()) == set(envs.keys())
+    for k, env in envs.items():
+        reward, _ = tabular_maxent.irl(env, trajectories[k], discount,
+                                       **kwargs)
+        assert np.allclose(reward, batched[k][0], atol=1e-3)
+
+    mean_reward = tabular_maxent.metalearn(envs, trajectories, discount,
+                                           **kwargs)
+    batched_mean = tabular_maxent.metalearn(envs, trajectories, discount,
+                                            batched=True, **kwargs)
+    assert np.allclose(mean_reward, batched_mean, atol=1e-3)
+
+
+def test_early_stopping():
+    """Tests irl() stops once the gradient is below grad_tol, returning a
+       converged reward, and that num_iter=0 returns the initial reward."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    transition = env.unwrapped.transition
+    initial_states = env.unwrapped.initial_states
+    horizon = env._max_episode_steps
+    discount = 0.9
+    nS = transition.shape[0]
+    trajectories = expert_trajectories(env, discount)
+
+    grad_tol = 1e-3
+    rewards = [tabular_maxent.irl(env, trajectories, discount,
+                                  num_iter=num_iter, grad_tol=grad_tol)[0]
+               for num_iter in [1000, 2000]]
+    # Stopped early, so more iterations make no difference
+    assert np.all(rewards[0] == rewards[1])
+    policy = tabular_maxent.max_causal_ent_policy(transition, rewards[0],
+                                                  horizon, discount)
+    counts = tabular_maxent.expected_counts(policy, transition, initial_states,
+                                            horizon, discount)
+    demo_counts = tabular_maxent.empirical_counts(nS, trajectories, discount)
+    assert np.abs(counts - demo_counts).max() < 2 * grad_tol
+
+    init_reward = np.arange(nS, dtype=float)
+    for engine in ['numpy', 'torch']:
+        reward, policy = tabular_maxent.irl(env, trajectories, discount,
+                                            num_iter=0, engine=engine,
+                                            init_reward=init_reward)
+        assert np.all(reward == init_reward)
+        expected = tabular_maxent.max_causal_ent_policy(transition,
+                                                        init_reward,
+                                                        horizon, discount)
+        assert np.allclose(policy, expected)
+
+
+@pytest.mark.parametrize("method,discount,sparse",
+    itertools.product(['doubling', 'solve'], [1.00, 0.9], [False, True])
+)
+def test_expected_counts_methods(method, discount, sparse):
+    """Tests the closed-form methods of expected_counts agree with 'iterate'.
+       'solve' computes infinite-horizon counts, so is compared against
+       'iterate' with a horizon long enough that truncation is negligible."""
+    if method == 'solve' and discount == 1:
+        pytest.skip("'solve' requires discount < 1")
+    env = gym.make('pirl/GridWorld-Jungle-9x9-Soda-v0')
+    transition = env.unwrapped.transition
+    if sparse:
+        transition = tabular_mdp.SparseTransition.from_dense(transition)
+    initial_states = env.unwrapped.initial_states
+    horizon = env._max_episode_steps if method == 'doubling' else 500
+    policy = tabular_maxent.max_causal_ent_policy(transition,
+                                                  env.unwrapped.reward,
+                                                  horizon, discount)
+
+    expected = tabular_maxent.expected_counts(policy, transition,
+                                              initial_states, horizon,
+                                              discount, method='iterate')
+    actual = tabular_maxent.expected_counts(policy, transition,
+                                            initial_states, horizon,
+                                            discount, method=method)
+    assert np.allclose(actual, expected)
+
+    per_timestep = tabular_maxent.expected_counts(policy, transition,
+                                                  initial_states, horizon,
+                                                  discount, per_timestep=True)
+    assert per_timestep.shape == (len(initial_states), horizon + 1)
+    assert np.allclose(per_timestep.sum(1), expected)
+
+
+def test_prefix_irl():
+    """Tests prefix_irl gives the same rewards as separate runs of irl() on
+       each prefix of the trajectories, and warm-starts from the previous
+       prefix when requested."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    discount = 0.9
+    trajectories = expert_trajectories(env, discount)
+
+    ms = [5, 10, 20]
+    res = tabular_maxent.prefix_irl(env, trajectories, discount, ms,
+                                    num_iter=100)
+    assert set(res.keys()) == set(ms)
+    for m in ms:
+        reward, _ = tabular_maxent.irl(env, trajectories[:m], discount,
+                                       num_iter=100)
+        assert np.allclose(reward, res[m][0])
+
+    warm = tabular_maxent.prefix_irl(env, trajectories, discount, [5, 10],
+                                     warm_start=True, num_iter=10)
+    reward, _ = tabular_maxent.irl(env, trajectories[:10], discount,
+                                   num_iter=10, init_reward=warm[5][0])
+    assert np.allclose(reward, warm[10][0])
+
+
+def test_prefix_irl_zero():
+    """Tests prefix_irl with m = 0 gives the same result as irl() with no
+       trajectories, and that warm starts skip rewards that are not finite."""
+    env = gym.make('pirl/GridWorld-Jungle-4x4-Liquid-v0')
+    nS = env.unwrapped.transition.shape[0]
+    discount = 0.9
+    trajectories = expert_trajectories(env, discount)
+
+    # Regularized: the reward for m = 0 is common_reward, and finite
+    common_reward = np.ones(nS)
+    kwargs = dict(num_iter=10, regularize=1.0, common_reward=common_reward)
+    res = tabular_maxent.prefix_irl(env, trajectories, discount, [0, 5],
+                                    warm_start=True, **kwargs)
+    reward, _ = tabular_maxent.irl(env, [], discount, **kwargs)
+    assert np.allclose(reward, res[0][0])
+    reward, _ = tabular_maxent.irl(env, trajectories[:5], discount,
+                                   init_reward=res[0][0], **kwargs)
+    assert np.allclose(reward, res[5][0])
+
+    # Unregularized: no warm start from the reward for m = 0
+    res = tabular_maxent.prefix_irl(env, trajectories, discount, [0, 5],
+                                    warm_start=True, num_iter=10)
+    assert np.all(np.isfinite(res[5][0]))
+    reward, _ = tabular_maxent.irl(env, trajectories[:5], discount,
+                                   num_iter=10)
+    assert np.allclose(reward, res[5][0])
+
+
+def test_lbfgs_undiscounted():
+    """Tests L-BFGS and Adam converge to a tightly converged reference for
+       regularized IRL without discounting, and L-BFGS stops if the initial
+       gradient is zero. The regularized objective is coef-strongly convex,
+       so a reward with gradient g is within |g|_2 / coef of the optimum:
+       each optimizer is compared to the reference within this bound."""
+    env = gym.make('pirl/GridWorld-Jungle-9x9-Soda-v0')
+    transition = env.unwrapped.transition
+    initial_states = env.unwrapped.initial_states
+    horizon = env._max_episode_steps
+    discount = 1.00
+    nS = transition.shape[0]
+    trajectories = expert_trajectories(env, discount)
+    common_reward = np.zeros(nS)
+    regularize = 1.0
+    coef = regularize / len(trajectories)
+    demo_counts = tabular_maxent.empirical_counts(nS, trajectories, discount)
+
+    def grad_norm(reward):
+        policy = tabular_maxent.max_causal_ent_policy(transition, reward,
+                                                      horizon, discount)
+        counts = tabular_maxent.expected_counts(policy, transition,
+                                                initial_states, horizon,
+                                                discount)
+        grad = counts - demo_counts + coef * (reward - common_reward)
+        return np.linalg.norm(grad)
+
+    rewards = {}
+    for name, optimizer, kwargs in [
+            ('reference', tabular_maxent.lbfgs_optimizer,
+             dict(num_iter=1000, grad_tol=1e-10)),
+            ('lbfgs', tabular_maxent.lbfgs_optimizer,
+             dict(num_iter=100, grad_tol=1e-6)),
+            ('adam', tabular_maxent.default_optimizer,
+             dict(num_iter=500))]:
+        rewards[name], _ = tabular_maxent.finetune(common_reward, env,
+                                                   trajectories, discount,
+                                                   regularize=regularize,
+                                                   optimizer=optimizer,
+                                                   engine='torch', **kwargs)
+    assert grad_norm(rewards['reference']) < 1e-7
+    for name in ['lbfgs', 'adam']:
+        bound = grad_norm(rewards[name]) / coef
+        error = np.linalg.norm(rewards[name] - rewards['reference'])
+        assert error <= bound + 1e-6
+    assert grad_norm(rewards['lbfgs']) / coef < 1e-3
+
+    # Without trajectories, the optimum is common_reward
+    common_reward = np.random.RandomState(0).randn(nS)
+    reward, _ = tabular_maxent.finetune(common_reward, env, [], discount,
+                                        regularize=1.0, num_iter=10,
+                                        init_reward=common_reward,
+                                        optimizer=tabular_maxent.LBFGS,
+                                        engine='torch')
+    assert np.all(reward == common_reward)
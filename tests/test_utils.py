@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+from pirl import utils
+
+def test_cached_model_file():
+    """Tests calls with the same key share one file, which can be removed
+       before the process exits."""
+    calls = []
+    def make_xml():
+        calls.append(None)
+        return '<mujoco model="test{}"/>'.format(len(calls))
+
+    path = utils.cached_model_file(('test', 0), make_xml)
+    assert utils.cached_model_file(('test', 0), make_xml) == path
+    assert len(calls) == 1
+    with open(path, 'r') as f:
+        assert f.read() == '<mujoco model="test1"/>'
+
+    other_path = utils.cached_model_file(('test', 1), make_xml)
+    assert other_path != path
+    assert len(calls) == 2
+
+    # Removing the file early, or twice, is harmless
+    for p in [path, path, other_path]:
+        utils._remove_model_file(p)
+    assert not os.path.exists(path)
+
+def test_rejection_sample_fallback():
+    """Tests rejection_sample falls back to drawing candidates one at a
+       time, rather than failing, once max_batches batches are rejected."""
+    sizes = []
+    def sample(n):
+        sizes.append(n)
+        return np.full(n, len(sizes))
+    def accept(candidates):
+        return candidates > 5
+    assert utils.rejection_sample(sample, accept, batch_size=4,
+                                  max_batches=3) == 6
+    assert sizes == [4, 4, 4, 1, 1, 1]